@@ -1,29 +1,48 @@
 import os
 import json
 import logging
+import time
 import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
-from sp_api.api import CatalogItems, ListingsRestrictions, Products, ProductFees
 from sp_api.base import Marketplaces, SellingApiException
+from sp_api.base.exceptions import SellingApiRequestThrottledException
 
 # Fix the import - use relative import since bsr_scraper.py is in the same directory
 try:
-    from .bsr_scraper import scrape_bsr_table_by_country
+    from .bsr_scraper import BSR_TABLE_URL
+    from .bsr_loader import BSR_DOMAIN_IDS, BsrTableStore
+    from .sp_clients import install_pooled_sessions, sp_client_registry
+    from .response_cache import CACHE_TTLS, response_cache
+    from .shared_state import SharedResponseStore, shared_state
+    from .fee_model import BASIS_UNRESOLVED, FEE_MODEL_MAX_PROBES, FeeModel
+    from .prefetch import PREFETCH_BUDGET_BURST, PREFETCH_BUDGET_PER_MINUTE, PREFETCH_MAX_ASINS, PREFETCH_QUEUE_MAX, PREFETCH_WORKERS, PrefetchQueue
+    from .snapshot_store import ProductSnapshotStore
+    from .rate_limiter import PRIORITY_BULK, rate_scheduler, set_thread_priority
+    from .bulk_stream import STREAM_MAX_ASINS, format_ndjson, format_sse, run_stream_job, stream_jobs
+    from .metrics import OUTCOME_PARTIAL, RequestTimer, bind_timer, render_metrics, request_latency, request_outcome, submit_bound
+    from .log_pipeline import configure_logging, log_request_summary, sample_details
 except ImportError:
     # Fallback for direct execution
-    from bsr_scraper import scrape_bsr_table_by_country
+    from bsr_scraper import BSR_TABLE_URL
+    from bsr_loader import BSR_DOMAIN_IDS, BsrTableStore
+    from sp_clients import install_pooled_sessions, sp_client_registry
+    from response_cache import CACHE_TTLS, response_cache
+    from shared_state import SharedResponseStore, shared_state
+    from fee_model import BASIS_UNRESOLVED, FEE_MODEL_MAX_PROBES, FeeModel
+    from prefetch import PREFETCH_BUDGET_BURST, PREFETCH_BUDGET_PER_MINUTE, PREFETCH_MAX_ASINS, PREFETCH_QUEUE_MAX, PREFETCH_WORKERS, PrefetchQueue
+    from snapshot_store import ProductSnapshotStore
+    from rate_limiter import PRIORITY_BULK, rate_scheduler, set_thread_priority
+    from bulk_stream import STREAM_MAX_ASINS, format_ndjson, format_sse, run_stream_job, stream_jobs
+    from metrics import OUTCOME_PARTIAL, RequestTimer, bind_timer, render_metrics, request_latency, request_outcome, submit_bound
+    from log_pipeline import configure_logging, log_request_summary, sample_details
 
 # --- Logging Configuration ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log') if os.path.exists('.') else logging.NullHandler()
-    ]
-)
+# Log records are queued and written by a background thread, so request threads never
+# block on stderr or disk; app.log is rotated by size
+log_queue_handler = configure_logging(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Flask App Initialization ---
@@ -49,19 +68,47 @@ MARKETPLACE_REGIONS = {
     'BE': {'region': 'EU', 'marketplace_id': 'AMEN7PMS3EDWL'},
 }
 
+# Listing currency of each marketplace, for fee questions asked without an offer price
+MARKETPLACE_CURRENCIES = {
+    'US': 'USD', 'CA': 'CAD', 'MX': 'MXN',
+    'DE': 'EUR', 'FR': 'EUR', 'IT': 'EUR', 'ES': 'EUR', 'NL': 'EUR', 'BE': 'EUR',
+    'GB': 'GBP', 'SE': 'SEK', 'PL': 'PLN',
+}
+
 # --- Load BSR Data with Logging ---
 logger.info("=== APPLICATION STARTUP ===")
-logger.info("Loading BSR tables from SellerAmp...")
-try:
-    BSR_TABLES = {
-        'US': scrape_bsr_table_by_country(1),
-        'CA': scrape_bsr_table_by_country(6),
-    }
-    logger.info(f"BSR tables loaded successfully. US entries: {len(BSR_TABLES.get('US', {}))}, CA entries: {len(BSR_TABLES.get('CA', {}))}")
-except Exception as e:
-    logger.error(f"Error loading BSR tables: {str(e)}")
-    logger.error(traceback.format_exc())
-    BSR_TABLES = {'US': {}, 'CA': {}}
+# Serve from the on-disk snapshot right away and refresh from SellerAmp in the background,
+# so workers start instantly and share one scrape through the snapshot file
+BSR_SNAPSHOT_PATH = os.environ.get('BSR_SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bsr_tables.json'))
+BSR_REFRESH_INTERVAL = int(os.environ.get('BSR_REFRESH_INTERVAL', 24 * 3600))
+bsr_store = BsrTableStore(BSR_DOMAIN_IDS, BSR_SNAPSHOT_PATH, BSR_REFRESH_INTERVAL, url_template=os.environ.get('BSR_TABLE_URL', BSR_TABLE_URL), shared=shared_state)
+bsr_store.load_snapshot()
+bsr_store.start()
+
+BSR_LOOKUP_MAX_ITEMS = int(os.environ.get('BSR_LOOKUP_MAX_ITEMS', 10000))
+
+# --- Product Snapshot Store ---
+# Product data is kept on disk behind the in-memory cache, so restarts start warm and a
+# repeat lookup only re-fetches the kinds of data that have gone stale. Set SNAPSHOT_DB_PATH
+# to an empty string to run memory-only.
+SNAPSHOT_DB_PATH = os.environ.get('SNAPSHOT_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'product_snapshots.db'))
+PRICE_HISTORY_MAX_DAYS = 365
+snapshot_store = None
+if SNAPSHOT_DB_PATH:
+    try:
+        snapshot_store = ProductSnapshotStore(SNAPSHOT_DB_PATH, CACHE_TTLS)
+        response_cache.attach_store(snapshot_store)
+    except Exception as e:
+        logger.error(f"❌ Could not open product snapshot store {SNAPSHOT_DB_PATH}, running memory-only: {str(e)}")
+
+# The snapshot store already serves every worker of this host. A cluster-wide backend (Redis)
+# is added behind it, so data fetched on one host is reused on the others.
+if shared_state is not None and (shared_state.scope == 'cluster' or snapshot_store is None):
+    response_cache.attach_store(SharedResponseStore(shared_state, CACHE_TTLS))
+
+# Every fee estimate also teaches the ASIN's fee profile, which answers later fee questions
+# at other prices without calling SP-API again
+fee_model = FeeModel(response_cache)
 
 # --- Load Credentials from Environment Variables ---
 logger.info("Loading credentials from environment variables...")
@@ -142,8 +189,424 @@ def get_credentials_for_marketplace(marketplace_str):
     else:
         return None, None, f"Unknown region: {region}"
 
+# --- SP-API Worker Pool ---
+# SP-API calls reuse each worker thread's keep-alive HTTP session
+install_pooled_sessions()
+
+# Shared by every request so independent SP-API calls (catalog, restrictions, offers)
+# can run concurrently instead of back-to-back.
+SP_API_MAX_WORKERS = int(os.environ.get('SP_API_MAX_WORKERS', 16))
+sp_api_executor = ThreadPoolExecutor(max_workers=SP_API_MAX_WORKERS, thread_name_prefix='sp-api')
+# Bulk traffic gets its own pool and the bulk priority lane in the rate limiter, so a large
+# batch job can neither occupy the interactive workers nor take quota ahead of page lookups
+SP_API_BULK_MAX_WORKERS = int(os.environ.get('SP_API_BULK_MAX_WORKERS', 8))
+bulk_executor = ThreadPoolExecutor(max_workers=SP_API_BULK_MAX_WORKERS, thread_name_prefix='sp-api-bulk', initializer=set_thread_priority, initargs=(PRIORITY_BULK,))
+# Batch fee estimates also run in the bulk lane, on a pool of their own so they start as soon as
+# their offers are in instead of queueing behind the per-ASIN restriction calls in bulk_executor
+SP_API_BULK_FEES_MAX_WORKERS = int(os.environ.get('SP_API_BULK_FEES_MAX_WORKERS', 2))
+bulk_fees_executor = ThreadPoolExecutor(max_workers=SP_API_BULK_FEES_MAX_WORKERS, thread_name_prefix='sp-api-bulk-fees', initializer=set_thread_priority, initargs=(PRIORITY_BULK,))
+
+# --- Request Deadlines ---
+# A product lookup answers within this budget (ms, override with ?deadline= within the MIN/MAX
+# range, anything outside it is rejected with a 400). Fields whose SP-API
+# calls miss it are listed as pending; the calls keep running and land in the cache, so a
+# follow-up request for just those fields is answered from it.
+REQUEST_DEADLINE_MS = int(os.environ.get('REQUEST_DEADLINE_MS', 3000))
+REQUEST_DEADLINE_MIN_MS = 250
+REQUEST_DEADLINE_MAX_MS = int(os.environ.get('REQUEST_DEADLINE_MAX_MS', 30000))
+# Share of the budget each step is waited for, counted from the start of the request. The steps
+# run concurrently and fees start from the offers callback, so a smaller share gives the others no
+# extra time; it only stops the wait early. Steps that missed their share are checked once more
+# before answering, so a result that arrived while later steps were waited for is still used.
+STEP_DEADLINE_SHARES = {'catalog': 1.0, 'restrictions': 1.0, 'offers': 1.0, 'fees': 1.0}
+STEP_DEADLINE_SHARES.update(json.loads(os.environ.get('STEP_DEADLINE_SHARES', '{}')))
+# Suggested wait before asking again for pending fields
+PENDING_RETRY_AFTER_MS = int(os.environ.get('PENDING_RETRY_AFTER_MS', 1000))
+# A catalog read still running after this long is sent a second time if a rate-limit token is
+# free, and the first answer wins (catalog reads are idempotent). 0 disables hedging.
+CATALOG_HEDGE_AFTER_MS = int(os.environ.get('CATALOG_HEDGE_AFTER_MS', 800))
+
+CATALOG_INCLUDED_DATA = ['summaries', 'identifiers', 'attributes', 'images']
+EMPTY_FEES = {'totalFees': None, 'referralFee': None, 'fbaFee': None, 'netProfit': None}
+
+def parse_dimensions(attributes_data):
+    """Format package dimensions as 'L x W x H cm', converting from inches when needed"""
+    package_dims = attributes_data.get('item_package_dimensions', [{}])[0]
+    if not (package_dims and 'value' in package_dims.get('length', {})):
+        return "N/A"
+
+    values = []
+    for side in ('length', 'width', 'height'):
+        value = package_dims[side]['value']
+        # Convert to cm if in inches
+        if package_dims[side].get('unit', '').lower() in ['inches', 'inch']:
+            value *= 2.54
+        values.append(value)
+
+    length, width, height = values
+    return f"{length:.1f} x {width:.1f} x {height:.1f} cm"
+
+def parse_weight(attributes_data):
+    """Format package weight in grams"""
+    package_weight = attributes_data.get('item_package_weight', [{}])[0]
+    if not (package_weight and 'value' in package_weight):
+        return "N/A"
+
+    weight_value = package_weight['value']
+    weight_unit = package_weight.get('unit', '').lower()
+
+    if weight_unit in ['pounds', 'pound']:
+        # Convert pounds to grams
+        return f"{weight_value * 453.592:.0f} gr"
+    if weight_unit in ['kilograms', 'kg']:
+        # Convert kg to grams
+        return f"{weight_value * 1000:.0f} gr"
+    if weight_unit in ['grams', 'g']:
+        # Already in grams
+        return f"{weight_value:.0f} gr"
+    # Assume it's already in grams if no unit specified
+    try:
+        return f"{float(weight_value):.0f} gr"
+    except (ValueError, TypeError):
+        return "N/A"
+
+def parse_catalog_payload(asin, payload):
+    """Turn a catalog item payload (summaries, identifiers, attributes, images) into result fields"""
+    summary = payload.get('summaries', [{}])[0]
+    catalog_data = {
+        'asin': asin,
+        'title': summary.get('itemName', 'N/A'),
+        # 2020-12-01 catalog returns 'brandName', 2022-04-01 (used by batch search) returns 'brand'
+        'brand': summary.get('brandName') or summary.get('brand', 'N/A'),
+        'ean': next((i['identifier'] for i in payload.get('identifiers', [{}])[0].get('identifiers', []) if i['identifierType'] == 'EAN'), 'N/A'),
+    }
+    logger.info(f"Product: {catalog_data['title'][:50]}...")
+    logger.info(f"Brand: {catalog_data['brand']}")
+
+    # 2. Image Info
+    logger.info("🖼️ Step 2: Processing product images...")
+    try:
+        catalog_data['imageUrl'] = payload.get('images', [{}])[0].get('images', [{}])[0].get('link')
+        logger.info(f"✅ Image URL: {catalog_data['imageUrl'][:50] if catalog_data['imageUrl'] else 'None'}...")
+    except Exception as e:
+        logger.warning(f"⚠️ Could not process images: {str(e)}")
+        catalog_data['imageUrl'] = None
+
+    # 3. Dimensions and Weight
+    logger.info("📏 Step 3: Processing dimensions and weight...")
+    try:
+        attributes_data = payload.get('attributes', {})
+        catalog_data['dimensions'] = parse_dimensions(attributes_data)
+        catalog_data['packageWeight'] = parse_weight(attributes_data)
+        logger.info(f"✅ Dimensions: {catalog_data['dimensions']}, Weight: {catalog_data['packageWeight']}")
+    except Exception as e:
+        logger.error(f"❌ Error processing dimensions/weight: {str(e)}")
+        catalog_data['dimensions'] = "N/A"
+        catalog_data['packageWeight'] = "N/A"
+
+    return catalog_data
+
+def catalog_item_call(region, marketplace, credentials, asin):
+    """The getCatalogItem call for one ASIN, to be run by the rate scheduler"""
+    catalog_api = sp_client_registry.get(region, marketplace, credentials).catalog
+    return lambda: catalog_api.get_catalog_item(asin, includedData=CATALOG_INCLUDED_DATA)
+
+def load_catalog_data(region, marketplace, credentials, asin):
+    catalog_response = rate_scheduler.call('getCatalogItem', region, catalog_item_call(region, marketplace, credentials, asin), marketplace=marketplace.name)
+    logger.info("✅ Catalog item fetched successfully")
+    return parse_catalog_payload(asin, catalog_response.payload)
+
+def hedge_catalog_data(region, marketplace, credentials, asin):
+    """Second catalog read for a slow lookup, sent only if a rate-limit token is free; None if not sent"""
+    catalog_response = rate_scheduler.try_call('getCatalogItem', region, catalog_item_call(region, marketplace, credentials, asin), marketplace=marketplace.name)
+    if catalog_response is None:
+        return None
+    logger.info("✅ Catalog item fetched by hedged request")
+    catalog_data = parse_catalog_payload(asin, catalog_response.payload)
+    response_cache.set('catalog', (asin, marketplace.name), catalog_data)
+    return catalog_data
+
+def fetch_catalog_data(region, marketplace, credentials, asin):
+    """Fetch attributes and images with a single catalog call (Steps 1-3)"""
+    logger.info("🔍 Step 1: Fetching catalog attributes and images...")
+    try:
+        return dict(response_cache.get_or_load('catalog', (asin, marketplace.name), lambda: load_catalog_data(region, marketplace, credentials, asin)))
+    except Exception as e:
+        logger.error(f"❌ Error in catalog attributes: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise
+
+def load_restrictions_data(region, marketplace, credentials, asin, seller_id):
+    restrictions_api = sp_client_registry.get(region, marketplace, credentials).restrictions
+    restrictions_response = rate_scheduler.call('getListingsRestrictions', region, lambda: restrictions_api.get_listings_restrictions(asin=asin, sellerId=seller_id, conditionType='new_new'), marketplace=marketplace.name)
+    restrictions = restrictions_response.payload.get('restrictions', [])
+    logger.info(f"✅ Sellable: {not bool(restrictions)}, Restrictions: {len(restrictions)}")
+    return {
+        'isSellable': not bool(restrictions),
+        'restrictionReasons': [reason.get('message') for r in restrictions for reason in r.get('reasons', [])],
+    }
+
+def fetch_restrictions_data(region, marketplace, credentials, asin, seller_id):
+    """Check selling restrictions for the seller (Step 4)"""
+    logger.info("🚫 Step 4: Checking selling restrictions...")
+    try:
+        return dict(response_cache.get_or_load('restrictions', (asin, marketplace.name), lambda: load_restrictions_data(region, marketplace, credentials, asin, seller_id)))
+    except Exception as e:
+        logger.error(f"❌ Error checking restrictions: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {'isSellable': None, 'restrictionReasons': []}
+
+def process_offers(offers):
+    """Add shipping to FBM prices, sort by price and pick the buybox price"""
+    processed_offers = []
+    for o in offers:
+        # FBM teklifleri için kargo ücretini fiyata ekle
+        if not o.get('IsFulfilledByAmazon', False):
+            listing_price = o.get('ListingPrice', {}).get('Amount', 0.0)
+            shipping_price = o.get('Shipping', {}).get('Amount', 0.0)
+            o['ListingPrice']['Amount'] = float(listing_price) + float(shipping_price)
+        processed_offers.append(o)
+
+    # Fiyatlarına göre sırala
+    processed_offers.sort(key=lambda x: x.get('ListingPrice', {}).get('Amount', float('inf')))
+
+    buybox_price = None
+    currency_code = None
+    # Buy Box kazananını bul
+    buybox_offer = next((o for o in processed_offers if o.get('IsBuyBoxWinner')), None)
+
+    if buybox_offer:
+        buybox_price = float(buybox_offer['ListingPrice']['Amount'])
+        currency_code = buybox_offer['ListingPrice']['CurrencyCode']
+        logger.info(f"✅ Buybox Winner Found: {buybox_price} {currency_code}")
+    elif processed_offers:
+        # Buy Box yoksa, en düşük fiyatlı teklifi kullan
+        first_offer = processed_offers[0]
+        buybox_price = float(first_offer['ListingPrice']['Amount'])
+        currency_code = first_offer['ListingPrice']['CurrencyCode']
+        logger.info(f"✅ No Buybox Winner. Using lowest offer: {buybox_price} {currency_code}")
+
+    return {'offers': processed_offers, 'buyboxPrice': buybox_price, 'currencyCode': currency_code}
+
+def load_offers_data(region, marketplace, credentials, asin):
+    products_api = sp_client_registry.get(region, marketplace, credentials).products
+    offers_response = rate_scheduler.call('getItemOffers', region, lambda: products_api.get_item_offers(asin, "New", MarketplaceId=marketplace.marketplace_id), marketplace=marketplace.name)
+    offers_data = process_offers(offers_response.payload.get('Offers', []))
+    logger.info(f"✅ Offers processed: {len(offers_data['offers'])}")
+    return offers_data
+
+def load_cached_offers_data(region, marketplace, credentials, asin):
+    """Offers from the cache or SP-API; unlike fetch_offers_data, errors are raised"""
+    return dict(response_cache.get_or_load('offers', (asin, marketplace.name), lambda: load_offers_data(region, marketplace, credentials, asin)))
+
+def fetch_offers_data(region, marketplace, credentials, asin):
+    """Fetch new-condition offers and resolve the buybox price (Step 5)"""
+    logger.info("💰 Step 5: Fetching offers and pricing...")
+    try:
+        return load_cached_offers_data(region, marketplace, credentials, asin)
+    except Exception as e:
+        logger.error(f"❌ Error fetching or processing offers: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {'offers': [], 'buyboxPrice': None, 'currencyCode': None}
+
+def parse_fees_result(fees_result, price):
+    """Extract total/referral/FBA fees and net profit from one fees estimate result, None if it failed"""
+    if fees_result.get('Status') != 'Success':
+        logger.warning(f"⚠️ Fees calculation failed: {fees_result.get('Status')}")
+        return None
+
+    fees_estimate = fees_result.get('FeesEstimate', {})
+    total_fees = fees_estimate.get('TotalFeesEstimate', {}).get('Amount', 0.0)
+    fee_details = fees_estimate.get('FeeDetailList', [])
+    fees_data = {
+        'totalFees': total_fees,
+        'referralFee': next((f.get('FeeAmount', {}).get('Amount', 0.0) for f in fee_details if f.get('FeeType') == "ReferralFee"), 0.0),
+        'fbaFee': next((f.get('FeeAmount', {}).get('Amount', 0.0) for f in fee_details if f.get('FeeType') == "FBAFees"), 0.0),
+        'netProfit': price - total_fees,
+    }
+    logger.info(f"✅ Total Fees: {total_fees}, Net Profit: {fees_data['netProfit']}")
+    return fees_data
+
+def fees_cache_key(asin, marketplace, price, currency_code):
+    return (asin, marketplace.name, round(price, 2), currency_code)
+
+def load_fees_data(region, marketplace, credentials, asin, price, currency_code):
+    fees_api = sp_client_registry.get(region, marketplace, credentials).fees
+    estimate_request = {'id_type': 'ASIN', 'id_value': asin, 'price': price, 'currency': currency_code, 'is_fba': True, 'marketplace_id': marketplace.marketplace_id}
+    fees_response = rate_scheduler.call('getMyFeesEstimates', region, lambda: fees_api.get_product_fees_estimate([estimate_request]), marketplace=marketplace.name)
+    fees_data = parse_fees_result(fees_response.payload[0], price)
+    fee_model.observe(asin, marketplace.name, currency_code, price, fees_data)
+    return fees_data
+
+def quote_fees_data(asin, marketplace, price, currency_code):
+    """Fees at a price from the ASIN's fee profile when it pins them down exactly, else None"""
+    fees = fee_model.quote(asin, marketplace.name, currency_code, price)
+    if fees is None:
+        return None
+    logger.info(f"✅ Fees from fee profile ({fees['basis']}): {fees['totalFees']}")
+    return {'totalFees': fees['totalFees'], 'referralFee': fees['referralFee'], 'fbaFee': fees['fbaFee'], 'netProfit': price - fees['totalFees']}
+
+def fetch_fees_data(region, marketplace, credentials, asin, price, currency_code):
+    """Estimate FBA fees and net profit at the given price (Step 6)"""
+    logger.info("🧮 Step 6: Calculating fees...")
+    try:
+        # A failed estimate loads as None, which is returned as empty fees and not cached
+        fees_data = response_cache.get_or_load('fees', fees_cache_key(asin, marketplace, price, currency_code), lambda: quote_fees_data(asin, marketplace, price, currency_code) or load_fees_data(region, marketplace, credentials, asin, price, currency_code))
+        return dict(fees_data or EMPTY_FEES)
+    except Exception as e:
+        logger.error(f"❌ Error calculating fees: {str(e)}")
+        logger.error(traceback.format_exc())
+        return dict(EMPTY_FEES)
+
+OFFER_SUMMARY_TOP_N = int(os.environ.get('OFFER_SUMMARY_TOP_N', 5))
+
+def summarize_offers(offers, top_n=OFFER_SUMMARY_TOP_N):
+    """Compact view of a processed offer list (price-sorted, FBM prices already include shipping)"""
+    def price(offer):
+        return offer.get('ListingPrice', {}).get('Amount')
+
+    fba_offers = [o for o in offers if o.get('IsFulfilledByAmazon')]
+    fbm_offers = [o for o in offers if not o.get('IsFulfilledByAmazon')]
+    buybox_offer = next((o for o in offers if o.get('IsBuyBoxWinner')), None)
+    return {
+        'offerCount': len(offers),
+        'fbaCount': len(fba_offers),
+        'fbmCount': len(fbm_offers),
+        'lowestFbaPrice': price(fba_offers[0]) if fba_offers else None,
+        'lowestFbmLandedPrice': price(fbm_offers[0]) if fbm_offers else None,
+        'buyboxPrice': price(buybox_offer) if buybox_offer else None,
+        'buyboxIsFba': bool(buybox_offer.get('IsFulfilledByAmazon')) if buybox_offer else None,
+        'topOffers': [{
+            'sellerId': o.get('SellerId'),
+            'price': price(o),
+            'isFba': bool(o.get('IsFulfilledByAmazon')),
+            'isBuyBoxWinner': bool(o.get('IsBuyBoxWinner')),
+        } for o in offers[:top_n]],
+    }
+
+# --- Field Selection ---
+# Response fields produced by each pipeline step. A request with fields=/include= only runs
+# the steps its fields need; fees also needs the offers step for the buybox price.
+STEP_FIELDS = {
+    'catalog': ['title', 'brand', 'ean', 'imageUrl', 'dimensions', 'packageWeight'],
+    'restrictions': ['isSellable', 'restrictionReasons'],
+    'offers': ['buyboxPrice', 'currencyCode', 'offerSummary', 'offers'],
+    'fees': ['totalFees', 'referralFee', 'fbaFee', 'netProfit'],
+}
+PIPELINE_STEPS = tuple(STEP_FIELDS)
+# Group names usable in fields=; 'offers' itself is the raw offer list, 'pricing' the compact view
+FIELD_GROUPS = {
+    'catalog': STEP_FIELDS['catalog'],
+    'restrictions': STEP_FIELDS['restrictions'],
+    'pricing': ['buyboxPrice', 'currencyCode', 'offerSummary'],
+    'fees': STEP_FIELDS['fees'],
+}
+# Fields that need no SP-API call
+LOCAL_FIELDS = ['bsrPercentile']
+# Fields of a response without fields=; offerSummary is only computed when asked for
+DEFAULT_FIELDS = [f for step_fields in STEP_FIELDS.values() for f in step_fields if f != 'offerSummary']
+
+def parse_fields(fields_param):
+    """Expand a comma-separated fields/include list; returns (fields, steps, error_message)"""
+    known_fields = set(LOCAL_FIELDS) | {f for step_fields in STEP_FIELDS.values() for f in step_fields}
+    fields = []
+    for name in (f.strip() for f in fields_param.split(',')):
+        if not name:
+            continue
+        if name in FIELD_GROUPS:
+            fields.extend(FIELD_GROUPS[name])
+        elif name in known_fields:
+            fields.append(name)
+        else:
+            known = ', '.join(sorted(set(FIELD_GROUPS) | known_fields))
+            return None, None, f"Unknown field: {name}. Known fields: {known}"
+    if not fields:
+        return None, None, "No fields requested"
+
+    fields = list(dict.fromkeys(fields))
+    steps = {step for step, step_fields in STEP_FIELDS.items() if any(f in step_fields for f in fields)}
+    return fields, steps, None
+
+# --- Step Deadlines ---
+def parse_deadline(deadline_param):
+    """Response budget in seconds from ?deadline=<ms>; returns (budget, error_message)"""
+    if deadline_param is None:
+        return REQUEST_DEADLINE_MS / 1000, None
+    try:
+        deadline_ms = int(deadline_param)
+    except ValueError:
+        deadline_ms = None
+    if deadline_ms is None or not REQUEST_DEADLINE_MIN_MS <= deadline_ms <= REQUEST_DEADLINE_MAX_MS:
+        return None, f"deadline must be between {REQUEST_DEADLINE_MIN_MS} and {REQUEST_DEADLINE_MAX_MS} ms"
+    return deadline_ms / 1000, None
+
+def wait_for_step(future, until, hedge=None, hedge_after=None):
+    """
+    Wait for a step's future until `until` (a time.monotonic() value; None waits as long as it
+    takes). Returns the finished future, or None if the step missed its deadline.
+
+    With `hedge`, a function that submits a duplicate of the step and returns its future, a step
+    still running after `hedge_after` seconds is sent a second time and the first success counts.
+    A hedge that resolves to None was not sent. The original's failure is only returned once no
+    hedge is left running.
+    """
+    def remaining(at):
+        return None if at is None else max(at - time.monotonic(), 0)
+
+    futures = [future]
+    if hedge is not None:
+        hedge_at = time.monotonic() + hedge_after
+        done, _ = wait(futures, timeout=remaining(hedge_at if until is None else min(hedge_at, until)))
+        if not done and (until is None or time.monotonic() < until):
+            futures.append(hedge())
+
+    while True:
+        done, _ = wait(futures, timeout=remaining(until), return_when=FIRST_COMPLETED)
+        if not done:
+            return None
+        for finished in done:
+            if finished.exception() is None and (finished is future or finished.result() is not None):
+                return finished
+        # The original or the hedge failed (or the hedge was not sent), keep waiting for the other
+        futures = [f for f in futures if f not in done]
+        if not futures:
+            return future
+
+def chain_fees(offers_future, timer, region, marketplace, credentials, asin):
+    """
+    Future of the fee step, submitted as soon as offers are in rather than when the request
+    gets to it, so fees are still estimated (and cached) if the request stops waiting for
+    offers. No worker waits in between. Resolves to None without a buybox price.
+    """
+    fees_future = Future()
+
+    def forward(done):
+        if done.exception() is not None:
+            fees_future.set_exception(done.exception())
+        else:
+            fees_future.set_result(done.result())
+
+    def start(done):
+        if done.exception() is not None:
+            fees_future.set_exception(done.exception())
+            return
+        offers_data = done.result()
+        buybox_price, currency_code = offers_data['buyboxPrice'], offers_data['currencyCode']
+        if not (buybox_price and currency_code):
+            logger.info("ℹ️ No price available for fee calculation, skipping.")
+            fees_future.set_result(None)
+            return
+        sp_api_executor.submit(timer.run, 'fees', fetch_fees_data, region, marketplace, credentials, asin, buybox_price, currency_code).add_done_callback(forward)
+
+    offers_future.add_done_callback(start)
+    return fees_future
+
 # --- Main Function to Get Product Details ---
-def get_full_product_details_as_json(asin: str, marketplace_str: str):
+def get_full_product_details_as_json(asin: str, marketplace_str: str, timer=None, steps=PIPELINE_STEPS, budget=None):
+    """
+    Product details for one ASIN. With a `budget` (seconds) each step is waited for until its
+    share of it (STEP_DEADLINE_SHARES) and steps that miss it are listed in 'pending' by field.
+    """
     logger.info(f"=== PRODUCT DETAILS REQUEST ===")
     logger.info(f"ASIN: {asin}, Marketplace: {marketplace_str}")
     
@@ -162,212 +625,545 @@ def get_full_product_details_as_json(asin: str, marketplace_str: str):
         return {"error": error_msg}
 
     try:
-        logger.info("Initializing Amazon SP APIs...")
-        # Initialize APIs with the credentials loaded from environment variables
-        catalog_api = CatalogItems(credentials=credentials, marketplace=marketplace)
-        restrictions_api = ListingsRestrictions(credentials=credentials, marketplace=marketplace)
-        products_api = Products(credentials=credentials, marketplace=marketplace)
-        fees_api = ProductFees(credentials=credentials, marketplace=marketplace)
-        logger.info("✅ All APIs initialized successfully")
+        region = MARKETPLACE_REGIONS[marketplace_str.upper()]['region']
+        timer = timer or RequestTimer(marketplace.name)
+        started = time.monotonic()
 
-        result_data = {}
+        def until(step):
+            return started + budget * STEP_DEADLINE_SHARES.get(step, 1.0) if budget else None
+
+        # Catalog, restrictions and offers are independent - run them concurrently.
+        # Fees is the only step that depends on an earlier result (the buybox price),
+        # so it starts as soon as offers are in, while catalog/restrictions may still be running.
+        # Steps not needed for the requested fields are skipped entirely.
+        catalog_future = restrictions_future = offers_future = fees_future = None
+        catalog_hedge = None
+        # Hedge early enough for the duplicate to land within the catalog step's budget
+        hedge_after = CATALOG_HEDGE_AFTER_MS / 1000
+        if budget:
+            hedge_after = min(hedge_after, budget * STEP_DEADLINE_SHARES.get('catalog', 1.0) / 2)
+        if 'catalog' in steps:
+            catalog_future = sp_api_executor.submit(timer.run, 'catalog', fetch_catalog_data, region, marketplace, credentials, asin)
+            if CATALOG_HEDGE_AFTER_MS > 0:
+                catalog_hedge = lambda: sp_api_executor.submit(timer.run, 'catalogHedge', hedge_catalog_data, region, marketplace, credentials, asin)
+        if 'restrictions' in steps:
+            restrictions_future = sp_api_executor.submit(timer.run, 'restrictions', fetch_restrictions_data, region, marketplace, credentials, asin, seller_id)
+        if 'offers' in steps or 'fees' in steps:
+            offers_future = sp_api_executor.submit(timer.run, 'offers', fetch_offers_data, region, marketplace, credentials, asin)
+            if 'fees' in steps:
+                fees_future = chain_fees(offers_future, timer, region, marketplace, credentials, asin)
+
+        result_data = {'asin': asin}
+        finished_steps = {}
+        missed = []
+        for step, future, hedge in (('catalog', catalog_future, catalog_hedge), ('restrictions', restrictions_future, None), ('offers', offers_future, None), ('fees', fees_future, None)):
+            if future is None:
+                continue
+            finished = wait_for_step(future, until(step), hedge, hedge_after)
+            if finished is None:
+                missed.append((step, future))
+            else:
+                finished_steps[step] = finished
+        # A step that missed its share may have finished while the later ones were waited for
+        pending = []
+        for step, future in missed:
+            if future.done() and future.exception() is None:
+                finished_steps[step] = future
+            else:
+                pending.extend(STEP_FIELDS[step])
+                timer.mark_unfinished(step)
+        for step, finished in finished_steps.items():
+            if step == 'fees':
+                result_data.update(finished.result() or EMPTY_FEES)
+            else:
+                result_data.update(finished.result())
+
+        if pending:
+            logger.warning(f"⏱️ Deadline of {budget * 1000:.0f} ms reached, still pending: {', '.join(pending)}")
+            result_data['pending'] = pending
+        else:
+            logger.info("✅ Product details fetched successfully")
+        return result_data
+
+    except SellingApiException as e:
+        error_message = str(e.payload or e)
+        logger.error(f"❌ Amazon SP API Error: {error_message}")
+        logger.error(f"Full exception: {e}")
+        return {"error": f"API Error: {error_message}"}
+    except Exception as e:
+        logger.error(f"❌ Unexpected error: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {"error": f"An unexpected server error occurred: {str(e)}"}
+
+# --- Batch Product Details ---
+# SP-API batch operations accept at most 20 items per call
+SP_API_BATCH_SIZE = 20
+BATCH_MAX_ASINS = int(os.environ.get('BATCH_MAX_ASINS', 1000))
+
+def chunked(items, size):
+    """Split a list into consecutive chunks of at most `size` items"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def fetch_catalog_batch(region, marketplace, credentials, asins):
+    """Fetch catalog fields for up to 20 ASINs with one searchCatalogItems call"""
+    logger.info(f"🔍 Batch: searching catalog for {len(asins)} ASINs...")
+    search_api = sp_client_registry.get(region, marketplace, credentials).catalog_search
+    response = rate_scheduler.call('searchCatalogItems', region, lambda: search_api.search_catalog_items(identifiers=','.join(asins), identifiersType='ASIN', includedData=CATALOG_INCLUDED_DATA, pageSize=len(asins)), marketplace=marketplace.name)
+
+    catalog_by_asin = {}
+    for item in response.payload.get('items', []):
+        catalog_by_asin[item['asin']] = parse_catalog_payload(item['asin'], item)
+        response_cache.set('catalog', (item['asin'], marketplace.name), catalog_by_asin[item['asin']])
+    return catalog_by_asin
+
+def fetch_offers_batch(region, marketplace, credentials, asins):
+    """Fetch new-condition offers for up to 20 ASINs with one getItemOffersBatch call"""
+    logger.info(f"💰 Batch: fetching offers for {len(asins)} ASINs...")
+    products_api = sp_client_registry.get(region, marketplace, credentials).products
+    batch_requests = [{
+        'uri': f'/products/pricing/v0/items/{asin}/offers',
+        'method': 'GET',
+        'MarketplaceId': marketplace.marketplace_id,
+        'ItemCondition': 'New',
+        'CustomerType': 'Consumer',
+    } for asin in asins]
+    response = rate_scheduler.call('getItemOffersBatch', region, lambda: products_api.get_item_offers_batch(requests_=batch_requests), marketplace=marketplace.name)
+
+    offers_by_asin = {}
+    for position, item in enumerate(response.payload.get('responses', [])):
+        body = item.get('body', {})
+        payload = body.get('payload', {})
+        # ASIN is missing from the payload on error responses; SP-API echoes it in request.Asin,
+        # and responses come back in request order
+        asin = payload.get('ASIN') or item.get('request', {}).get('Asin')
+        if not asin:
+            if position >= len(asins):
+                logger.warning(f"⚠️ Batch offers response {position} matches no requested ASIN, skipping")
+                continue
+            asin = asins[position]
+        status_code = item.get('status', {}).get('statusCode')
+        if status_code != 200 or body.get('errors'):
+            logger.warning(f"⚠️ Batch offers failed for {asin}: {status_code} {body.get('errors')}")
+            offers_by_asin[asin] = {'offers': [], 'buyboxPrice': None, 'currencyCode': None}
+            continue
+        offers_by_asin[asin] = process_offers(payload.get('Offers', []))
+        response_cache.set('offers', (asin, marketplace.name), offers_by_asin[asin])
+    return offers_by_asin
+
+def fetch_fees_batch(region, marketplace, credentials, estimates):
+    """
+    Estimate FBA fees for up to 20 (asin, price, currency_code) triples with one call; the same
+    ASIN may appear at several prices. Returns {(asin, price): fees_data} for the successful ones.
+    """
+    logger.info(f"🧮 Batch: estimating fees for {len(estimates)} prices...")
+    fees_api = sp_client_registry.get(region, marketplace, credentials).fees
+    # Results are matched back through the identifier, which SP-API echoes as SellerInputIdentifier
+    by_identifier = {f"{asin}@{price:.2f}": (asin, price, currency_code) for asin, price, currency_code in estimates}
+    estimate_requests = [{
+        'id_type': 'ASIN',
+        'id_value': asin,
+        'identifier': identifier,
+        'price': price,
+        'currency': currency_code,
+        'is_fba': True,
+        'marketplace_id': marketplace.marketplace_id,
+    } for identifier, (asin, price, currency_code) in by_identifier.items()]
+    response = rate_scheduler.call('getMyFeesEstimates', region, lambda: fees_api.get_product_fees_estimate(estimate_requests), marketplace=marketplace.name)
+
+    fees_by_price = {}
+    for fees_result in response.payload:
+        identifier = fees_result.get('FeesEstimateIdentifier', {}).get('SellerInputIdentifier')
+        if identifier not in by_identifier:
+            continue
+        asin, price, currency_code = by_identifier[identifier]
+        fees_data = parse_fees_result(fees_result, price)
+        if fees_data is not None:
+            fees_by_price[(asin, price)] = fees_data
+            response_cache.set('fees', fees_cache_key(asin, marketplace, price, currency_code), fees_data)
+            fee_model.observe(asin, marketplace.name, currency_code, price, fees_data)
+    return fees_by_price
+
+def get_product_details_batch(asins, marketplace_str: str):
+    """
+    Fetch product details for many ASINs using SP-API batch operations.
+
+    Cached catalog, offers and fees are reused; only the misses are fetched. Catalog and offers
+    are fetched 20 ASINs per call, fees are estimated 20 ASINs per call as soon as each offers
+    batch returns, and restrictions (which have no batch operation) run per ASIN on the bulk
+    worker pool. Returns per-ASIN results in input order; an ASIN whose catalog data could not
+    be fetched gets an 'error' field instead of product fields.
+    """
+    logger.info(f"=== BATCH PRODUCT DETAILS REQUEST ===")
+    logger.info(f"ASINs: {len(asins)}, Marketplace: {marketplace_str}")
+
+    credentials, seller_id, error = get_credentials_for_marketplace(marketplace_str)
+    if error:
+        logger.error(f"❌ Credential error: {error}")
+        return {"error": error}
+
+    try:
+        marketplace = getattr(Marketplaces, marketplace_str.upper())
+    except AttributeError:
+        error_msg = f"Invalid marketplace: '{marketplace_str}'"
+        logger.error(error_msg)
+        return {"error": error_msg}
+
+    region = MARKETPLACE_REGIONS[marketplace_str.upper()]['region']
+
+    catalog_by_asin = {}
+    offers_by_asin = {}
+    fees_by_asin = {}
+    for asin in asins:
+        catalog_data = response_cache.get('catalog', (asin, marketplace.name))
+        if catalog_data is not None:
+            catalog_by_asin[asin] = catalog_data
+        offers_data = response_cache.get('offers', (asin, marketplace.name))
+        if offers_data is not None:
+            offers_by_asin[asin] = offers_data
+    catalog_misses = [asin for asin in asins if asin not in catalog_by_asin]
+    offers_misses = [asin for asin in asins if asin not in offers_by_asin]
+    logger.info(f"Cache hits - catalog: {len(catalog_by_asin)}, offers: {len(offers_by_asin)}")
+
+    # Bound to the request's timer, so the pool threads follow its log sampling decision
+    catalog_futures = {submit_bound(bulk_executor, fetch_catalog_batch, region, marketplace, credentials, chunk): chunk for chunk in chunked(catalog_misses, SP_API_BATCH_SIZE)}
+    offers_futures = {submit_bound(bulk_executor, fetch_offers_batch, region, marketplace, credentials, chunk): chunk for chunk in chunked(offers_misses, SP_API_BATCH_SIZE)}
+    restrictions_futures = {asin: submit_bound(bulk_executor, fetch_restrictions_data, region, marketplace, credentials, asin, seller_id) for asin in asins}
+
+    fees_futures = []
+
+    def estimate_fees(offers_data_by_asin):
+        estimates = []
+        for asin, data in offers_data_by_asin.items():
+            if not (data['buyboxPrice'] and data['currencyCode']):
+                continue
+            fees_data = response_cache.get('fees', fees_cache_key(asin, marketplace, data['buyboxPrice'], data['currencyCode'])) or quote_fees_data(asin, marketplace, data['buyboxPrice'], data['currencyCode'])
+            if fees_data is not None:
+                fees_by_asin[asin] = fees_data
+            else:
+                estimates.append((asin, data['buyboxPrice'], data['currencyCode']))
+        fees_futures.extend(submit_bound(bulk_fees_executor, fetch_fees_batch, region, marketplace, credentials, chunk) for chunk in chunked(estimates, SP_API_BATCH_SIZE))
 
-        # 1. Catalog Info (Attributes)
-        logger.info("🔍 Step 1: Fetching catalog attributes...")
+    # Submit each fees batch as soon as its offers batch has produced buybox prices
+    estimate_fees(offers_by_asin)
+    for future in as_completed(offers_futures):
         try:
-            catalog_response_attributes = catalog_api.get_catalog_item(asin, includedData=['summaries', 'identifiers', 'attributes'])
-            logger.info("✅ Catalog attributes fetched successfully")
-            
-            summary = catalog_response_attributes.payload.get('summaries', [{}])[0]
-            result_data['asin'] = asin
-            result_data['title'] = summary.get('itemName', 'N/A')
-            result_data['brand'] = summary.get('brandName', 'N/A')
-            result_data['ean'] = next((i['identifier'] for i in catalog_response_attributes.payload.get('identifiers', [{}])[0].get('identifiers', []) if i['identifierType'] == 'EAN'), 'N/A')
-            
-            logger.info(f"Product: {result_data['title'][:50]}...")
-            logger.info(f"Brand: {result_data['brand']}")
-            
+            chunk_offers = future.result()
         except Exception as e:
-            logger.error(f"❌ Error in catalog attributes: {str(e)}")
+            logger.error(f"❌ Error in batch offers: {str(e)}")
             logger.error(traceback.format_exc())
-            raise
+            chunk_offers = {}
+        offers_by_asin.update(chunk_offers)
+        estimate_fees(chunk_offers)
 
-        # 2. Image Info
-        logger.info("🖼️ Step 2: Fetching product images...")
+    for future in fees_futures:
         try:
-            catalog_response_images = catalog_api.get_catalog_item(asin, includedData=['images'])
-            result_data['imageUrl'] = catalog_response_images.payload.get('images', [{}])[0].get('images', [{}])[0].get('link')
-            logger.info(f"✅ Image URL: {result_data['imageUrl'][:50] if result_data['imageUrl'] else 'None'}...")
+            fees_by_asin.update({asin: fees_data for (asin, _), fees_data in future.result().items()})
         except Exception as e:
-            logger.warning(f"⚠️ Could not fetch images: {str(e)}")
-            result_data['imageUrl'] = None
+            logger.error(f"❌ Error in batch fees: {str(e)}")
+            logger.error(traceback.format_exc())
 
-        # 3. Dimensions and Weight
-        logger.info("📏 Step 3: Processing dimensions and weight...")
+    catalog_errors = {}
+    for future, chunk in catalog_futures.items():
         try:
-            attributes_data = catalog_response_attributes.payload.get('attributes', {})
-            
-            # Dimensions
-            package_dims = attributes_data.get('item_package_dimensions', [{}])[0]
-            if package_dims and 'value' in package_dims.get('length', {}):
-                # Check if dimensions are in inches and convert to cm
-                length_unit = package_dims['length'].get('unit', '').lower()
-                width_unit = package_dims['width'].get('unit', '').lower()
-                height_unit = package_dims['height'].get('unit', '').lower()
-                
-                length = package_dims['length']['value']
-                width = package_dims['width']['value']
-                height = package_dims['height']['value']
-                
-                # Convert to cm if in inches
-                if length_unit in ['inches', 'inch']:
-                    length *= 2.54
-                if width_unit in ['inches', 'inch']:
-                    width *= 2.54
-                if height_unit in ['inches', 'inch']:
-                    height *= 2.54
-                
-                result_data['dimensions'] = f"{length:.1f} x {width:.1f} x {height:.1f} cm"
-                logger.info(f"✅ Dimensions: {result_data['dimensions']}")
-            else:
-                result_data['dimensions'] = "N/A"
-                logger.info("ℹ️ No dimensions available")
-
-            # Weight
-            package_weight = attributes_data.get('item_package_weight', [{}])[0]
-            if package_weight and 'value' in package_weight:
-                weight_value = package_weight['value']
-                weight_unit = package_weight.get('unit', '').lower()
-                
-                if weight_unit in ['pounds', 'pound']:
-                    # Convert pounds to grams
-                    weight_gr = weight_value * 453.592
-                    result_data['packageWeight'] = f"{weight_gr:.0f} gr"
-                elif weight_unit in ['kilograms', 'kg']:
-                    # Convert kg to grams
-                    weight_gr = weight_value * 1000
-                    result_data['packageWeight'] = f"{weight_gr:.0f} gr"
-                elif weight_unit in ['grams', 'g']:
-                    # Already in grams
-                    result_data['packageWeight'] = f"{weight_value:.0f} gr"
-                else:
-                    # Assume it's already in grams if no unit specified
-                    try:
-                        result_data['packageWeight'] = f"{float(weight_value):.0f} gr"
-                    except (ValueError, TypeError):
-                        result_data['packageWeight'] = "N/A"
-                
-                logger.info(f"✅ Weight: {result_data['packageWeight']}")
-            else:
-                result_data['packageWeight'] = "N/A"
-                logger.info("ℹ️ No weight available")
-                
+            catalog_by_asin.update(future.result())
         except Exception as e:
-            logger.error(f"❌ Error processing dimensions/weight: {str(e)}")
-            result_data['dimensions'] = "N/A"
-            result_data['packageWeight'] = "N/A"
+            logger.error(f"❌ Error in batch catalog: {str(e)}")
+            logger.error(traceback.format_exc())
+            catalog_errors.update({asin: f"Catalog error: {str(e)}" for asin in chunk})
+
+    results = []
+    for asin in asins:
+        if asin not in catalog_by_asin:
+            results.append({'asin': asin, 'error': catalog_errors.get(asin, "ASIN not found in catalog")})
+            continue
+        result_data = {}
+        result_data.update(catalog_by_asin[asin])
+        result_data.update(restrictions_futures[asin].result())
+        result_data.update(offers_by_asin.get(asin, {'offers': [], 'buyboxPrice': None, 'currencyCode': None}))
+        result_data.update(fees_by_asin.get(asin, EMPTY_FEES))
+        results.append(result_data)
+
+    logger.info(f"✅ Batch completed: {sum('error' not in r for r in results)}/{len(results)} ASINs succeeded")
+    return {'marketplace': marketplace_str.upper(), 'count': len(results), 'results': results}
+
+# --- Cross-Marketplace Price Comparison ---
+COMPARE_DEFAULT_MARKETPLACES = ['DE', 'FR', 'IT', 'ES']
+# The extension shows the United Kingdom as 'UK', SP-API calls it 'GB'
+MARKETPLACE_ALIASES = {'UK': 'GB'}
+
+def resolve_marketplace_code(market):
+    market = market.strip().upper()
+    return MARKETPLACE_ALIASES.get(market, market)
+
+def compare_marketplace_prices(asin, markets):
+    """
+    Fetch offers for one ASIN in several marketplaces concurrently and return the
+    per-market price table used by the extension's EU price panel.
+    """
+    logger.info(f"🌍 Comparing prices for {asin} in {', '.join(markets)}...")
+    futures = {}
+    unavailable = []
+    for market in markets:
+        code = resolve_marketplace_code(market)
+        credentials, _, error = get_credentials_for_marketplace(code)
+        if error:
+            unavailable.append({'market': market, 'error': error})
+            continue
+        region = MARKETPLACE_REGIONS[code]['region']
+        marketplace = getattr(Marketplaces, code)
+        # Same cache entries as the single-ASIN lookup, so either warms the other. Errors are
+        # kept, so a failed lookup is not reported as a marketplace without offers.
+        futures[market] = submit_bound(sp_api_executor, load_cached_offers_data, region, marketplace, credentials, asin)
 
-        # 4. Restrictions
-        logger.info("🚫 Step 4: Checking selling restrictions...")
+    prices = []
+    for market, future in futures.items():
         try:
-            restrictions_response = restrictions_api.get_listings_restrictions(asin=asin, sellerId=seller_id, conditionType='new_new')
-            restrictions = restrictions_response.payload.get('restrictions', [])
-            result_data['isSellable'] = not bool(restrictions)
-            result_data['restrictionReasons'] = [reason.get('message') for r in restrictions for reason in r.get('reasons', [])]
-            logger.info(f"✅ Sellable: {result_data['isSellable']}, Restrictions: {len(restrictions)}")
+            offers_data = future.result()
+        except SellingApiRequestThrottledException:
+            logger.warning(f"⚠️ Offers lookup for {asin} in {market} throttled")
+            unavailable.append({'market': market, 'error': "Throttled by SP-API, try again shortly"})
+            continue
+        except SellingApiException as e:
+            logger.error(f"❌ Offers lookup for {asin} in {market} failed: {str(e.payload or e)}")
+            unavailable.append({'market': market, 'error': f"API Error: {str(e.payload or e)}"})
+            continue
         except Exception as e:
-            logger.error(f"❌ Error checking restrictions: {str(e)}")
-            logger.error(traceback.format_exc())
-            result_data['isSellable'] = None
-            result_data['restrictionReasons'] = []
+            logger.error(f"❌ Offers lookup for {asin} in {market} failed: {str(e)}")
+            unavailable.append({'market': market, 'error': f"Lookup failed: {str(e)}"})
+            continue
+        if offers_data['buyboxPrice'] is None:
+            unavailable.append({'market': market, 'error': "No offers"})
+            continue
+        prices.append({
+            'market': market,
+            'price': offers_data['buyboxPrice'],
+            'currency': offers_data['currencyCode'],
+            'moq': 1,
+            'offerCount': len(offers_data['offers']),
+        })
 
-        # 5. Offers
-        logger.info("💰 Step 5: Fetching offers and pricing...")
-        buybox_price = None
-        currency_code = None
-        try:
-            offers_response = products_api.get_item_offers(asin, "New", MarketplaceId=marketplace.marketplace_id)
-            offers = offers_response.payload.get('Offers', [])
-            
-            processed_offers = []
-            for o in offers:
-                # FBM teklifleri için kargo ücretini fiyata ekle
-                if not o.get('IsFulfilledByAmazon', False):
-                    listing_price = o.get('ListingPrice', {}).get('Amount', 0.0)
-                    shipping_price = o.get('Shipping', {}).get('Amount', 0.0)
-                    o['ListingPrice']['Amount'] = float(listing_price) + float(shipping_price)
-                processed_offers.append(o)
-
-            # Fiyatlarına göre sırala
-            processed_offers.sort(key=lambda x: x.get('ListingPrice', {}).get('Amount', float('inf')))
-            
-            result_data['offers'] = processed_offers
-            
-            # Buy Box kazananını bul
-            buybox_offer = next((o for o in processed_offers if o.get('IsBuyBoxWinner')), None)
-            
-            if buybox_offer:
-                buybox_price = float(buybox_offer['ListingPrice']['Amount'])
-                currency_code = buybox_offer['ListingPrice']['CurrencyCode']
-                logger.info(f"✅ Buybox Winner Found: {buybox_price} {currency_code}")
-            elif processed_offers:
-                # Buy Box yoksa, en düşük fiyatlı teklifi kullan
-                first_offer = processed_offers[0]
-                buybox_price = float(first_offer['ListingPrice']['Amount'])
-                currency_code = first_offer['ListingPrice']['CurrencyCode']
-                logger.info(f"✅ No Buybox Winner. Using lowest offer: {buybox_price} {currency_code}")
-            
-            result_data['buyboxPrice'] = buybox_price
-            result_data['currencyCode'] = currency_code
-            
-            logger.info(f"✅ Offers processed: {len(processed_offers)}")
+    logger.info(f"✅ Prices found in {len(prices)}/{len(markets)} marketplaces for {asin}")
+    return {'asin': asin, 'prices': prices, 'unavailable': unavailable}
 
-        except Exception as e:
-            logger.error(f"❌ Error fetching or processing offers: {str(e)}")
-            logger.error(traceback.format_exc())
-            result_data['offers'] = []
-            result_data['buyboxPrice'] = None
-            result_data['currencyCode'] = None
+# --- Fee Model Quotes ---
+FEE_LADDER_MAX_PRICES = int(os.environ.get('FEE_LADDER_MAX_PRICES', 500))
+FEE_LADDER_DEFAULT_STEPS = 20
+FEES_BATCH_MAX_ITEMS = int(os.environ.get('FEES_BATCH_MAX_ITEMS', 5000))
+# A ladder of one ASIN may spend more estimates pinning down tier boundaries than a batch item
+FEE_LADDER_MAX_PROBES = int(os.environ.get('FEE_LADDER_MAX_PROBES', 8))
+
+def fee_answer(price, fees, cost):
+    """Fees, net profit and (with a unit cost) ROI at one sale price"""
+    net_profit = round(price - fees['totalFees'] - (cost or 0.0), 2)
+    answer = {'price': price, **fees, 'netProfit': net_profit}
+    if cost:
+        answer['roi'] = round(net_profit / cost, 4)
+    return answer
+
+def get_fee_quotes(marketplace_str, items, executor, include_tiers=False, max_probes=FEE_MODEL_MAX_PROBES):
+    """
+    Answer fee and net-profit questions for (asin, price, cost) items from the learned fee
+    profiles, fetching only the estimates the profiles still need.
+
+    Estimates run on `executor` 20 per call, so a whole price ladder for one ASIN costs one to
+    a few calls, and a batch over thousands of ASINs about one call per 20 ASINs not seen before.
+    Each result carries the basis its fees were derived on (see fee_model.py).
+    """
+    credentials, _, error = get_credentials_for_marketplace(marketplace_str)
+    if error:
+        logger.error(f"❌ Credential error: {error}")
+        return {"error": error}
 
-        # 6. Fees
-        logger.info("🧮 Step 6: Calculating fees...")
-        if buybox_price and currency_code:
+    try:
+        marketplace = getattr(Marketplaces, marketplace_str.upper())
+    except AttributeError:
+        error_msg = f"Invalid marketplace: '{marketplace_str}'"
+        logger.error(error_msg)
+        return {"error": error_msg}
+
+    region = MARKETPLACE_REGIONS[marketplace_str.upper()]['region']
+    currency_code = MARKETPLACE_CURRENCIES[marketplace_str.upper()]
+
+    def estimate(probes):
+        futures = [submit_bound(executor, fetch_fees_batch, region, marketplace, credentials, [(asin, price, currency_code) for asin, price in chunk])
+                   for chunk in chunked(probes, SP_API_BATCH_SIZE)]
+        for future in futures:
             try:
-                fees_response = fees_api.get_product_fees_estimate([{'id_type': 'ASIN', 'id_value': asin, 'price': buybox_price, 'currency': currency_code, 'is_fba': True, 'marketplace_id': marketplace.marketplace_id}])
-                fees_result = fees_response.payload[0]
-                
-                if fees_result.get('Status') == 'Success':
-                    fees_estimate = fees_result.get('FeesEstimate', {})
-                    total_fees = fees_estimate.get('TotalFeesEstimate', {}).get('Amount', 0.0)
-                    fee_details = fees_estimate.get('FeeDetailList', [])
-                    result_data['totalFees'] = total_fees
-                    result_data['referralFee'] = next((f.get('FeeAmount', {}).get('Amount', 0.0) for f in fee_details if f.get('FeeType') == "ReferralFee"), 0.0)
-                    result_data['fbaFee'] = next((f.get('FeeAmount', {}).get('Amount', 0.0) for f in fee_details if f.get('FeeType') == "FBAFees"), 0.0)
-                    result_data['netProfit'] = buybox_price - total_fees
-                    logger.info(f"✅ Total Fees: {total_fees}, Net Profit: {result_data['netProfit']}")
-                else:
-                    logger.warning(f"⚠️ Fees calculation failed: {fees_result.get('Status')}")
-                    result_data.update({'totalFees': None, 'referralFee': None, 'fbaFee': None, 'netProfit': None})
+                future.result()
             except Exception as e:
-                logger.error(f"❌ Error calculating fees: {str(e)}")
+                logger.error(f"❌ Error in batch fees: {str(e)}")
                 logger.error(traceback.format_exc())
-                result_data.update({'totalFees': None, 'referralFee': None, 'fbaFee': None, 'netProfit': None})
+
+    prices_by_asin = {}
+    for asin, price, _ in items:
+        prices_by_asin.setdefault(asin, []).append(price)
+    profiles, estimates_made = fee_model.learn(marketplace.name, currency_code, prices_by_asin, estimate, max_probes)
+
+    results = []
+    for asin, price, cost in items:
+        fees = profiles[asin].quote(price)
+        if fees is None:
+            results.append({'asin': asin, 'price': price, 'error': "No fee estimate available for this ASIN"})
+            continue
+        results.append({'asin': asin, **fee_answer(price, fees, cost)})
+
+    unresolved = sum(1 for r in results if r.get('basis') == BASIS_UNRESOLVED)
+    logger.info(f"✅ Fee quotes: {len(results)} prices, {estimates_made} new estimates, {unresolved} unresolved")
+    data = {'marketplace': marketplace_str.upper(), 'currency': currency_code, 'count': len(results), 'newEstimates': estimates_made, 'results': results}
+    if include_tiers:
+        data['tiers'] = {asin: profile.tiers() for asin, profile in profiles.items()}
+    return data
+
+def parse_price_ladder(args):
+    """Prices from ?prices=a,b,c or ?min=&max=[&step=]; returns (prices, error_message)"""
+    try:
+        if args.get('prices'):
+            prices = [round(float(p), 2) for p in args['prices'].split(',') if p.strip()]
+        elif args.get('min') and args.get('max'):
+            low, high = float(args['min']), float(args['max'])
+            step = float(args['step']) if args.get('step') else ((high - low) / FEE_LADDER_DEFAULT_STEPS or 1.0)
+            if high < low or step <= 0:
+                return None, "max must not be below min, and step must be positive"
+            if (high - low) / step + 1 > FEE_LADDER_MAX_PRICES:
+                return None, f"Too many prices. Maximum per request: {FEE_LADDER_MAX_PRICES}"
+            count = int(round((high - low) / step, 6)) + 1
+            prices = [round(low + i * step, 2) for i in range(count)]
         else:
-            logger.info("ℹ️ No price available for fee calculation, skipping.")
-            result_data.update({'totalFees': None, 'referralFee': None, 'fbaFee': None, 'netProfit': None})
+            return None, "Give either prices=a,b,c or min= and max= (optionally step=)"
+    except ValueError:
+        return None, "Prices must be numbers"
 
-        logger.info("✅ Product details fetched successfully")
-        return result_data
+    prices = list(dict.fromkeys(prices))
+    if not prices or any(p <= 0 for p in prices):
+        return None, "Prices must be positive"
+    if len(prices) > FEE_LADDER_MAX_PRICES:
+        return None, f"Too many prices: {len(prices)}. Maximum per request: {FEE_LADDER_MAX_PRICES}"
+    return prices, None
 
-    except SellingApiException as e:
-        error_message = str(e.payload or e)
-        logger.error(f"❌ Amazon SP API Error: {error_message}")
-        logger.error(f"Full exception: {e}")
-        return {"error": f"API Error: {error_message}"}
-    except Exception as e:
-        logger.error(f"❌ Unexpected error: {str(e)}")
-        logger.error(traceback.format_exc())
-        return {"error": f"An unexpected server error occurred: {str(e)}"}
+def parse_fee_items(items):
+    """Validate the 'items' list of a fee batch body; returns ([(asin, price, cost)], error_message)"""
+    if not isinstance(items, list) or not items:
+        return None, "Request body must contain a non-empty 'items' list of {asin, price, cost?} objects"
+    if len(items) > FEES_BATCH_MAX_ITEMS:
+        return None, f"Too many items: {len(items)}. Maximum per request: {FEES_BATCH_MAX_ITEMS}"
+
+    parsed = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('asin'), str) or not item['asin'].strip():
+            return None, "Every item needs an 'asin' string"
+        price, cost = item.get('price'), item.get('cost')
+        if isinstance(price, bool) or not isinstance(price, (int, float)) or price <= 0:
+            return None, f"Item {item['asin']}: 'price' must be a positive number"
+        if cost is not None and (isinstance(cost, bool) or not isinstance(cost, (int, float)) or cost < 0):
+            return None, f"Item {item['asin']}: 'cost' must be a non-negative number"
+        parsed.append((item['asin'].strip().upper(), round(float(price), 2), cost))
+    return parsed, None
+
+# --- Prefetch ---
+def prefetch_is_warm(asin, marketplace_str):
+    """True if every step of a product lookup would be answered from the cache"""
+    key = (asin, marketplace_str)
+    if response_cache.peek('catalog', key) is None or response_cache.peek('restrictions', key) is None:
+        return False
+    offers_data = response_cache.peek('offers', key)
+    if offers_data is None:
+        return False
+    price, currency_code = offers_data['buyboxPrice'], offers_data['currencyCode']
+    if not (price and currency_code):
+        return True
+    marketplace = getattr(Marketplaces, marketplace_str)
+    return response_cache.peek('fees', fees_cache_key(asin, marketplace, price, currency_code)) is not None or fee_model.quote(asin, marketplace.name, currency_code, price) is not None
+
+def prefetch_product(asin, marketplace_str):
+    """
+    Warm the cache for one product lookup, on a prefetch worker thread. Steps run one after
+    another and bypass single-flight loading, so an interactive request for the same ASIN
+    never waits on a load queued in the prefetch lane; at worst both fetch it.
+    """
+    credentials, seller_id, error = get_credentials_for_marketplace(marketplace_str)
+    if error:
+        raise ValueError(error)
+    marketplace = getattr(Marketplaces, marketplace_str)
+    region = MARKETPLACE_REGIONS[marketplace_str]['region']
+    key = (asin, marketplace.name)
+
+    timer = RequestTimer(marketplace.name, log_details=sample_details())
+    bind_timer(timer)
+    try:
+        with timer.step('prefetch'):
+            if response_cache.peek('catalog', key) is None:
+                response_cache.set('catalog', key, load_catalog_data(region, marketplace, credentials, asin))
+            if response_cache.peek('restrictions', key) is None:
+                response_cache.set('restrictions', key, load_restrictions_data(region, marketplace, credentials, asin, seller_id))
+            offers_data = response_cache.peek('offers', key)
+            if offers_data is None:
+                offers_data = load_offers_data(region, marketplace, credentials, asin)
+                response_cache.set('offers', key, offers_data)
+
+            price, currency_code = offers_data['buyboxPrice'], offers_data['currencyCode']
+            if price and currency_code:
+                fees_key = fees_cache_key(asin, marketplace, price, currency_code)
+                if response_cache.peek('fees', fees_key) is None:
+                    fees_data = quote_fees_data(asin, marketplace, price, currency_code) or load_fees_data(region, marketplace, credentials, asin, price, currency_code)
+                    if fees_data is not None:
+                        response_cache.set('fees', fees_key, fees_data)
+        logger.info(f"✅ Prefetched {asin} ({marketplace_str}) in {timer.breakdown()['totalMs']} ms")
+    finally:
+        bind_timer(None)
+
+# ASINs the extension expects the user to open soon (search results, the sidepanel's bulk
+# list, related products) are fetched in the background, so the product page opens warm
+prefetch_queue = PrefetchQueue(prefetch_is_warm, prefetch_product, PREFETCH_WORKERS, PREFETCH_QUEUE_MAX, PREFETCH_BUDGET_PER_MINUTE, PREFETCH_BUDGET_BURST, shared=shared_state)
+prefetch_queue.start()
+
+# --- Request Metrics and Logging ---
+# Metrics label for a marketplace the backend does not serve; the raw value would let any
+# caller create new histogram series
+INVALID_MARKETPLACE_LABEL = 'invalid'
+
+def request_marketplace():
+    """Marketplace of the current request, from the query string or JSON body, as a metrics label"""
+    body = request.get_json(silent=True) if request.is_json else None
+    marketplace = request.args.get('marketplace') or (body.get('marketplace') if isinstance(body, dict) else None)
+    if not marketplace:
+        # Every single-marketplace endpoint defaults to US; price comparison spans several
+        return '' if request.endpoint == 'api_compare_prices' else 'US'
+    marketplace = str(marketplace).upper()
+    return marketplace if marketplace in MARKETPLACE_REGIONS else INVALID_MARKETPLACE_LABEL
+
+@app.before_request
+def start_request_timer():
+    # The timer travels with the request's work onto worker threads, carrying the
+    # detail-log sampling decision along with the step timings
+    g.request_timer = RequestTimer(request_marketplace(), log_details=sample_details())
+    bind_timer(g.request_timer)
+
+@app.after_request
+def record_request(response):
+    # Streaming responses are recorded when their headers go out, i.e. time to first byte
+    timer = g.get('request_timer')
+    if timer is not None and request.endpoint not in (None, 'metrics'):
+        breakdown = timer.breakdown()
+        outcome = OUTCOME_PARTIAL if g.get('partial_response') else request_outcome(response.status_code)
+        request_latency.observe(breakdown['totalMs'] / 1000, endpoint=request.endpoint, marketplace=timer.marketplace, outcome=outcome)
+        log_request_summary({
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'asin': (request.view_args or {}).get('asin'),
+            'marketplace': timer.marketplace,
+            'status': response.status_code,
+            'outcome': outcome,
+            'ms': breakdown['totalMs'],
+            'steps': breakdown['stepsMs'],
+            'unfinished': breakdown['unfinishedMs'],
+            'spApiCalls': len(breakdown['spApiCalls']),
+            'throttled': sum(1 for call in breakdown['spApiCalls'] if call['outcome'] == 'throttled'),
+        })
+    return response
+
+@app.teardown_request
+def release_request_timer(exc):
+    bind_timer(None)
 
 # --- API Endpoints ---
 @app.route('/')
@@ -379,8 +1175,17 @@ def health_check():
         "timestamp": datetime.now().isoformat(),
         "credentials_loaded": bool(na_credentials),
         "eu_credentials_loaded": bool(eu_credentials),
-        "bsr_tables_loaded": bool(BSR_TABLES.get('US')) and bool(BSR_TABLES.get('CA')),
-        "supported_marketplaces": list(MARKETPLACE_REGIONS.keys())
+        "bsr_tables_loaded": bool(bsr_store.tables.get('US')) and bool(bsr_store.tables.get('CA')),
+        "bsr_tables": bsr_store.stats(),
+        "supported_marketplaces": list(MARKETPLACE_REGIONS.keys()),
+        "sp_api_clients": sp_client_registry.stats(),
+        "cache": response_cache.stats(),
+        "rate_limits": rate_scheduler.stats(),
+        "stream_jobs": stream_jobs.stats(),
+        "prefetch": prefetch_queue.stats(),
+        "snapshot_store": snapshot_store.stats() if snapshot_store else None,
+        "shared_state": shared_state.stats() if shared_state else None,
+        "log_records_dropped": log_queue_handler.dropped
     })
 
 @app.route('/get_product_details/<string:asin>', methods=['GET'])
@@ -392,23 +1197,62 @@ def api_get_product_details(asin):
         return jsonify({"error": "Server is not configured correctly. Please check logs."}), 503
 
     marketplace = request.args.get('marketplace', 'US')
+    # BSR and category as shown on the product page, used to compute the percentile bucket
+    bsr = request.args.get('bsr', type=int)
+    category = request.args.get('category')
+    # ?debug=1 adds a per-step timing breakdown to the response
+    debug = request.args.get('debug', '').lower() in ('1', 'true', 'yes')
+    # ?fields=isSellable or ?include=pricing,fees returns only those fields and skips unneeded SP-API calls
+    fields_param = request.args.get('fields') or request.args.get('include')
+    top_n = request.args.get('top', OFFER_SUMMARY_TOP_N, type=int)
+    # ?deadline=<ms> overrides REQUEST_DEADLINE_MS; fields not ready by then come back in 'pending'
+    deadline_param = request.args.get('deadline')
     logger.info(f"Marketplace: {marketplace}")
     
     # Validate marketplace
     if marketplace.upper() not in MARKETPLACE_REGIONS:
         supported = ', '.join(MARKETPLACE_REGIONS.keys())
         return jsonify({"error": f"Unsupported marketplace: {marketplace}. Supported: {supported}"}), 400
+    if top_n < 1:
+        return jsonify({"error": "top must be at least 1"}), 400
+    budget, error = parse_deadline(deadline_param)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Counts prefetch hits, and takes a still-queued prefetch of this ASIN off the queue
+    prefetch_queue.record_lookup((asin.strip().upper(), marketplace.upper()))
+
+    fields, steps = None, PIPELINE_STEPS
+    if fields_param:
+        fields, steps, error = parse_fields(fields_param)
+        if error:
+            return jsonify({"error": error}), 400
     
     try:
-        data = get_full_product_details_as_json(asin, marketplace)
+        timer = g.request_timer
+        data = get_full_product_details_as_json(asin, marketplace, timer=timer, steps=steps, budget=budget)
         
         if "error" in data:
             logger.error(f"API returning error: {data['error']}")
             return jsonify(data), 500
         
-        # Add BSR data if available for the marketplace
-        bsr_data = BSR_TABLES.get(marketplace.upper(), {})
-        data['bsr_data'] = bsr_data
+        pending = data.pop('pending', [])
+        data['bsrPercentile'] = bsr_store.index.lookup(marketplace, bsr, category)
+        # Only fields this response would have carried; the steps list everything they produce
+        pending = [f for f in pending if f in (fields or DEFAULT_FIELDS)]
+        if fields:
+            if 'offerSummary' in fields and 'offers' in data:
+                data['offerSummary'] = summarize_offers(data['offers'], top_n)
+            # Pending fields are listed in 'pending' only, not as nulls in the body
+            data = {'asin': data['asin'], **{f: data.get(f) for f in fields if f not in pending}}
+        if pending:
+            # The late calls keep running and fill the cache; asking again with
+            # fields=<pending> returns them without repeating the rest of the lookup
+            data['pending'] = pending
+            data['retryAfterMs'] = PENDING_RETRY_AFTER_MS
+            g.partial_response = True
+        if debug:
+            data['timings'] = timer.breakdown()
         logger.info(f"✅ API request completed successfully for ASIN: {asin}")
         return jsonify(data)
         
@@ -417,6 +1261,279 @@ def api_get_product_details(asin):
         logger.error(traceback.format_exc())
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
+def parse_asin_list(body, max_asins):
+    """Validate the 'asins' list of a JSON body; returns (asins, error_message)"""
+    asins = body.get('asins')
+    if not isinstance(asins, list) or not asins or not all(isinstance(a, str) and a.strip() for a in asins):
+        return None, "Request body must contain a non-empty 'asins' list of strings"
+
+    # Normalize and de-duplicate while keeping the caller's order
+    asins = list(dict.fromkeys(a.strip().upper() for a in asins))
+    if len(asins) > max_asins:
+        return None, f"Too many ASINs: {len(asins)}. Maximum per request: {max_asins}"
+    return asins, None
+
+@app.route('/get_product_details_batch', methods=['POST'])
+def api_get_product_details_batch():
+    body = request.get_json(silent=True) or {}
+    marketplace = body.get('marketplace') or request.args.get('marketplace', 'US')
+    logger.info(f"Batch API request received for {len(body.get('asins') or [])} ASINs, Marketplace: {marketplace}")
+
+    if not na_credentials and not eu_credentials:
+        logger.error("Server not configured - missing credentials")
+        return jsonify({"error": "Server is not configured correctly. Please check logs."}), 503
+
+    if marketplace.upper() not in MARKETPLACE_REGIONS:
+        supported = ', '.join(MARKETPLACE_REGIONS.keys())
+        return jsonify({"error": f"Unsupported marketplace: {marketplace}. Supported: {supported}"}), 400
+
+    asins, error = parse_asin_list(body, BATCH_MAX_ASINS)
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        data = get_product_details_batch(asins, marketplace)
+
+        if "error" in data:
+            logger.error(f"Batch API returning error: {data['error']}")
+            return jsonify(data), 500
+
+        return jsonify(data)
+
+    except Exception as e:
+        logger.error(f"❌ Unexpected error in batch API endpoint: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/bulk_check/stream', methods=['POST'])
+def api_bulk_check_stream():
+    body = request.get_json(silent=True) or {}
+    marketplace = body.get('marketplace') or request.args.get('marketplace', 'US')
+    logger.info(f"Stream API request received for {len(body.get('asins') or [])} ASINs, Marketplace: {marketplace}")
+
+    if not na_credentials and not eu_credentials:
+        logger.error("Server not configured - missing credentials")
+        return jsonify({"error": "Server is not configured correctly. Please check logs."}), 503
+
+    if marketplace.upper() not in MARKETPLACE_REGIONS:
+        supported = ', '.join(MARKETPLACE_REGIONS.keys())
+        return jsonify({"error": f"Unsupported marketplace: {marketplace}. Supported: {supported}"}), 400
+
+    asins, error = parse_asin_list(body, STREAM_MAX_ASINS)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Server-sent events when asked for, newline-delimited JSON otherwise
+    use_sse = body.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    formatter = format_sse if use_sse else format_ndjson
+
+    # Chunks run on the stream pool, after this view has returned; they log under this request
+    timer = g.request_timer
+
+    def process_chunk(chunk):
+        data = timer.call(get_product_details_batch, chunk, marketplace)
+        if "error" in data:
+            return [{'asin': asin, 'error': data['error']} for asin in chunk]
+        return data['results']
+
+    job = stream_jobs.create(len(asins))
+
+    def generate():
+        for record in run_stream_job(job, asins, process_chunk):
+            yield formatter(record)
+
+    return Response(generate(), mimetype='text/event-stream' if use_sse else 'application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Job-Id': job.id,
+    })
+
+@app.route('/bulk_check/<string:job_id>/cancel', methods=['POST'])
+def api_bulk_check_cancel(job_id):
+    if not stream_jobs.cancel(job_id):
+        return jsonify({"error": f"Unknown or finished job: {job_id}"}), 404
+    logger.info(f"Stream job {job_id} cancellation requested")
+    return jsonify({"jobId": job_id, "cancelled": True})
+
+@app.route('/prefetch', methods=['POST'])
+def api_prefetch():
+    body = request.get_json(silent=True) or {}
+    marketplace = (body.get('marketplace') or request.args.get('marketplace', 'US')).upper()
+    logger.info(f"Prefetch request received for {len(body.get('asins') or [])} ASINs, Marketplace: {marketplace}")
+
+    if not na_credentials and not eu_credentials:
+        logger.error("Server not configured - missing credentials")
+        return jsonify({"error": "Server is not configured correctly. Please check logs."}), 503
+
+    if marketplace not in MARKETPLACE_REGIONS:
+        supported = ', '.join(MARKETPLACE_REGIONS.keys())
+        return jsonify({"error": f"Unsupported marketplace: {marketplace}. Supported: {supported}"}), 400
+
+    _, _, error = get_credentials_for_marketplace(marketplace)
+    if error:
+        return jsonify({"error": error}), 400
+
+    asins, error = parse_asin_list(body, PREFETCH_MAX_ASINS)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Accepted, not done: the workers warm the cache within their budget
+    queued = prefetch_queue.submit([(asin, marketplace) for asin in asins])
+    return jsonify({"marketplace": marketplace, "received": len(asins), "queued": queued, "queueLength": prefetch_queue.stats()['queued']}), 202
+
+@app.route('/compare_prices/<string:asin>', methods=['GET'])
+def api_compare_prices(asin):
+    markets = request.args.get('marketplaces')
+    markets = [m.strip().upper() for m in markets.split(',') if m.strip()] if markets else COMPARE_DEFAULT_MARKETPLACES
+    markets = list(dict.fromkeys(markets))
+    logger.info(f"Price comparison request received for ASIN: {asin}, Marketplaces: {', '.join(markets)}")
+
+    if not na_credentials and not eu_credentials:
+        logger.error("Server not configured - missing credentials")
+        return jsonify({"error": "Server is not configured correctly. Please check logs."}), 503
+
+    unsupported = [m for m in markets if resolve_marketplace_code(m) not in MARKETPLACE_REGIONS]
+    if unsupported:
+        supported = ', '.join(MARKETPLACE_REGIONS.keys())
+        return jsonify({"error": f"Unsupported marketplace: {', '.join(unsupported)}. Supported: {supported}"}), 400
+
+    try:
+        return jsonify(compare_marketplace_prices(asin.strip().upper(), markets))
+
+    except Exception as e:
+        logger.error(f"❌ Unexpected error in price comparison endpoint: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/fees/<string:asin>', methods=['GET'])
+def api_fee_ladder(asin):
+    marketplace = request.args.get('marketplace', 'US')
+    cost = request.args.get('cost', type=float)
+    asin = asin.strip().upper()
+    logger.info(f"Fee ladder request received for ASIN: {asin}, Marketplace: {marketplace}")
+
+    if not na_credentials and not eu_credentials:
+        logger.error("Server not configured - missing credentials")
+        return jsonify({"error": "Server is not configured correctly. Please check logs."}), 503
+
+    if marketplace.upper() not in MARKETPLACE_REGIONS:
+        supported = ', '.join(MARKETPLACE_REGIONS.keys())
+        return jsonify({"error": f"Unsupported marketplace: {marketplace}. Supported: {supported}"}), 400
+
+    prices, error = parse_price_ladder(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        data = get_fee_quotes(marketplace, [(asin, price, cost) for price in prices], sp_api_executor, include_tiers=True, max_probes=FEE_LADDER_MAX_PROBES)
+
+        if "error" in data:
+            logger.error(f"Fee ladder API returning error: {data['error']}")
+            return jsonify(data), 500
+
+        return jsonify({
+            'asin': asin,
+            'marketplace': data['marketplace'],
+            'currency': data['currency'],
+            'newEstimates': data['newEstimates'],
+            'tiers': data['tiers'][asin],
+            'ladder': [{k: v for k, v in result.items() if k != 'asin'} for result in data['results']],
+        })
+
+    except Exception as e:
+        logger.error(f"❌ Unexpected error in fee ladder endpoint: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/fees/batch', methods=['POST'])
+def api_fees_batch():
+    body = request.get_json(silent=True) or {}
+    marketplace = body.get('marketplace') or request.args.get('marketplace', 'US')
+    logger.info(f"Fee batch request received for {len(body.get('items') or [])} items, Marketplace: {marketplace}")
+
+    if not na_credentials and not eu_credentials:
+        logger.error("Server not configured - missing credentials")
+        return jsonify({"error": "Server is not configured correctly. Please check logs."}), 503
+
+    if marketplace.upper() not in MARKETPLACE_REGIONS:
+        supported = ', '.join(MARKETPLACE_REGIONS.keys())
+        return jsonify({"error": f"Unsupported marketplace: {marketplace}. Supported: {supported}"}), 400
+
+    items, error = parse_fee_items(body.get('items'))
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        # Estimates for a large batch go through the bulk pool and rate-limit lane
+        data = get_fee_quotes(marketplace, items, bulk_executor)
+
+        if "error" in data:
+            logger.error(f"Fee batch API returning error: {data['error']}")
+            return jsonify(data), 500
+
+        return jsonify(data)
+
+    except Exception as e:
+        logger.error(f"❌ Unexpected error in fee batch endpoint: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/price_history/<string:asin>', methods=['GET'])
+def api_price_history(asin):
+    marketplace = request.args.get('marketplace', 'US').upper()
+    days = request.args.get('days', 30, type=int)
+
+    if snapshot_store is None:
+        return jsonify({"error": "Product snapshot store is not enabled"}), 503
+    if marketplace not in MARKETPLACE_REGIONS:
+        supported = ', '.join(MARKETPLACE_REGIONS.keys())
+        return jsonify({"error": f"Unsupported marketplace: {marketplace}. Supported: {supported}"}), 400
+    if not 0 < days <= PRICE_HISTORY_MAX_DAYS:
+        return jsonify({"error": f"days must be between 1 and {PRICE_HISTORY_MAX_DAYS}"}), 400
+
+    try:
+        # Snapshots are stored under the Marketplaces enum name, which equals the country code
+        history = snapshot_store.price_history(asin.strip().upper(), marketplace, time.time() - days * 86400)
+        return jsonify({"asin": asin.strip().upper(), "marketplace": marketplace, "days": days, "history": history})
+
+    except Exception as e:
+        logger.error(f"❌ Unexpected error in price history endpoint: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/bsr_percentile', methods=['POST'])
+def api_bsr_percentile():
+    body = request.get_json(silent=True) or {}
+    marketplace = body.get('marketplace') or request.args.get('marketplace', 'US')
+    items = body.get('items')
+
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({"error": "Request body must contain an 'items' list of {bsr, category} objects"}), 400
+    if len(items) > BSR_LOOKUP_MAX_ITEMS:
+        return jsonify({"error": f"Too many items: {len(items)}. Maximum per request: {BSR_LOOKUP_MAX_ITEMS}"}), 400
+    index = bsr_store.index
+    if not index.has_marketplace(marketplace):
+        return jsonify({"error": f"No BSR data for marketplace: {marketplace}"}), 404
+
+    pairs = []
+    for item in items:
+        try:
+            bsr = int(item.get('bsr'))
+        except (TypeError, ValueError):
+            bsr = None
+        pairs.append((bsr, item.get('category')))
+
+    percentiles = index.lookup_many(marketplace, pairs)
+    return jsonify({
+        "marketplace": marketplace.upper(),
+        "results": [{"bsr": bsr, "category": category, "percentile": percentile} for (bsr, category), percentile in zip(pairs, percentiles)]
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latency histograms in the Prometheus text exposition format"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 # --- Error Handlers ---
 @app.errorhandler(Exception)
 def handle_exception(e):
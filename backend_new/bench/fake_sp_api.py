@@ -0,0 +1,303 @@
+"""
+Local stand-in for the SP-API and LWA endpoints the backend calls, for offline benchmarks.
+
+Serves getCatalogItem, searchCatalogItems, getListingsRestrictions, getItemOffers,
+getItemOffersBatch and getMyFeesEstimates with configurable latency, 429 rate and payload
+size, plus the BSR table page from fixtures/bsr_table.html. Point the backend at it with
+SP_API_ENDPOINT, SP_API_LWA_URL and BSR_TABLE_URL (bench/run.py does this for you).
+
+    python -m bench.fake_sp_api --port 8765 --latency-ms 150 --throttle-rate 0.05
+"""
+import os
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BSR_FIXTURE_PATH = os.path.join(FIXTURES_DIR, 'bsr_table.html')
+
+@dataclass
+class FakeSpApiConfig:
+    latency_ms: float = 150.0
+    jitter_ms: float = 50.0
+    # Share of SP-API calls answered with 429 QuotaExceeded
+    throttle_rate: float = 0.0
+    # Share of SP-API calls that hang for tail_ms on top of the normal latency
+    tail_rate: float = 0.0
+    tail_ms: float = 5000.0
+    # Share of ASINs answered with an item-level error inside getItemOffersBatch (see batch_item_fails)
+    batch_error_rate: float = 0.0
+    # Offers returned per ASIN and filler bytes added to catalog attributes
+    offers: int = 10
+    attribute_padding: int = 2000
+    # Send x-amzn-RateLimit-Limit so the backend's rate limiter adapts to this value
+    rate_limit_header: float = 0.0
+
+class FakeSpApiStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.throttled = {}
+
+    def record(self, operation, throttled):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if throttled:
+                self.throttled[operation] = self.throttled.get(operation, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'throttled': dict(self.throttled)}
+
+# --- Payloads ---
+def catalog_item(asin, config):
+    rng = random.Random(asin)
+    return {
+        'asin': asin,
+        'summaries': [{'marketplaceId': 'ATVPDKIKX0DER', 'itemName': f"Benchmark Product {asin}", 'brandName': 'Acme', 'brand': 'Acme'}],
+        'identifiers': [{'marketplaceId': 'ATVPDKIKX0DER', 'identifiers': [{'identifierType': 'EAN', 'identifier': str(rng.randint(10**12, 10**13 - 1))}]}],
+        'images': [{'marketplaceId': 'ATVPDKIKX0DER', 'images': [{'variant': 'MAIN', 'link': f"https://m.media-amazon.com/images/I/{asin}.jpg", 'height': 500, 'width': 500}]}],
+        'attributes': {
+            'item_package_dimensions': [{
+                'length': {'value': round(rng.uniform(2, 20), 2), 'unit': 'inches'},
+                'width': {'value': round(rng.uniform(2, 20), 2), 'unit': 'inches'},
+                'height': {'value': round(rng.uniform(1, 10), 2), 'unit': 'inches'},
+            }],
+            'item_package_weight': [{'value': round(rng.uniform(0.1, 10), 2), 'unit': 'pounds'}],
+            # Real catalog attributes carry dozens of unused fields; this stands in for them
+            'bullet_point': [{'value': 'x' * config.attribute_padding}],
+        },
+    }
+
+def item_offers(asin, config, currency='USD'):
+    rng = random.Random(asin)
+    base_price = rng.uniform(10, 80)
+    buybox = rng.randrange(config.offers) if config.offers else None
+    offers = []
+    for i in range(config.offers):
+        is_fba = rng.random() < 0.6
+        offers.append({
+            'SellerId': f"A{rng.randint(10**12, 10**13 - 1)}",
+            'SubCondition': 'new',
+            'IsFulfilledByAmazon': is_fba,
+            'IsBuyBoxWinner': i == buybox,
+            'ListingPrice': {'Amount': round(base_price * rng.uniform(0.95, 1.3), 2), 'CurrencyCode': currency},
+            'Shipping': {'Amount': 0.0 if is_fba else round(rng.uniform(0, 6), 2), 'CurrencyCode': currency},
+            'SellerFeedbackRating': {'SellerPositiveFeedbackRating': rng.randint(80, 100), 'FeedbackCount': rng.randint(0, 50000)},
+            'ShippingTime': {'minimumHours': 24, 'maximumHours': 48, 'availabilityType': 'NOW'},
+            'IsFeaturedMerchant': True,
+        })
+    return {'ASIN': asin, 'status': 'Success', 'ItemCondition': 'New', 'Summary': {'TotalOfferCount': len(offers)}, 'Offers': offers}
+
+def batch_item_fails(asin, config):
+    """Whether getItemOffersBatch answers this ASIN with an error; fixed per ASIN so the bench can check results"""
+    return random.Random(asin).random() < config.batch_error_rate
+
+def restrictions(asin):
+    # Roughly one in four ASINs needs approval
+    if random.Random(asin).random() < 0.25:
+        return {'restrictions': [{'marketplaceId': 'ATVPDKIKX0DER', 'conditionType': 'new_new', 'reasons': [{'message': 'You need approval to list in this brand.', 'reasonCode': 'APPROVAL_REQUIRED'}]}]}
+    return {'restrictions': []}
+
+def fees_estimate(estimate_request):
+    request_body = estimate_request.get('FeesEstimateRequest', {})
+    price = float(request_body.get('PriceToEstimateFees', {}).get('ListingPrice', {}).get('Amount', 0.0))
+    currency = request_body.get('PriceToEstimateFees', {}).get('ListingPrice', {}).get('CurrencyCode', 'USD')
+    # Shaped like a real schedule: a lower referral rate up to $15 and a low-price FBA band under $10
+    referral_fee = max(round(price * (0.08 if price <= 15 else 0.15), 2), 0.30)
+    fba_fee = round((2.45 if price < 10 else 3.22) + random.Random(estimate_request.get('IdValue')).uniform(0, 4), 2)
+    return {
+        'Status': 'Success',
+        'FeesEstimateIdentifier': {
+            'MarketplaceId': request_body.get('MarketplaceId'),
+            'IdType': estimate_request.get('IdType', 'ASIN'),
+            'IdValue': estimate_request.get('IdValue'),
+            'SellerInputIdentifier': request_body.get('Identifier'),
+            'IsAmazonFulfilled': request_body.get('IsAmazonFulfilled'),
+        },
+        'FeesEstimate': {
+            'TotalFeesEstimate': {'Amount': round(referral_fee + fba_fee, 2), 'CurrencyCode': currency},
+            'FeeDetailList': [
+                {'FeeType': 'ReferralFee', 'FeeAmount': {'Amount': referral_fee, 'CurrencyCode': currency}},
+                {'FeeType': 'FBAFees', 'FeeAmount': {'Amount': fba_fee, 'CurrencyCode': currency}},
+            ],
+        },
+    }
+
+# --- HTTP Handler ---
+class FakeSpApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = FakeSpApiConfig()
+    stats = FakeSpApiStats()
+
+    ROUTES = [
+        ('POST', re.compile(r'^/auth/o2/token$'), 'token', None),
+        ('GET', re.compile(r'^/catalog/2020-12-01/items/(?P<asin>[^/]+)$'), 'getCatalogItem', 'catalog_item'),
+        ('GET', re.compile(r'^/catalog/2022-04-01/items$'), 'searchCatalogItems', 'search_catalog'),
+        ('GET', re.compile(r'^/listings/2021-08-01/restrictions$'), 'getListingsRestrictions', 'restrictions'),
+        ('GET', re.compile(r'^/products/pricing/v0/items/(?P<asin>[^/]+)/offers$'), 'getItemOffers', 'item_offers'),
+        ('POST', re.compile(r'^/batches/products/pricing/v0/itemOffers$'), 'getItemOffersBatch', 'item_offers_batch'),
+        ('POST', re.compile(r'^/products/fees/v0/feesEstimate$'), 'getMyFeesEstimates', 'fees_estimates'),
+        ('GET', re.compile(r'^/sas/bsr-tables$'), 'bsrTables', None),
+        ('GET', re.compile(r'^/_stats$'), 'stats', None),
+        ('POST', re.compile(r'^/_reset$'), 'reset', None),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._read_body()
+        for route_method, pattern, operation, handler_name in self.ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self._send_json(404, {'errors': [{'code': 'NotFound', 'message': f"No fake for {method} {url.path}"}]})
+
+        if operation == 'token':
+            return self._send_json(200, {'access_token': 'Atza|benchmark-token', 'refresh_token': 'Atzr|benchmark', 'token_type': 'bearer', 'expires_in': 3600})
+        if operation == 'stats':
+            return self._send_json(200, {'config': asdict(self.config), **self.stats.snapshot()})
+        if operation == 'reset':
+            self.stats.reset()
+            return self._send_json(200, {'reset': True})
+        if operation == 'bsrTables':
+            with open(BSR_FIXTURE_PATH, 'rb') as f:
+                return self._send(200, f.read(), 'text/html; charset=utf-8')
+
+        config = self.config
+        delay_ms = max(0.0, random.gauss(config.latency_ms, config.jitter_ms))
+        if random.random() < config.tail_rate:
+            delay_ms += config.tail_ms
+        time.sleep(delay_ms / 1000)
+        throttled = random.random() < config.throttle_rate
+        self.stats.record(operation, throttled)
+        if throttled:
+            return self._send_json(429, {'errors': [{'code': 'QuotaExceeded', 'message': 'You exceeded your quota for the requested resource.'}]})
+        self._send_json(200, getattr(self, handler_name)(match, query, body))
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        body = self.rfile.read(length)
+        # The LWA token request is form-encoded, SP-API bodies are JSON
+        if 'json' not in (self.headers.get('Content-Type') or ''):
+            return body
+        return json.loads(body)
+
+    def _send(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        if self.config.rate_limit_header:
+            self.send_header('x-amzn-RateLimit-Limit', str(self.config.rate_limit_header))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data).encode('utf-8'), 'application/json')
+
+    # --- Operations ---
+    def catalog_item(self, match, query, body):
+        return catalog_item(match.group('asin'), self.config)
+
+    def search_catalog(self, match, query, body):
+        asins = [a for a in query.get('identifiers', '').split(',') if a]
+        return {'numberOfResults': len(asins), 'items': [catalog_item(asin, self.config) for asin in asins]}
+
+    def restrictions(self, match, query, body):
+        return restrictions(query.get('asin'))
+
+    def item_offers(self, match, query, body):
+        return {'payload': item_offers(match.group('asin'), self.config)}
+
+    def item_offers_batch(self, match, query, body):
+        responses = []
+        for item_request in (body or {}).get('requests', []):
+            asin = item_request['uri'].rstrip('/').split('/')[-2]
+            echoed_request = {'MarketplaceId': item_request.get('MarketplaceId'), 'ItemCondition': item_request.get('ItemCondition'), 'Asin': asin}
+            if batch_item_fails(asin, self.config):
+                # Like SP-API for an invalid or restricted ASIN: no payload, the ASIN only in the echoed request
+                responses.append({
+                    'status': {'statusCode': 400, 'reasonPhrase': 'Bad Request'},
+                    'body': {'errors': [{'code': 'InvalidInput', 'message': f"Invalid ASIN {asin}"}]},
+                    'request': echoed_request,
+                })
+                continue
+            responses.append({
+                'status': {'statusCode': 200, 'reasonPhrase': 'OK'},
+                'body': {'payload': item_offers(asin, self.config)},
+                'request': echoed_request,
+            })
+        return {'responses': responses}
+
+    def fees_estimates(self, match, query, body):
+        return [fees_estimate(estimate_request) for estimate_request in (body or [])]
+
+def make_server(config, host='127.0.0.1', port=0):
+    """Create the fake server; port 0 picks a free port (see server.server_address)"""
+    handler = type('ConfiguredFakeSpApiHandler', (FakeSpApiHandler,), {'config': config, 'stats': FakeSpApiStats()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def serve(config, host='127.0.0.1', port=8765):
+    server = make_server(config, host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def parse_config_args(parser):
+    defaults = FakeSpApiConfig()
+    parser.add_argument('--latency-ms', type=float, default=defaults.latency_ms, help='mean SP-API latency')
+    parser.add_argument('--jitter-ms', type=float, default=defaults.jitter_ms, help='latency standard deviation')
+    parser.add_argument('--throttle-rate', type=float, default=defaults.throttle_rate, help='share of calls answered with 429')
+    parser.add_argument('--tail-rate', type=float, default=defaults.tail_rate, help='share of calls that hang for --tail-ms')
+    parser.add_argument('--tail-ms', type=float, default=defaults.tail_ms, help='extra latency of the slow tail')
+    parser.add_argument('--batch-error-rate', type=float, default=defaults.batch_error_rate, help='share of ASINs failing inside getItemOffersBatch')
+    parser.add_argument('--offers', type=int, default=defaults.offers, help='offers per ASIN')
+    parser.add_argument('--attribute-padding', type=int, default=defaults.attribute_padding, help='filler bytes per catalog item')
+    parser.add_argument('--rate-limit-header', type=float, default=defaults.rate_limit_header, help='x-amzn-RateLimit-Limit to send (0 = none)')
+
+def config_from_args(args):
+    return FakeSpApiConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        throttle_rate=args.throttle_rate,
+        tail_rate=args.tail_rate,
+        tail_ms=args.tail_ms,
+        batch_error_rate=args.batch_error_rate,
+        offers=args.offers,
+        attribute_padding=args.attribute_padding,
+        rate_limit_header=args.rate_limit_header,
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parse_config_args(parser)
+    args = parser.parse_args()
+    print(f"Fake SP-API listening on http://{args.host}:{args.port}")
+    serve(config_from_args(args), args.host, args.port)
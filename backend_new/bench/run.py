@@ -0,0 +1,344 @@
+"""
+Offline benchmark scenarios for the backend, run against the local fake SP-API.
+
+Starts bench/fake_sp_api.py in a separate process, points the backend at it and drives
+the Flask app in-process (or a running server with --base-url) with concurrent clients.
+Reports throughput and p50/p95/p99 latency per scenario.
+
+    cd backend_new
+    python -m bench.run                                    # every scenario
+    python -m bench.run single hot --requests 500 --concurrency 32
+    python -m bench.run --latency-ms 300 --throttle-rate 0.1 --json after.json --compare before.json
+    python -m bench.run bulk --batch-error-rate 0.2          # some ASINs fail inside offer batches
+
+Scenarios:
+    single  distinct ASINs through /get_product_details (cold cache)
+    hot     a small set of ASINs requested over and over (warm cache)
+    bulk    /get_product_details_batch jobs; every ASIN the fake answers must come back priced
+    bsr     fetching and parsing the BSR table fixture
+
+SP-API rate limits are lifted by default so the numbers measure the backend itself;
+use --rate-limits real to include the usage-plan token buckets.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import string
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+
+import requests
+
+try:
+    from .fake_sp_api import BSR_FIXTURE_PATH, batch_item_fails, config_from_args, parse_config_args, serve
+except ImportError:
+    # Fallback for direct execution
+    from fake_sp_api import BSR_FIXTURE_PATH, batch_item_fails, config_from_args, parse_config_args, serve
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['single', 'hot', 'bulk', 'bsr']
+SP_API_OPERATIONS = ['getCatalogItem', 'searchCatalogItems', 'getListingsRestrictions', 'getItemOffers', 'getItemOffersBatch', 'getMyFeesEstimates']
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def random_asins(count, prefix='B0'):
+    """ASINs unique to this run, so nothing is served from a cache warmed by an earlier run"""
+    rng = random.Random()
+    run_id = ''.join(rng.choices(string.ascii_uppercase, k=3))
+    return [f"{prefix}{run_id}{i:05d}" for i in range(count)]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# --- Fake SP-API Process ---
+class FakeSpApiProcess:
+    def __init__(self, config, port=None):
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._process = multiprocessing.Process(target=serve, args=(config, '127.0.0.1', self.port), daemon=True)
+
+    def start(self, timeout=10):
+        self._process.start()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                requests.get(f"{self.url}/_stats", timeout=1)
+                return self
+            except requests.RequestException:
+                time.sleep(0.05)
+        raise RuntimeError(f"Fake SP-API did not start on port {self.port}")
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join(timeout=5)
+
+class FakeSpApiStatsClient:
+    def __init__(self, url):
+        self.url = url
+
+    def reset(self):
+        if self.url:
+            requests.post(f"{self.url}/_reset", timeout=5)
+
+    def snapshot(self):
+        if not self.url:
+            return None
+        stats = requests.get(f"{self.url}/_stats", timeout=5).json()
+        return {'calls': stats['calls'], 'throttled': stats['throttled']}
+
+def backend_environment(fake_url, workdir, real_rate_limits):
+    """Environment that points the backend at the fake SP-API"""
+    env = {
+        'SP_API_ENDPOINT': fake_url,
+        'SP_API_LWA_URL': f"{fake_url}/auth/o2/token",
+        'BSR_TABLE_URL': f"{fake_url}/sas/bsr-tables?domain_id={{domain_id}}",
+        'BSR_SNAPSHOT_PATH': os.path.join(workdir, 'bsr_tables.json'),
+        'SNAPSHOT_DB_PATH': os.path.join(workdir, 'product_snapshots.db'),
+        'LOG_PATH': os.path.join(workdir, 'app.log'),
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AMAZON_REFRESH_TOKEN': 'Atzr|benchmark',
+        'AMAZON_LWA_APP_ID': 'amzn1.application-oa2-client.benchmark',
+        'AMAZON_LWA_CLIENT_SECRET': 'benchmark',
+        'AMAZON_SELLER_ID': 'ABENCHMARKSELLER',
+        'EU_REFRESH_TOKEN': 'Atzr|benchmark',
+        'EU_LWA_APP_ID': 'amzn1.application-oa2-client.benchmark',
+        'EU_LWA_CLIENT_SECRET': 'benchmark',
+        'EU_SELLER_ID': 'ABENCHMARKSELLER',
+    }
+    if not real_rate_limits:
+        env['SP_API_RATE_LIMITS'] = json.dumps({op: [10000, 10000] for op in SP_API_OPERATIONS})
+    return env
+
+# --- Clients ---
+class InProcessClient:
+    """Calls the Flask app directly, without an HTTP server in between"""
+
+    def __init__(self, verbose):
+        if BACKEND_DIR not in sys.path:
+            sys.path.insert(0, BACKEND_DIR)
+        import app as backend_app
+        if not verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        self.backend = backend_app
+        self.app = backend_app.app
+
+    def request(self, method, path, body=None):
+        response = self.app.test_client().open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+    def clear_cache(self):
+        self.backend.response_cache.clear()
+
+class HttpClient:
+    """Calls a running server over HTTP, one keep-alive session per load thread"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        response = session.request(method, self.base_url + path, json=body, timeout=300)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    def clear_cache(self):
+        pass
+
+# --- Load Generation ---
+def run_load(calls, concurrency):
+    """Run zero-argument callables returning True on success; returns (latencies, errors, seconds)"""
+    def timed(call):
+        started = time.perf_counter()
+        try:
+            ok = call()
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, calls))
+    seconds = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    return latencies, errors, seconds
+
+def summarize(name, latencies, errors, seconds, items_per_call=1, unit='req'):
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        'scenario': name,
+        'calls': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) * items_per_call / seconds, 2) if seconds else None,
+        'unit': f"{unit}/s",
+        'p50_ms': round(percentile(ms, 50), 1) if ms else None,
+        'p95_ms': round(percentile(ms, 95), 1) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 1) if ms else None,
+        'max_ms': round(ms[-1], 1) if ms else None,
+    }
+
+def product_call(client, asin, marketplace):
+    def call():
+        status, data = client.request('GET', f"/get_product_details/{asin}?marketplace={marketplace}")
+        return status == 200 and data is not None and 'error' not in data
+    return call
+
+# --- Scenarios ---
+def scenario_single(client, args):
+    client.clear_cache()
+    calls = [product_call(client, asin, args.marketplace) for asin in random_asins(args.requests)]
+    return summarize('single', *run_load(calls, args.concurrency))
+
+def scenario_hot(client, args):
+    asins = random_asins(args.hot_asins)
+    # Warm the cache first; only the repeated traffic is measured
+    run_load([product_call(client, asin, args.marketplace) for asin in asins], args.concurrency)
+    calls = [product_call(client, asins[i % len(asins)], args.marketplace) for i in range(args.requests)]
+    return summarize('hot', *run_load(calls, args.concurrency))
+
+def scenario_bulk(client, args):
+    client.clear_cache()
+    config = config_from_args(args)
+
+    def job(asins):
+        def call():
+            status, data = client.request('POST', '/get_product_details_batch', {'marketplace': args.marketplace, 'asins': asins})
+            if status != 200 or data is None or data.get('count') != len(asins):
+                return False
+            # With --batch-error-rate, an ASIN failing inside a batch must not cost the others their prices
+            priced = {result['asin'] for result in data['results'] if result.get('buyboxPrice') is not None}
+            return priced == {asin for asin in asins if not batch_item_fails(asin, config)}
+        return call
+
+    calls = [job(random_asins(args.bulk_size)) for _ in range(args.bulk_jobs)]
+    return summarize('bulk', *run_load(calls, args.bulk_concurrency), items_per_call=args.bulk_size, unit='asin')
+
+def scenario_bsr(client, args):
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    from bsr_scraper import scrape_bsr_table_by_country
+
+    url_template = os.environ['BSR_TABLE_URL']
+    calls = [lambda: bool(scrape_bsr_table_by_country(1, url_template)) for _ in range(args.bsr_requests)]
+    return summarize('bsr', *run_load(calls, args.concurrency), unit='table')
+
+SCENARIO_RUNNERS = {
+    'single': scenario_single,
+    'hot': scenario_hot,
+    'bulk': scenario_bulk,
+    'bsr': scenario_bsr,
+}
+
+# --- Reporting ---
+COLUMNS = ['scenario', 'calls', 'errors', 'seconds', 'throughput', 'unit', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+def print_table(results):
+    rows = [[str(result.get(column, '')) for column in COLUMNS] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(COLUMNS)]
+    print('  '.join(column.ljust(width) for column, width in zip(COLUMNS, widths)))
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {result['scenario']: result for result in json.load(f)['results']}
+
+    print(f"\nChange against {baseline_path}:")
+    for result in results:
+        before = baseline.get(result['scenario'])
+        if not before:
+            continue
+        changes = []
+        for metric in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = before.get(metric), result.get(metric)
+            if old and new is not None:
+                changes.append(f"{metric} {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+        print(f"  {result['scenario']}: {', '.join(changes)}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--requests', type=int, default=200, help='requests per single/hot scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--hot-asins', type=int, default=20, help='distinct ASINs in the hot scenario')
+    parser.add_argument('--bulk-jobs', type=int, default=4, help='batch requests in the bulk scenario')
+    parser.add_argument('--bulk-size', type=int, default=100, help='ASINs per batch request')
+    parser.add_argument('--bulk-concurrency', type=int, default=2, help='concurrent batch requests')
+    parser.add_argument('--bsr-requests', type=int, default=50, help='BSR table fetches in the bsr scenario')
+    parser.add_argument('--marketplace', default='US')
+    parser.add_argument('--rate-limits', choices=['unlimited', 'real'], default='unlimited', help='SP-API usage plan buckets in the backend')
+    parser.add_argument('--base-url', help='benchmark a running server instead of the in-process app; it must already point at a fake SP-API')
+    parser.add_argument('--fake-url', help='with --base-url: URL of that fake SP-API, for call counts')
+    parser.add_argument('--json', dest='json_path', help='write results to this file')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    parser.add_argument('--verbose', action='store_true', help='keep backend INFO logging')
+    parse_config_args(parser)
+    args = parser.parse_args(argv)
+    scenarios = args.scenarios or SCENARIOS
+    unknown = [name for name in scenarios if name not in SCENARIO_RUNNERS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+
+    fake = None
+    workdir = tempfile.mkdtemp(prefix='fastchecker-bench-')
+    config = config_from_args(args)
+    try:
+        if args.base_url:
+            client = HttpClient(args.base_url)
+            fake_url = args.fake_url
+            os.environ.setdefault('BSR_TABLE_URL', f"{fake_url}/sas/bsr-tables?domain_id={{domain_id}}" if fake_url else BSR_FIXTURE_PATH)
+        else:
+            fake = FakeSpApiProcess(config).start()
+            fake_url = fake.url
+            os.environ.update(backend_environment(fake_url, workdir, args.rate_limits == 'real'))
+            client = InProcessClient(args.verbose)
+        fake_stats = FakeSpApiStatsClient(fake_url)
+
+        print(f"Fake SP-API: {fake_url or 'external'}, latency {config.latency_ms}±{config.jitter_ms} ms, "
+              f"429 rate {config.throttle_rate}, slow tail {config.tail_rate} x {config.tail_ms:g} ms, "
+              f"{config.offers} offers/ASIN, rate limits {args.rate_limits}\n")
+
+        results = []
+        for name in scenarios:
+            fake_stats.reset()
+            result = SCENARIO_RUNNERS[name](client, args)
+            result['sp_api'] = fake_stats.snapshot()
+            results.append(result)
+            print(f"{name}: done in {result['seconds']}s")
+
+        print()
+        print_table(results)
+        if args.compare:
+            print_comparison(results, args.compare)
+        if args.json_path:
+            with open(args.json_path, 'w', encoding='utf-8') as f:
+                json.dump({'fake_sp_api': asdict(config), 'args': vars(args), 'results': results}, f, indent=2)
+            print(f"\nResults written to {args.json_path}")
+    finally:
+        if fake:
+            fake.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import re
+import logging
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# SellerAmp column headers look like 'Top 0.5% BSR', 'Top 1% BSR', ...
+PERCENT_HEADER_RE = re.compile(r'Top\s+([\d.]+)%\s+BSR', re.IGNORECASE)
+
+def normalize_category(category):
+    """Normalize a category name so 'Home & Kitchen' on a product page matches the table row"""
+    category = category.lower().replace('&amp;', '&').replace('&', ' and ')
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', category).split())
+
+def percent_label(percent):
+    return f"{percent:g}%"
+
+class BsrIndex:
+    """
+    Precomputed BSR percentile lookup built from the scraped BSR tables.
+
+    For every marketplace and normalized category it keeps the BSR thresholds sorted
+    ascending together with their 'Top X%' bucket, so a lookup is a single bisect.
+    """
+
+    def __init__(self, bsr_tables):
+        self._index = {}
+        for marketplace, table in (bsr_tables or {}).items():
+            self._index[marketplace.upper()] = {
+                normalize_category(category): self._build_thresholds(columns)
+                for category, columns in (table or {}).items()
+            }
+        logger.info(f"BSR index built: { {m: len(c) for m, c in self._index.items()} }")
+
+    @staticmethod
+    def _build_thresholds(columns):
+        buckets = []
+        for header, threshold in columns.items():
+            match = PERCENT_HEADER_RE.search(header)
+            if match:
+                buckets.append((float(match.group(1)), threshold))
+        buckets.sort()
+        # A wider bucket never has a smaller threshold; guard against bad rows so bisect stays valid
+        thresholds, labels = [], []
+        for percent, threshold in buckets:
+            if thresholds and threshold < thresholds[-1]:
+                continue
+            thresholds.append(threshold)
+            labels.append(percent_label(percent))
+        return thresholds, labels
+
+    def has_marketplace(self, marketplace):
+        return bool(self._index.get(marketplace.upper()))
+
+    def lookup(self, marketplace, bsr, category):
+        """Return the smallest 'Top X%' bucket containing this BSR, e.g. '1%', or None"""
+        return self.lookup_many(marketplace, [(bsr, category)])[0]
+
+    def lookup_many(self, marketplace, pairs):
+        """Look up many (bsr, category) pairs for one marketplace"""
+        categories = self._index.get(marketplace.upper(), {})
+        results = []
+        for bsr, category in pairs:
+            entry = categories.get(normalize_category(category)) if bsr and isinstance(category, str) else None
+            if not entry:
+                results.append(None)
+                continue
+            thresholds, labels = entry
+            position = bisect_left(thresholds, bsr)
+            results.append(labels[position] if position < len(labels) else None)
+        return results
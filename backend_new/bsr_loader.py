@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .bsr_index import BsrIndex
+    from .bsr_scraper import BSR_TABLE_URL, fetch_bsr_table_html, parse_bsr_table
+except ImportError:
+    # Fallback for direct execution
+    from bsr_index import BsrIndex
+    from bsr_scraper import BSR_TABLE_URL, fetch_bsr_table_html, parse_bsr_table
+
+logger = logging.getLogger(__name__)
+
+# SellerAmp uses Keepa domain ids. NL, SE, PL and BE have no SellerAmp BSR table.
+BSR_DOMAIN_IDS = {
+    'US': 1,
+    'GB': 2,
+    'DE': 3,
+    'FR': 4,
+    'CA': 6,
+    'IT': 8,
+    'ES': 9,
+    'MX': 11,
+}
+
+# Another worker holding the refresh lock longer than this is assumed to have died
+REFRESH_LOCK_TIMEOUT = 600
+# Domains that failed to refresh are retried on their own after this many seconds
+REFRESH_RETRY_DELAY = 300
+# Returned by _acquire_refresh_lock when the lock is held in shared state rather than a file
+SHARED_REFRESH_LOCK = 'shared'
+
+class BsrTableStore:
+    """
+    Holds the BSR tables and their percentile index, loaded from an on-disk snapshot at
+    startup and refreshed in a background thread.
+
+    Tables and index are swapped together as one tuple, so readers never see a table
+    from one refresh paired with an index from another.
+
+    The snapshot file and refresh lock coordinate the workers of one host. With a shared
+    state backend, the snapshot and lock live there too, so workers on every host share a
+    single scrape.
+
+    The snapshot also records the domains whose last fetch failed. Those are retried on their
+    own after REFRESH_RETRY_DELAY, by whichever worker gets the lock; the others pick up the
+    result. The file's mtime stays at the last full refresh, so retries never postpone it.
+    """
+
+    def __init__(self, domains, snapshot_path, refresh_interval, url_template=BSR_TABLE_URL, shared=None):
+        self.domains = dict(domains)
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.url_template = url_template
+        self.shared = shared
+        self._state = ({}, BsrIndex({}))
+        self._validators = {}
+        self._loaded_at = None
+        self._updated_at = None
+        # {marketplace: [failed_at, error]} for domains whose last fetch failed
+        self._failed = {}
+        self._snapshot_seen = None
+        self._last_error = None
+        self._thread = None
+
+    @property
+    def tables(self):
+        return self._state[0]
+
+    @property
+    def index(self):
+        return self._state[1]
+
+    def _swap(self, tables, validators, loaded_at, updated_at=None, failed=None):
+        self._state = (tables, BsrIndex(tables))
+        self._validators = validators
+        self._loaded_at = loaded_at
+        self._updated_at = updated_at or loaded_at
+        self._failed = dict(failed or {})
+
+    def _swap_snapshot(self, snapshot):
+        self._swap(snapshot.get('tables', {}), snapshot.get('validators', {}), snapshot.get('saved_at'), snapshot.get('updated_at'), snapshot.get('failed'))
+
+    def _snapshot_data(self):
+        return {'saved_at': self._loaded_at, 'updated_at': self._updated_at, 'tables': self.tables, 'validators': self._validators, 'failed': self._failed}
+
+    def load_snapshot(self):
+        """Load tables from the shared or on-disk snapshot; returns False if there is none"""
+        return self._load_shared_snapshot() or self._load_file_snapshot()
+
+    def _load_file_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            logger.info(f"No BSR snapshot at {self.snapshot_path}, waiting for first refresh")
+            return False
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Could not read BSR snapshot {self.snapshot_path}: {str(e)}")
+            return False
+
+        self._swap_snapshot(snapshot)
+        self._snapshot_seen = self._snapshot_version()
+        logger.info(f"✅ BSR tables loaded from snapshot: { {m: len(t) for m, t in self.tables.items()} }")
+        return True
+
+    def _load_shared_snapshot(self):
+        snapshot = self.shared.get('bsr:snapshot') if self.shared is not None else None
+        if not snapshot:
+            return False
+        self._swap_snapshot(snapshot)
+        logger.info(f"✅ BSR tables loaded from shared state: { {m: len(t) for m, t in self.tables.items()} }")
+        return True
+
+    def _publish_shared_snapshot(self):
+        if self.shared is None:
+            return
+        self.shared.set('bsr:snapshot', self._snapshot_data())
+        # Kept apart so the other workers can check freshness without fetching the tables
+        self.shared.set('bsr:meta', {'saved_at': self._loaded_at, 'updated_at': self._updated_at})
+
+    def _save_snapshot(self):
+        self._publish_shared_snapshot()
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._snapshot_data(), f)
+        # The mtime marks the last full refresh, also after a retry of failed domains
+        os.utime(tmp_path, (self._loaded_at, self._loaded_at))
+        # Atomic on POSIX, so other workers never read a half-written snapshot
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_seen = self._snapshot_version()
+
+    def _snapshot_stat(self):
+        try:
+            return os.stat(self.snapshot_path)
+        except OSError:
+            return None
+
+    def _snapshot_version(self):
+        """Changes with every write of the snapshot file, including retries that keep its mtime"""
+        stat = self._snapshot_stat()
+        return stat.st_ctime_ns if stat else None
+
+    def _fetch_domain(self, marketplace, domain_id):
+        validators = self._validators.get(marketplace, {})
+        html, etag, last_modified = fetch_bsr_table_html(
+            domain_id, self.url_template, etag=validators.get('etag'), last_modified=validators.get('last_modified'))
+        if html is None:
+            logger.info(f"BSR table for {marketplace} not modified")
+            return self.tables.get(marketplace), validators
+
+        table = parse_bsr_table(html)
+        if table is None:
+            raise ValueError(f"BSR table not found for {marketplace} (domain {domain_id})")
+        return table, {'etag': etag, 'last_modified': last_modified}
+
+    def refresh(self, marketplaces=None):
+        """
+        Fetch all domains (or just `marketplaces`, to retry failed ones) concurrently and swap in
+        the new tables; failed domains keep their old table and are recorded for a retry
+        """
+        domains = {m: self.domains[m] for m in marketplaces} if marketplaces else self.domains
+        logger.info(f"Refreshing BSR tables for {', '.join(domains)}...")
+        started = time.time()
+        tables = dict(self.tables)
+        validators = dict(self._validators)
+        failed = {m: entry for m, entry in self._failed.items() if m not in domains and m in self.domains}
+
+        with ThreadPoolExecutor(max_workers=len(domains), thread_name_prefix='bsr-fetch') as executor:
+            futures = {marketplace: executor.submit(self._fetch_domain, marketplace, domain_id) for marketplace, domain_id in domains.items()}
+            for marketplace, future in futures.items():
+                try:
+                    table, domain_validators = future.result()
+                    if table:
+                        tables[marketplace] = table
+                        validators[marketplace] = domain_validators
+                except Exception as e:
+                    failed[marketplace] = [time.time(), str(e)]
+                    logger.error(f"❌ Error refreshing BSR table for {marketplace}: {str(e)}")
+
+        # A retry keeps the time of the last full refresh, so the next one is not postponed
+        now = time.time()
+        self._swap(tables, validators, self._loaded_at if marketplaces else now, now, failed)
+        try:
+            self._save_snapshot()
+        except OSError as e:
+            logger.error(f"❌ Could not write BSR snapshot: {str(e)}")
+        logger.info(f"✅ BSR tables refreshed in {time.time() - started:.1f}s: { {m: len(t) for m, t in tables.items()} }")
+
+    def _acquire_refresh_lock(self):
+        """Cross-process lock so only one gunicorn worker scrapes at a time"""
+        if self.shared is not None:
+            acquired = self.shared.add('bsr:refresh-lock', os.getpid(), REFRESH_LOCK_TIMEOUT)
+            # None: shared state is down, fall back to the lock file
+            if acquired is not None:
+                return SHARED_REFRESH_LOCK if acquired else None
+        lock_path = f"{self.snapshot_path}.lock"
+        try:
+            if time.time() - os.path.getmtime(lock_path) > REFRESH_LOCK_TIMEOUT:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return lock_path
+        except FileExistsError:
+            return None
+
+    def _sync_fresh_snapshot(self):
+        """Pick up a newer shared or on-disk snapshot (possibly written by another worker); True if it is still fresh"""
+        meta = self.shared.get('bsr:meta') if self.shared is not None else None
+        if meta and time.time() - meta['saved_at'] < self.refresh_interval:
+            if meta['updated_at'] != self._updated_at:
+                self._load_shared_snapshot()
+            return True
+
+        stat = self._snapshot_stat()
+        if stat and time.time() - stat.st_mtime < self.refresh_interval:
+            if stat.st_ctime_ns != self._snapshot_seen:
+                self._load_file_snapshot()
+            # Shared state is missing or behind the file (first start with it, or it was down): catch it up
+            if self.tables:
+                self._publish_shared_snapshot()
+            return True
+        return False
+
+    def _retries_due(self):
+        """Failed domains whose retry delay has passed"""
+        now = time.time()
+        return [m for m, (failed_at, _) in self._failed.items() if m in self.domains and now - failed_at >= REFRESH_RETRY_DELAY]
+
+    def refresh_if_stale(self):
+        """Refresh when the snapshot is stale, or retry the domains that failed last time"""
+        if self._sync_fresh_snapshot() and not self._retries_due():
+            return
+
+        lock_path = self._acquire_refresh_lock()
+        if not lock_path:
+            logger.info("Another worker is refreshing BSR tables, skipping")
+            return
+        try:
+            # Another worker may have refreshed or retried in the meantime
+            if not self._sync_fresh_snapshot():
+                self.refresh()
+            elif self._retries_due():
+                self.refresh(self._retries_due())
+        finally:
+            if lock_path == SHARED_REFRESH_LOCK:
+                self.shared.delete('bsr:refresh-lock')
+            else:
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh_if_stale()
+                self._last_error = None
+            except Exception as e:
+                self._last_error = str(e)
+                logger.error(f"❌ BSR refresh loop error: {str(e)}")
+                logger.error(traceback.format_exc())
+            delay = REFRESH_RETRY_DELAY if self._last_error or self._failed else min(self.refresh_interval, 3600)
+            # Jitter so workers started together do not all wake at the same moment
+            time.sleep(delay * random.uniform(0.9, 1.1))
+
+    def start(self):
+        """Start the background refresh thread (idempotent)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='bsr-loader', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        return {
+            'marketplaces': {marketplace: len(table) for marketplace, table in self.tables.items()},
+            'loaded_at': self._loaded_at,
+            'refresh_interval': self.refresh_interval,
+            'last_error': self._last_error,
+            'failed': {marketplace: error for marketplace, (_, error) in self._failed.items()},
+        }
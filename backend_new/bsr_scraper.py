@@ -1,29 +1,53 @@
-
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
 
-def scrape_bsr_table_by_country(domain_id: int):
+BSR_TABLE_URL = "https://sas.selleramp.com/sas/bsr-tables?domain_id={domain_id}&src="
+
+def fetch_bsr_table_html(domain_id: int, url_template: str = BSR_TABLE_URL, etag=None, last_modified=None, timeout=30):
     """
-    Scrapes the BSR table from SellerAmp for a specific country domain.
+    Fetches the BSR table page with a conditional GET.
+    Returns (html, etag, last_modified); html is None when the page has not changed (304).
+    `url_template` may also be a local file path with a {domain_id} placeholder.
     """
-    url = f"https://sas.selleramp.com/sas/bsr-tables?domain_id={domain_id}&src="
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        print(f"Error fetching BSR table for domain {domain_id}: {e}")
-        return None
+    url = url_template.format(domain_id=domain_id)
+    if not url.startswith(('http://', 'https://')):
+        with open(url, 'rb') as f:
+            return f.read(), None, None
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    response = requests.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return None, etag, last_modified
+    response.raise_for_status()
+    return response.content, response.headers.get('ETag'), response.headers.get('Last-Modified')
 
-    soup = BeautifulSoup(response.content, 'html.parser')
+def parse_bsr_table(html):
+    """
+    Parses the SellerAmp BSR table into {category: {'Top X% BSR': threshold}}.
+    Returns None if the page has no table.
+    """
+    # Only build a tree for the table itself, the rest of the page is irrelevant
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=SoupStrainer('table'))
     table = soup.find('table')
     if not table:
-        print(f"BSR table not found for domain {domain_id}.")
         return None
 
     headers = [th.text.strip() for th in table.find_all('th')]
     bsr_data = {}
 
-    for row in table.find('tbody').find_all('tr'):
+    rows = table.find('tbody') or table
+    for row in rows.find_all('tr'):
         cells = row.find_all('td')
         if not cells:
             continue
@@ -31,7 +55,7 @@ def scrape_bsr_table_by_country(domain_id: int):
         category = cells[0].text.strip()
         # Skip the 'Product Count' column (index 1)
         values = [cell.text.strip().replace(',', '') for cell in cells[2:]]
-        
+
         category_data = {}
         # Start from the 3rd header ('Top 0.5% BSR')
         for i, header in enumerate(headers[2:]):
@@ -41,3 +65,18 @@ def scrape_bsr_table_by_country(domain_id: int):
         bsr_data[category] = category_data
 
     return bsr_data
+
+def scrape_bsr_table_by_country(domain_id: int, url_template: str = BSR_TABLE_URL):
+    """
+    Scrapes the BSR table from SellerAmp for a specific country domain.
+    """
+    try:
+        html, _, _ = fetch_bsr_table_html(domain_id, url_template)
+    except requests.RequestException as e:
+        print(f"Error fetching BSR table for domain {domain_id}: {e}")
+        return None
+
+    bsr_data = parse_bsr_table(html)
+    if bsr_data is None:
+        print(f"BSR table not found for domain {domain_id}.")
+    return bsr_data
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+try:
+    from .rate_limiter import PRIORITY_BULK, set_thread_priority
+except ImportError:
+    # Fallback for direct execution
+    from rate_limiter import PRIORITY_BULK, set_thread_priority
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 20))
+# The first chunk is smaller so the first results reach the client quickly
+STREAM_FIRST_CHUNK_SIZE = int(os.environ.get('STREAM_FIRST_CHUNK_SIZE', 5))
+# At most this many chunks are being fetched (or held as results) per job at any time
+STREAM_MAX_IN_FLIGHT = int(os.environ.get('STREAM_MAX_IN_FLIGHT', 4))
+STREAM_MAX_WORKERS = int(os.environ.get('STREAM_MAX_WORKERS', 8))
+STREAM_MAX_ASINS = int(os.environ.get('STREAM_MAX_ASINS', 10000))
+# Send a heartbeat when nothing completed for this long, so proxies keep the connection open
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get('STREAM_HEARTBEAT_SECONDS', 15))
+
+# Chunk workers only orchestrate; the SP-API calls themselves run on the bulk pool in app.py
+stream_executor = ThreadPoolExecutor(max_workers=STREAM_MAX_WORKERS, thread_name_prefix='bulk-stream', initializer=set_thread_priority, initargs=(PRIORITY_BULK,))
+
+class StreamJob:
+    def __init__(self, total):
+        self.id = uuid.uuid4().hex
+        self.total = total
+        self.completed = 0
+        self.created_at = time.time()
+        self.cancelled = threading.Event()
+
+class StreamJobRegistry:
+    """Running streaming jobs by id, so a separate request can cancel them"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, total):
+        job = StreamJob(total)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancelled.set()
+        return True
+
+    def remove(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {job.id: {'total': job.total, 'completed': job.completed, 'cancelled': job.cancelled.is_set()} for job in self._jobs.values()}
+
+stream_jobs = StreamJobRegistry()
+
+def split_chunks(asins, chunk_size, first_chunk_size):
+    first = asins[:first_chunk_size]
+    rest = asins[first_chunk_size:]
+    return ([first] if first else []) + [rest[i:i + chunk_size] for i in range(0, len(rest), chunk_size)]
+
+def run_stream_job(job, asins, process_chunk, chunk_size=STREAM_CHUNK_SIZE, max_in_flight=STREAM_MAX_IN_FLIGHT):
+    """
+    Generator of job records: a 'job' header, one 'result' per ASIN as its chunk completes,
+    'heartbeat' while waiting, and a final 'done'. `process_chunk(asins)` returns a list of
+    per-ASIN result dicts. Stops early, without starting new chunks, once the job is cancelled
+    or the client disconnects.
+    """
+    chunks = iter(split_chunks(asins, chunk_size, min(STREAM_FIRST_CHUNK_SIZE, chunk_size)))
+    pending = {}
+
+    def submit_next():
+        chunk = next(chunks, None)
+        if chunk is not None:
+            pending[stream_executor.submit(process_chunk, chunk)] = chunk
+
+    logger.info(f"Stream job {job.id} started: {job.total} ASINs")
+    try:
+        yield {'type': 'job', 'jobId': job.id, 'total': job.total}
+        for _ in range(max_in_flight):
+            submit_next()
+
+        last_sent = time.time()
+        while pending:
+            # Short waits so a cancel request is noticed within a second
+            done, _ = wait(list(pending), timeout=1.0, return_when=FIRST_COMPLETED)
+            if job.cancelled.is_set():
+                break
+            if not done:
+                if time.time() - last_sent >= STREAM_HEARTBEAT_SECONDS:
+                    last_sent = time.time()
+                    yield {'type': 'heartbeat', 'completed': job.completed}
+                continue
+
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logger.error(f"❌ Stream job {job.id} chunk failed: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    results = [{'asin': asin, 'error': f"Server error: {str(e)}"} for asin in chunk]
+                submit_next()
+                for result in results:
+                    job.completed += 1
+                    yield {'type': 'result', 'data': result}
+                last_sent = time.time()
+
+        cancelled = job.cancelled.is_set()
+        logger.info(f"Stream job {job.id} {'cancelled' if cancelled else 'finished'}: {job.completed}/{job.total}")
+        yield {'type': 'done', 'jobId': job.id, 'completed': job.completed, 'total': job.total, 'cancelled': cancelled}
+    finally:
+        # Reached on completion, cancellation and client disconnect (GeneratorExit)
+        job.cancelled.set()
+        for future in pending:
+            future.cancel()
+        stream_jobs.remove(job.id)
+
+def format_ndjson(record):
+    return json.dumps(record) + '\n'
+
+def format_sse(record):
+    if record['type'] == 'heartbeat':
+        return ': heartbeat\n\n'
+    return f"event: {record['type']}\ndata: {json.dumps(record)}\n\n"
@@ -0,0 +1,242 @@
+import os
+import time
+import logging
+from bisect import bisect_left
+
+try:
+    from .response_cache import CACHE_TTLS
+except ImportError:
+    # Fallback for direct execution
+    from response_cache import CACHE_TTLS
+
+logger = logging.getLogger(__name__)
+
+# Estimates of the same ASIN are answered from for this long; fee schedules change rarely,
+# but peak-season surcharges and category moves do happen
+FEE_ESTIMATE_MAX_AGE = CACHE_TTLS.get('fee_profile', 24 * 3600)
+# A price within this ratio of the nearest estimate is extrapolated from it without a new call
+FEE_MODEL_EXTRAPOLATION_RATIO = float(os.environ.get('FEE_MODEL_EXTRAPOLATION_RATIO', 1.25))
+# Tier boundaries are bisected until the bracket is narrower than this share of the price
+FEE_MODEL_TIER_RESOLUTION = float(os.environ.get('FEE_MODEL_TIER_RESOLUTION', 0.02))
+# New fee estimates fetched per ASIN for one question, across all refinement rounds
+FEE_MODEL_MAX_PROBES = int(os.environ.get('FEE_MODEL_MAX_PROBES', 4))
+
+# Fee amounts are rounded to the cent
+FEE_ROUNDING = 0.005
+FEE_AMOUNT_TOLERANCE = 0.01
+
+# How a quoted fee was obtained, from most to least certain
+BASIS_ESTIMATE = 'estimate'          # an SP-API estimate at exactly this price
+BASIS_INTERPOLATED = 'interpolated'  # between two estimates with no fee boundary in between
+BASIS_EXTRAPOLATED = 'extrapolated'  # within FEE_MODEL_EXTRAPOLATION_RATIO of the nearest estimate
+BASIS_UNRESOLVED = 'unresolved'      # further out, or across a tier boundary that was not pinned down
+
+class FeeEstimate:
+    """One SP-API fee estimate: referral fee, FBA fee and any other fees at a sale price"""
+
+    __slots__ = ('price', 'referral', 'fba', 'other', 'observed_at')
+
+    def __init__(self, price, referral, fba, other, observed_at=None):
+        self.price = price
+        self.referral = referral
+        self.fba = fba
+        self.other = other
+        self.observed_at = observed_at or time.time()
+
+    @classmethod
+    def from_fees(cls, price, fees_data):
+        referral = fees_data.get('referralFee') or 0.0
+        fba = fees_data.get('fbaFee') or 0.0
+        # 'or 0.0' also turns a rounded -0.0 into 0.0
+        other = round((fees_data.get('totalFees') or 0.0) - referral - fba, 2) or 0.0
+        return cls(round(price, 2), referral, fba, other)
+
+    def to_data(self):
+        return [self.price, self.referral, self.fba, self.other, self.observed_at]
+
+def segment_kind(lower, upper):
+    """
+    How the referral fee behaves between two estimates: 'rate' (same percentage), 'flat' (same
+    amount, i.e. the minimum referral fee) or None if a tier, FBA price band or minimum boundary
+    lies between them.
+    """
+    if abs(lower.fba - upper.fba) > FEE_AMOUNT_TOLERANCE or abs(lower.other - upper.other) > FEE_AMOUNT_TOLERANCE:
+        return None
+    # Both amounts are rounded to the cent, and the lower estimate's rounding error scales up with the price
+    if abs(lower.referral / lower.price * upper.price - upper.referral) <= FEE_ROUNDING * (1 + upper.price / lower.price) + 1e-9:
+        return 'rate'
+    if abs(lower.referral - upper.referral) <= FEE_AMOUNT_TOLERANCE:
+        return 'flat'
+    return None
+
+class FeeProfile:
+    """
+    Fee schedule of one ASIN in one marketplace, learned from a handful of fee estimates.
+
+    Estimates are kept sorted by price. Between two estimates whose FBA and other fees match and
+    whose referral fees share a rate (or a flat minimum) no boundary can lie, so any price there
+    is answered exactly; elsewhere the nearest estimate's rate and fixed fees are carried over.
+    """
+
+    def __init__(self, estimates=()):
+        self.estimates = sorted(estimates, key=lambda e: e.price)
+
+    @classmethod
+    def from_data(cls, data, max_age=FEE_ESTIMATE_MAX_AGE):
+        cutoff = time.time() - max_age
+        return cls(FeeEstimate(*row) for row in (data or {}).get('estimates', []) if row[4] >= cutoff)
+
+    def to_data(self):
+        return {'estimates': [e.to_data() for e in self.estimates]}
+
+    def add(self, estimate):
+        # A newer estimate at the same price replaces the old one
+        self.estimates = [e for e in self.estimates if abs(e.price - estimate.price) > FEE_ROUNDING]
+        self.estimates.insert(bisect_left([e.price for e in self.estimates], estimate.price), estimate)
+
+    def _neighbours(self, price):
+        prices = [e.price for e in self.estimates]
+        index = bisect_left(prices, price - FEE_ROUNDING)
+        if index < len(prices) and abs(prices[index] - price) <= FEE_ROUNDING:
+            return self.estimates[index], self.estimates[index]
+        lower = self.estimates[index - 1] if index > 0 else None
+        upper = self.estimates[index] if index < len(prices) else None
+        return lower, upper
+
+    def _outer_kind(self, estimate):
+        """Referral behaviour next to an edge estimate, judged from its inner neighbour"""
+        index = self.estimates.index(estimate)
+        neighbour = self.estimates[index + 1] if index == 0 and len(self.estimates) > 1 else (self.estimates[index - 1] if index > 0 else None)
+        if neighbour is None:
+            return 'rate'
+        return segment_kind(*sorted((estimate, neighbour), key=lambda e: e.price)) or 'rate'
+
+    def quote(self, price):
+        """Fees at a sale price with the basis they were derived on, or None without any estimate"""
+        if not self.estimates:
+            return None
+        lower, upper = self._neighbours(price)
+        if lower is upper:
+            source, kind, basis = lower, 'rate', BASIS_ESTIMATE
+        elif lower is not None and upper is not None:
+            kind = segment_kind(lower, upper)
+            if kind:
+                source, basis = lower, BASIS_INTERPOLATED
+            else:
+                # Unresolved boundary in between: the nearer estimate is the best guess
+                source = lower if price / lower.price <= upper.price / price else upper
+                kind, basis = 'rate', BASIS_UNRESOLVED
+        else:
+            source = lower or upper
+            kind = self._outer_kind(source)
+            ratio = max(price / source.price, source.price / price)
+            basis = BASIS_EXTRAPOLATED if ratio <= FEE_MODEL_EXTRAPOLATION_RATIO else BASIS_UNRESOLVED
+
+        referral = source.referral if basis == BASIS_ESTIMATE or kind == 'flat' else round(source.referral / source.price * price, 2)
+        return {
+            'referralFee': referral,
+            'fbaFee': source.fba,
+            'otherFees': source.other,
+            'totalFees': round(referral + source.fba + source.other, 2),
+            'basis': basis,
+        }
+
+    def probes_needed(self, prices):
+        """Prices at which a new estimate would settle the unresolved quotes for these prices"""
+        if not self.estimates:
+            ordered = sorted(prices)
+            return [round(ordered[len(ordered) // 2], 2)] if ordered else []
+
+        probes = set()
+        lowest, highest = self.estimates[0].price, self.estimates[-1].price
+        for price in prices:
+            if self.quote(price)['basis'] != BASIS_UNRESOLVED:
+                continue
+            if price < lowest:
+                probes.add(round(min(prices), 2))
+            elif price > highest:
+                probes.add(round(max(prices), 2))
+            else:
+                lower, upper = self._neighbours(price)
+                if upper.price - lower.price > FEE_MODEL_TIER_RESOLUTION * upper.price:
+                    probes.add(round((lower.price + upper.price) / 2, 2))
+        return sorted(probes)
+
+    def tiers(self):
+        """Runs of estimates that share one fee rule, i.e. the fee tiers found so far"""
+        tiers = []
+        for estimate in self.estimates:
+            if tiers and segment_kind(tiers[-1]['last'], estimate):
+                tiers[-1]['last'] = estimate
+                tiers[-1]['maxPrice'] = estimate.price
+                continue
+            tiers.append({'first': estimate, 'last': estimate, 'minPrice': estimate.price, 'maxPrice': estimate.price})
+        return [{
+            'minPrice': tier['minPrice'],
+            'maxPrice': tier['maxPrice'],
+            # The highest-priced estimate has the smallest rounding error
+            'referralRate': round(tier['last'].referral / tier['last'].price, 4),
+            'fbaFee': tier['first'].fba,
+            'otherFees': tier['first'].other,
+        } for tier in tiers]
+
+class FeeModel:
+    """
+    Per-ASIN fee profiles kept in the response cache (and with it the snapshot store), fed by
+    every fee estimate the backend makes. Answers fee questions for arbitrary prices and only
+    asks SP-API for the few estimates needed to place the prices it cannot answer yet.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def profile(self, asin, marketplace_name, currency_code):
+        # The model's own reads are not lookups, so they stay out of the cache's hit/miss counters
+        return FeeProfile.from_data(self.cache.peek('fee_profile', (asin, marketplace_name, currency_code)))
+
+    def observe(self, asin, marketplace_name, currency_code, price, fees_data):
+        """Add one successful fee estimate to the ASIN's profile"""
+        if not fees_data or price <= 0:
+            return
+        estimate = FeeEstimate.from_fees(price, fees_data)
+
+        def merge(data):
+            profile = FeeProfile.from_data(data)
+            profile.add(estimate)
+            return profile.to_data()
+
+        # Merged into whatever is stored at the time, so estimates from other workers are kept
+        self.cache.update('fee_profile', (asin, marketplace_name, currency_code), merge)
+
+    def quote(self, asin, marketplace_name, currency_code, price, bases=(BASIS_ESTIMATE, BASIS_INTERPOLATED)):
+        """Fees at a price from the cached profile alone, if they can be derived on one of `bases`"""
+        fees = self.profile(asin, marketplace_name, currency_code).quote(price)
+        return fees if fees and fees['basis'] in bases else None
+
+    def learn(self, marketplace_name, currency_code, prices_by_asin, estimate, max_probes=FEE_MODEL_MAX_PROBES):
+        """
+        Make sure every ASIN's profile can answer its prices, fetching estimates in rounds.
+
+        `estimate` takes a list of (asin, price) pairs, fetches them from SP-API and feeds the
+        results back through observe(). Each round asks only for the probes the profiles still
+        need (a first estimate, the edges of the requested range, the midpoint of an unresolved
+        tier boundary), at most `max_probes` per ASIN in total. Returns (profiles, estimates made).
+        """
+        profiles = {asin: self.profile(asin, marketplace_name, currency_code) for asin in prices_by_asin}
+        probes_left = dict.fromkeys(prices_by_asin, max_probes)
+        estimates_made = 0
+        while True:
+            probes = []
+            for asin, prices in prices_by_asin.items():
+                wanted = profiles[asin].probes_needed(prices)[:probes_left[asin]]
+                probes_left[asin] -= len(wanted)
+                probes.extend((asin, price) for price in wanted)
+            if not probes:
+                break
+            estimate(probes)
+            estimates_made += len(probes)
+            for asin in {asin for asin, _ in probes}:
+                profiles[asin] = self.profile(asin, marketplace_name, currency_code)
+
+        logger.info(f"🧮 Fee model: {len(prices_by_asin)} ASINs answered with {estimates_made} new estimates")
+        return profiles, estimates_made
@@ -0,0 +1,87 @@
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+try:
+    from .metrics import current_timer
+except ImportError:
+    # Fallback for direct execution
+    from metrics import current_timer
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_PATH = os.environ.get('LOG_PATH', 'app.log')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+# Records waiting for the writer thread; beyond this new records are dropped rather than blocking requests
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Share of successful requests whose step-by-step INFO lines are kept. Warnings, errors and the
+# per-request summary record are always written.
+LOG_DETAIL_SAMPLE_RATE = float(os.environ.get('LOG_DETAIL_SAMPLE_RATE', 0.1))
+
+# Logger for the one structured record written per request, never sampled
+REQUEST_LOGGER = 'fastchecker.requests'
+# Worker pools that only ever run work for requests; their detail lines without a bound timer
+# cannot be attributed to a sampled request and are dropped
+WORKER_THREAD_PREFIXES = ('sp-api', 'bulk-stream')
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of raising when the writer falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DetailSampler(logging.Filter):
+    """Drops INFO and DEBUG records of requests that were not picked for detailed logging"""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or record.name == REQUEST_LOGGER:
+            return True
+        timer = current_timer()
+        if timer is None:
+            return not record.threadName.startswith(WORKER_THREAD_PREFIXES)
+        return getattr(timer, 'log_details', True)
+
+def sample_details():
+    """Decide, once per request, whether its detail lines are logged"""
+    return random.random() < LOG_DETAIL_SAMPLE_RATE
+
+def configure_logging(level=logging.INFO, log_path=LOG_PATH):
+    """
+    Route all logging through a queue to a background writer thread, which writes to stderr
+    and to a size-rotated log file. Returns the queue handler (for its drop counter).
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    try:
+        handlers.append(logging.handlers.RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'))
+    except OSError as e:
+        logging.getLogger(__name__).warning(f"⚠️ Could not open log file {log_path}: {str(e)}")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(DetailSampler())
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Flush whatever is still queued when the worker exits
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    return queue_handler
+
+def log_request_summary(summary):
+    """Write the structured per-request record as a single JSON line"""
+    logging.getLogger(REQUEST_LOGGER).info(json.dumps(summary, default=str))
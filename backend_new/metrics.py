@@ -0,0 +1,161 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds; SP-API calls range from tens of milliseconds to throttled multi-second waits
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+OUTCOME_OK = 'ok'
+OUTCOME_THROTTLED = 'throttled'
+OUTCOME_ERROR = 'error'
+# Answered at the request deadline with some fields still pending
+OUTCOME_PARTIAL = 'partial'
+
+class LatencyHistogram:
+    """Cumulative latency histogram per label combination, rendered in Prometheus text format"""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels.get(name) or '') for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One counter per bucket plus +Inf, then sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+
+    def render(self):
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key in sorted(series):
+            counts, total = series[key]
+            labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, key))
+            prefix = f"{labels}," if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_latency = LatencyHistogram(
+    'fastchecker_request_duration_seconds', 'Time spent handling HTTP requests.', ['endpoint', 'marketplace', 'outcome'])
+step_latency = LatencyHistogram(
+    'fastchecker_step_duration_seconds', 'Time spent in each product details step, including cache and rate limit waits.', ['step', 'marketplace', 'outcome'])
+sp_api_latency = LatencyHistogram(
+    'fastchecker_sp_api_call_duration_seconds', 'Duration of individual SP-API calls, excluding rate limit waits.', ['operation', 'marketplace', 'outcome'])
+rate_limit_wait = LatencyHistogram(
+    'fastchecker_rate_limit_wait_seconds', 'Time SP-API calls waited for a rate limit token.', ['operation', 'marketplace', 'priority'])
+
+HISTOGRAMS = [request_latency, step_latency, sp_api_latency, rate_limit_wait]
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+# Timer of the request the current thread is working for, so SP-API calls made deep inside
+# a step can be attributed to it without passing the timer through every function
+_thread_timer = threading.local()
+
+def current_timer():
+    return getattr(_thread_timer, 'timer', None)
+
+def bind_timer(timer):
+    """Attach a request timer to the current thread, or detach it with None"""
+    _thread_timer.timer = timer
+
+class RequestTimer:
+    """Per-request timing breakdown, collected from every worker thread that runs one of its steps"""
+
+    def __init__(self, marketplace, log_details=True):
+        self.marketplace = marketplace
+        # Whether INFO lines logged on behalf of this request are written (see log_pipeline)
+        self.log_details = log_details
+        self.started = time.perf_counter()
+        self.steps = {}
+        self.calls = []
+        # Start times of steps still running, and elapsed ms of steps the request stopped waiting for
+        self._running = {}
+        self.unfinished = {}
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args):
+        """Run fn(*args) with this timer bound, so its SP-API calls and log lines count for this request"""
+        previous = current_timer()
+        bind_timer(self)
+        try:
+            return fn(*args)
+        finally:
+            bind_timer(previous)
+
+    def run(self, step, fn, *args):
+        """Run fn(*args) as a named step, typically on an executor thread"""
+        with self.step(step):
+            return self.call(fn, *args)
+
+    @contextmanager
+    def step(self, step):
+        started = time.perf_counter()
+        with self._lock:
+            self._running[step] = started
+        outcome = OUTCOME_ERROR
+        try:
+            yield
+            outcome = OUTCOME_OK
+        finally:
+            elapsed = time.perf_counter() - started
+            step_latency.observe(elapsed, step=step, marketplace=self.marketplace, outcome=outcome)
+            with self._lock:
+                self._running.pop(step, None)
+                self.steps[step] = round(elapsed * 1000, 1)
+
+    def mark_unfinished(self, step):
+        """Record a step the request answered without, with how long it had been running (or waiting to start)"""
+        with self._lock:
+            started = self._running.get(step, self.started)
+            self.unfinished[step] = round((time.perf_counter() - started) * 1000, 1)
+
+    def record_call(self, operation, seconds, waited, outcome):
+        with self._lock:
+            self.calls.append({'operation': operation, 'ms': round(seconds * 1000, 1), 'rateLimitWaitMs': round(waited * 1000, 1), 'outcome': outcome})
+
+    def breakdown(self):
+        with self._lock:
+            return {'totalMs': round((time.perf_counter() - self.started) * 1000, 1), 'stepsMs': dict(self.steps), 'unfinishedMs': dict(self.unfinished), 'spApiCalls': list(self.calls)}
+
+def submit_bound(executor, fn, *args):
+    """Submit fn(*args) to a worker pool with the calling thread's request timer bound on the worker"""
+    timer = current_timer()
+    if timer is None:
+        return executor.submit(fn, *args)
+    return executor.submit(timer.call, fn, *args)
+
+def record_sp_api_call(operation, marketplace, seconds, waited, outcome):
+    """Record one SP-API attempt in the histograms and in the current request's breakdown"""
+    sp_api_latency.observe(seconds, operation=operation, marketplace=marketplace, outcome=outcome)
+    timer = current_timer()
+    if timer is not None:
+        timer.record_call(operation, seconds, waited, outcome)
+
+def request_outcome(status_code):
+    if status_code == 429:
+        return OUTCOME_THROTTLED
+    return OUTCOME_OK if status_code < 400 else OUTCOME_ERROR
@@ -0,0 +1,127 @@
+import os
+import logging
+import threading
+from collections import OrderedDict, deque
+
+try:
+    from .rate_limiter import PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, TokenBucket, set_thread_priority
+except ImportError:
+    # Fallback for direct execution
+    from rate_limiter import PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, TokenBucket, set_thread_priority
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 2))
+# Lookups waiting to be warmed; beyond this the oldest are dropped
+PREFETCH_QUEUE_MAX = int(os.environ.get('PREFETCH_QUEUE_MAX', 500))
+# ASINs accepted per prefetch request
+PREFETCH_MAX_ASINS = int(os.environ.get('PREFETCH_MAX_ASINS', 100))
+# ASINs warmed per minute across all workers, with a burst so a fresh search page starts at once.
+# The SP-API calls themselves also only use spare rate-limit capacity (PRIORITY_PREFETCH).
+PREFETCH_BUDGET_PER_MINUTE = float(os.environ.get('PREFETCH_BUDGET_PER_MINUTE', 30))
+PREFETCH_BUDGET_BURST = int(os.environ.get('PREFETCH_BUDGET_BURST', 10))
+
+class PrefetchQueue:
+    """
+    Deduplicating queue of (asin, marketplace) lookups to warm the response cache with, worked
+    off by a few background threads in the prefetch rate-limit lane.
+
+    Newer submissions go first, each in its own order: the page that sent them is the one the
+    user is looking at now. When the queue is full the oldest entries are dropped. Lookups that
+    are already cached are skipped without spending budget.
+    """
+
+    def __init__(self, is_warm, warm, workers, max_queued, budget_per_minute, budget_burst, shared=None):
+        self.is_warm = is_warm
+        self.warm = warm
+        self.workers = workers
+        self.max_queued = max_queued
+        # With shared state the budget holds for all workers together
+        self.budget = TokenBucket(budget_per_minute / 60, budget_burst, shared, 'prefetch:budget')
+        self._queue = deque()
+        self._pending = set()
+        self._active = set()
+        # Recently warmed lookups, to count how many were then actually opened
+        self._warmed = OrderedDict()
+        self._cond = threading.Condition()
+        self._threads = []
+        self.counters = {'submitted': 0, 'duplicates': 0, 'dropped': 0, 'skipped': 0, 'warmed': 0, 'failed': 0, 'used': 0}
+
+    def start(self):
+        """Start the worker threads (once)"""
+        with self._cond:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'prefetch-{len(self._threads)}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, items):
+        """Queue (asin, marketplace) pairs ahead of older ones; returns how many were new"""
+        queued = 0
+        with self._cond:
+            # appendleft in reverse keeps the caller's order at the front of the queue
+            for item in reversed(list(dict.fromkeys(items))):
+                if item in self._pending or item in self._active:
+                    self.counters['duplicates'] += 1
+                    continue
+                self._queue.appendleft(item)
+                self._pending.add(item)
+                queued += 1
+            while len(self._queue) > self.max_queued:
+                self._pending.discard(self._queue.pop())
+                self.counters['dropped'] += 1
+            self.counters['submitted'] += queued
+            self._cond.notify(queued)
+        return queued
+
+    def record_lookup(self, item):
+        """Called for every interactive lookup: drops it from the queue and counts prefetch hits"""
+        with self._cond:
+            if item in self._pending:
+                # The interactive request fetches it right now anyway
+                self._pending.discard(item)
+                self._queue.remove(item)
+            if self._warmed.pop(item, None) is not None:
+                self.counters['used'] += 1
+
+    def _next(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            item = self._queue.popleft()
+            self._pending.discard(item)
+            self._active.add(item)
+            return item
+
+    def _run(self):
+        set_thread_priority(PRIORITY_PREFETCH)
+        while True:
+            item = self._next()
+            outcome = 'failed'
+            try:
+                if self.is_warm(*item):
+                    outcome = 'skipped'
+                else:
+                    # The budget bucket is private to these workers, so its lane does not matter
+                    self.budget.acquire(PRIORITY_INTERACTIVE)
+                    self.warm(*item)
+                    outcome = 'warmed'
+            except Exception as e:
+                logger.warning(f"⚠️ Prefetch of {item[0]} ({item[1]}) failed: {str(e)}")
+            finally:
+                with self._cond:
+                    self._active.discard(item)
+                    self.counters[outcome] += 1
+                    if outcome == 'warmed':
+                        self._warmed[item] = True
+                        while len(self._warmed) > self.max_queued:
+                            self._warmed.popitem(last=False)
+
+    def stats(self):
+        with self._cond:
+            counters = dict(self.counters)
+            counters['queued'] = len(self._queue)
+            counters['active'] = len(self._active)
+        counters['workers'] = len(self._threads)
+        counters['budget_tokens'] = self.budget.stats()['tokens']
+        return counters
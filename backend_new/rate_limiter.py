@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from collections import defaultdict
+
+from sp_api.base.exceptions import SellingApiRequestThrottledException
+
+try:
+    from .metrics import OUTCOME_ERROR, OUTCOME_OK, OUTCOME_THROTTLED, rate_limit_wait, record_sp_api_call
+    from .shared_state import shared_state
+except ImportError:
+    # Fallback for direct execution
+    from metrics import OUTCOME_ERROR, OUTCOME_OK, OUTCOME_THROTTLED, rate_limit_wait, record_sp_api_call
+    from shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# Speculative cache warming; only ever uses capacity nobody else wants (see TokenBucket.acquire)
+PRIORITY_PREFETCH = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk', PRIORITY_PREFETCH: 'prefetch'}
+
+# (requests per second, burst) from the SP-API usage plans for the operations we call.
+# Override with SP_API_RATE_LIMITS='{"getItemOffers": [1, 2]}' if the account has a higher plan.
+SP_API_RATE_LIMITS = {
+    'getCatalogItem': (2, 2),
+    'searchCatalogItems': (2, 2),
+    'getListingsRestrictions': (5, 10),
+    'getItemOffers': (0.5, 1),
+    'getItemOffersBatch': (0.1, 1),
+    'getMyFeesEstimates': (0.5, 1),
+}
+SP_API_RATE_LIMITS.update({op: tuple(limit) for op, limit in json.loads(os.environ.get('SP_API_RATE_LIMITS', '{}')).items()})
+
+THROTTLE_MAX_RETRIES = int(os.environ.get('SP_API_THROTTLE_MAX_RETRIES', 4))
+THROTTLE_BASE_BACKOFF = float(os.environ.get('SP_API_THROTTLE_BASE_BACKOFF', 1.0))
+
+# Lane of the current thread. Worker pools set it once through their initializer, so the
+# priority follows the work without threading it through every function call.
+_thread_lane = threading.local()
+
+def set_thread_priority(priority):
+    _thread_lane.priority = priority
+
+def current_priority():
+    return getattr(_thread_lane, 'priority', PRIORITY_INTERACTIVE)
+
+class TokenBucket:
+    """
+    Token bucket whose waiters are served by (priority, arrival order).
+
+    With a shared backend the tokens themselves live there, so all workers draw from one
+    bucket; priority order then holds among the waiters of each process. The round trip to
+    the backend is made with the condition released, so a slow backend never holds up
+    stats(), drain() or callers arriving at the bucket.
+    """
+
+    def __init__(self, rate, burst, shared=None, shared_key=None):
+        self.rate = rate
+        self.burst = burst
+        self.shared = shared
+        self.shared_key = shared_key
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        # Calls that took a free token without queueing, see try_acquire()
+        self.spare_calls = 0
+        self.wait_total = defaultdict(float)
+        self.wait_max = defaultdict(float)
+        self.acquired = defaultdict(int)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self, needed):
+        """
+        Take a token if `needed` are available and return 0, else the seconds until they will be.
+        Called holding _cond, which is released around the shared backend round trip.
+        """
+        if self.shared is not None:
+            rate, burst = self.rate, self.burst
+            self._cond.release()
+            try:
+                wait = self.shared.take_token(self.shared_key, rate, burst, needed)
+            finally:
+                self._cond.acquire()
+            # None means the shared backend is down; count locally until it is back
+            if wait is not None:
+                return wait
+        self._refill()
+        if self.tokens >= needed:
+            self.tokens -= 1
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def acquire(self, priority):
+        """Block until a token is available for this caller; returns seconds waited"""
+        started = time.monotonic()
+        # Prefetch waits for a full bucket, i.e. one that has sat idle long enough to refill, so the
+        # token it takes is spare capacity rather than one an interactive call was about to need
+        needed = self.burst if priority >= PRIORITY_PREFETCH else 1
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    if self._waiters[0] == ticket:
+                        wait = self._take(needed)
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            self.calls += 1
+            self.acquired[priority] += 1
+            self.wait_total[priority] += waited
+            self.wait_max[priority] = max(self.wait_max[priority], waited)
+            return waited
+
+    def try_acquire(self, priority):
+        """Take a token only if one is free right now and nobody is queued for it; True if taken"""
+        with self._cond:
+            if self._waiters or self._take(1) > 0:
+                return False
+            self.calls += 1
+            self.spare_calls += 1
+            self.acquired[priority] += 1
+            return True
+
+    def drain(self):
+        """Empty the bucket after a 429 so queued callers back off too"""
+        with self._cond:
+            self._refill()
+            self.tokens = 0.0
+            self.throttled += 1
+        if self.shared is not None:
+            self.shared.drain(self.shared_key)
+
+    def record_retry(self):
+        with self._cond:
+            self.retries += 1
+
+    def set_rate(self, rate):
+        with self._cond:
+            if rate > 0 and rate != self.rate:
+                self._refill()
+                self.rate = rate
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            self._refill()
+            queued = defaultdict(int)
+            for priority, _ in self._waiters:
+                queued[PRIORITY_NAMES.get(priority, priority)] += 1
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': round(self.tokens, 2),
+                'shared': self.shared is not None,
+                'queued': dict(queued),
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'retries': self.retries,
+                'spare_calls': self.spare_calls,
+                'avg_wait': {PRIORITY_NAMES.get(p, p): round(self.wait_total[p] / n, 3) for p, n in self.acquired.items() if n},
+                'max_wait': {PRIORITY_NAMES.get(p, p): round(w, 3) for p, w in self.wait_max.items()},
+            }
+
+class RateLimitScheduler:
+    """
+    Central gate for SP-API calls: one token bucket per (operation, region), interactive
+    callers ahead of bulk ones, prefetch only on spare capacity, and jittered exponential
+    backoff when Amazon still throttles.
+    """
+
+    def __init__(self, limits, max_retries, base_backoff, shared=None):
+        self.limits = dict(limits)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.shared = shared
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, operation, region):
+        key = (operation, region)
+        with self._lock:
+            if key not in self._buckets:
+                rate, burst = self.limits.get(operation, (1, 1))
+                self._buckets[key] = TokenBucket(rate, burst, self.shared, f"rate:{operation}:{region}")
+            return self._buckets[key]
+
+    def call(self, operation, region, fn, marketplace=None):
+        """Run fn() once a token is available, retrying throttled (429) calls"""
+        bucket = self.bucket(operation, region)
+        priority = current_priority()
+        marketplace = marketplace or region
+        for attempt in range(self.max_retries + 1):
+            waited = bucket.acquire(priority)
+            rate_limit_wait.observe(waited, operation=operation, marketplace=marketplace, priority=PRIORITY_NAMES.get(priority, priority))
+            started = time.perf_counter()
+            try:
+                response = fn()
+            except SellingApiRequestThrottledException:
+                record_sp_api_call(operation, marketplace, time.perf_counter() - started, waited, OUTCOME_THROTTLED)
+                bucket.drain()
+                if attempt == self.max_retries:
+                    logger.error(f"❌ {operation} ({region}) still throttled after {attempt + 1} attempts")
+                    raise
+                bucket.record_retry()
+                backoff = self.base_backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"⚠️ {operation} ({region}) throttled, retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+                continue
+            except Exception:
+                record_sp_api_call(operation, marketplace, time.perf_counter() - started, waited, OUTCOME_ERROR)
+                raise
+            record_sp_api_call(operation, marketplace, time.perf_counter() - started, waited, OUTCOME_OK)
+
+            # Amazon reports the account's actual rate for the operation, follow it
+            rate_limit = getattr(response, 'rate_limit', None)
+            if rate_limit:
+                try:
+                    bucket.set_rate(float(rate_limit))
+                except ValueError:
+                    pass
+            return response
+
+    def try_call(self, operation, region, fn, marketplace=None):
+        """
+        Run fn() only if a token is free right now, without queueing or retrying; None if it was
+        not sent. For hedged duplicates, which must never delay or throttle the calls they copy.
+        """
+        bucket = self.bucket(operation, region)
+        marketplace = marketplace or region
+        if not bucket.try_acquire(current_priority()):
+            return None
+        started = time.perf_counter()
+        try:
+            response = fn()
+        except SellingApiRequestThrottledException:
+            record_sp_api_call(operation, marketplace, time.perf_counter() - started, 0, OUTCOME_THROTTLED)
+            bucket.drain()
+            raise
+        except Exception:
+            record_sp_api_call(operation, marketplace, time.perf_counter() - started, 0, OUTCOME_ERROR)
+            raise
+        record_sp_api_call(operation, marketplace, time.perf_counter() - started, 0, OUTCOME_OK)
+        return response
+
+    def stats(self):
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {f"{operation}:{region}": bucket.stats() for (operation, region), bucket in buckets.items()}
+
+# With SHARED_STATE_URL set, the buckets are shared by all workers, so adding workers does not
+# multiply the request rate sent to Amazon
+rate_scheduler = RateLimitScheduler(SP_API_RATE_LIMITS, THROTTLE_MAX_RETRIES, THROTTLE_BASE_BACKOFF, shared=shared_state)
@@ -0,0 +1,192 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Time-to-live in seconds for each kind of product data. Catalog fields almost never change,
+# restrictions change occasionally, offers/buybox go stale within minutes. Fees are keyed by
+# price, so they can be kept as long as the fee schedule is stable; the per-ASIN fee profiles
+# learned from them (see fee_model.py) likewise.
+CACHE_TTLS = {
+    'catalog': int(os.environ.get('CACHE_TTL_CATALOG', 24 * 3600)),
+    'restrictions': int(os.environ.get('CACHE_TTL_RESTRICTIONS', 3600)),
+    'offers': int(os.environ.get('CACHE_TTL_OFFERS', 300)),
+    'fees': int(os.environ.get('CACHE_TTL_FEES', 6 * 3600)),
+    'fee_profile': int(os.environ.get('CACHE_TTL_FEE_PROFILE', 24 * 3600)),
+}
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 20000))
+
+class TieredCache:
+    """
+    In-process LRU cache with a separate TTL per kind of data and single-flight loading.
+
+    Keys are (kind, key) pairs, e.g. ('offers', ('B000123', 'US')). Concurrent get_or_load()
+    calls for the same missing key share one loader call; loader exceptions are propagated
+    to every waiter and are never cached.
+
+    With stores attached (the on-disk snapshot store, the cross-worker shared state), memory
+    misses are looked up in them, in attach order, before the loader runs, and loaded values
+    are written through to all of them. Values built up from several writes go through
+    update(), which every store applies atomically, so writes from other workers are merged
+    rather than overwritten.
+    """
+
+    def __init__(self, ttls, max_entries):
+        self.ttls = dict(ttls)
+        self.max_entries = max_entries
+        self.stores = []
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        # Serializes update() in this process; stores make it atomic across workers
+        self._update_lock = threading.Lock()
+        self._counters = defaultdict(lambda: {'hits': 0, 'store_hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0})
+
+    def attach_store(self, store):
+        self.stores.append(store)
+
+    def get(self, kind, key):
+        """Return the cached value or None, counting a hit or miss"""
+        with self._lock:
+            value = self._lookup(kind, key)
+            if value is not None:
+                self._counters[kind]['hits'] += 1
+                return value
+
+        value = self._load_from_store(kind, key)
+        with self._lock:
+            self._counters[kind]['store_hits' if value is not None else 'misses'] += 1
+        return value
+
+    def peek(self, kind, key):
+        """Like get(), but not counted as a hit or miss; for background work checking what is cached"""
+        with self._lock:
+            value = self._lookup(kind, key)
+        return value if value is not None else self._load_from_store(kind, key)
+
+    def set(self, kind, key, value):
+        with self._lock:
+            self._store(kind, key, value)
+        for store in self.stores:
+            store.set(kind, key, value)
+
+    def update(self, kind, key, fn):
+        """
+        Replace a value with fn(current value or None) and return the new one; not counted as a
+        hit or miss. fn may be called more than once (once per store, and again on a conflict).
+        """
+        with self._update_lock:
+            with self._lock:
+                current = self._lookup(kind, key)
+            value = None
+            for store in self.stores:
+                stored = store.update(kind, key, fn, self.ttls.get(kind, 0))
+                # The first store's value is the one kept in memory; None means that store failed
+                value = stored if value is None else value
+            if value is None:
+                value = fn(current)
+            with self._lock:
+                self._store(kind, key, value)
+        return value
+
+    def get_or_load(self, kind, key, loader):
+        """Return the cached value, or call loader() once for all concurrent callers and cache it"""
+        cache_key = (kind, key)
+        with self._lock:
+            value = self._lookup(kind, key)
+            if value is not None:
+                self._counters[kind]['hits'] += 1
+                return value
+
+            future = self._inflight.get(cache_key)
+            if future is not None:
+                self._counters[kind]['coalesced'] += 1
+                owner = False
+            else:
+                self._counters[kind]['misses'] += 1
+                future = self._inflight[cache_key] = Future()
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = self._load_from_store(kind, key)
+            loaded = value is None
+            if loaded:
+                value = loader()
+                if value is not None:
+                    for store in self.stores:
+                        store.set(kind, key, value)
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(cache_key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if not loaded:
+                # Counted as a miss above; it was answered locally after all
+                self._counters[kind]['misses'] -= 1
+                self._counters[kind]['store_hits'] += 1
+            elif value is not None:
+                self._store(kind, key, value)
+            self._inflight.pop(cache_key, None)
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            kinds = {}
+            for kind in self.ttls:
+                counters = dict(self._counters[kind])
+                lookups = counters['hits'] + counters['store_hits'] + counters['misses'] + counters['coalesced']
+                counters['hit_rate'] = round((counters['hits'] + counters['store_hits']) / lookups, 3) if lookups else None
+                counters['ttl'] = self.ttls[kind]
+                kinds[kind] = counters
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'kinds': kinds}
+
+    def _load_from_store(self, kind, key):
+        """Value from the first store that has it fresh, also put back into memory"""
+        for store in self.stores:
+            snapshot = store.get(kind, key, self.ttls.get(kind, 0))
+            if snapshot is not None:
+                break
+        else:
+            return None
+        value, fetched_at = snapshot
+        with self._lock:
+            # Keep the snapshot's own age, so it expires when it would have in memory
+            self._store(kind, key, value, expires_at=fetched_at + self.ttls.get(kind, 0))
+        return value
+
+    # Callers must hold self._lock
+    def _lookup(self, kind, key):
+        cache_key = (kind, key)
+        entry = self._entries.get(cache_key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[cache_key]
+            return None
+        self._entries.move_to_end(cache_key)
+        return value
+
+    def _store(self, kind, key, value, expires_at=None):
+        cache_key = (kind, key)
+        self._entries[cache_key] = (value, expires_at or time.time() + self.ttls.get(kind, 0))
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_entries:
+            (evicted_kind, _), _ = self._entries.popitem(last=False)
+            self._counters[evicted_kind]['evictions'] += 1
+
+response_cache = TieredCache(CACHE_TTLS, CACHE_MAX_ENTRIES)
@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Where gunicorn workers (and hosts) share access tokens, rate-limit buckets, cached product
+# data and the BSR tables. Unset keeps all of it per process.
+#   redis://host:6379/0         any Redis-compatible server, shared across hosts (needs the redis package)
+#   sqlite:///run/fastchecker.db  a SQLite file, shared by the workers of one host
+SHARED_STATE_URL = os.environ.get('SHARED_STATE_URL', '')
+# Prefix for every key, so several deployments can share one Redis database
+SHARED_STATE_PREFIX = os.environ.get('SHARED_STATE_PREFIX', 'fastchecker:')
+# After a failed call the backend is skipped for this long and process-local state is used
+SHARED_STATE_RETRY = float(os.environ.get('SHARED_STATE_RETRY', 30))
+# SQLite has no key expiry; expired rows are deleted by a write at most this often
+SHARED_STATE_PRUNE_INTERVAL = float(os.environ.get('SHARED_STATE_PRUNE_INTERVAL', 300))
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# Token bucket step, run atomically in Redis. Returns the seconds to wait as a string (Lua
+# numbers are truncated to integers on the way out), '0' when a token was taken.
+REDIS_TAKE_TOKEN = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate, burst, needed = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= needed then
+    tokens = tokens - 1
+else
+    wait = (needed - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 2000) + 60000)
+return tostring(wait)
+"""
+
+class SharedStateBackend:
+    """
+    Small key-value and token-bucket store shared by all workers. Every public call is guarded:
+    when the backend fails it is skipped for SHARED_STATE_RETRY seconds and callers get the
+    default back, so they fall back to their process-local state instead of failing requests.
+    """
+
+    # 'host' if only the workers of one machine can share it, 'cluster' if any host can
+    scope = 'host'
+
+    def __init__(self, url):
+        self.url = url
+        self._down_until = 0
+        self.failures = 0
+
+    def _guarded(self, fn, *args, default=None):
+        if time.time() < self._down_until:
+            return default
+        try:
+            return fn(*args)
+        except Exception as e:
+            self.failures += 1
+            self._down_until = time.time() + SHARED_STATE_RETRY
+            logger.warning(f"⚠️ Shared state unavailable, using process-local state for {SHARED_STATE_RETRY:g}s: {str(e)}")
+            return default
+
+    def get(self, key):
+        """JSON value stored under key, or None if missing, expired or the backend is down"""
+        return self._guarded(self._get, SHARED_STATE_PREFIX + key)
+
+    def set(self, key, value, ttl=None):
+        self._guarded(self._set, SHARED_STATE_PREFIX + key, json.dumps(value), ttl)
+
+    def add(self, key, value, ttl):
+        """Set key only if it is absent; True if set, False if present, None if the backend is down"""
+        return self._guarded(self._add, SHARED_STATE_PREFIX + key, json.dumps(value), ttl)
+
+    def update(self, key, fn, ttl=None):
+        """
+        Atomically replace the value under key with fn(current value or None), which may be called
+        more than once; returns the new value, or None if the backend is down
+        """
+        return self._guarded(self._update, SHARED_STATE_PREFIX + key, fn, ttl)
+
+    def delete(self, key):
+        self._guarded(self._delete, SHARED_STATE_PREFIX + key)
+
+    def take_token(self, key, rate, burst, needed=1):
+        """
+        One step of a shared token bucket: take a token if at least `needed` are available and
+        return 0, else return the seconds until there will be. None if the backend is down.
+        """
+        return self._guarded(self._take_token, SHARED_STATE_PREFIX + key, rate, burst, needed)
+
+    def drain(self, key):
+        """Empty a shared bucket after a 429, so every worker backs off"""
+        self._guarded(self._drain, SHARED_STATE_PREFIX + key)
+
+    def stats(self):
+        return {'backend': type(self).__name__, 'scope': self.scope, 'failures': self.failures, 'available': time.time() >= self._down_until}
+
+class SqliteSharedState(SharedStateBackend):
+    """Shared state in a SQLite file (WAL), for the workers of a single host"""
+
+    def __init__(self, url, path):
+        super().__init__(url)
+        self.path = path
+        self._local = threading.local()
+        self._next_prune = 0
+        self._prune_lock = threading.Lock()
+        self._connection().executescript(SQLITE_SCHEMA)
+        self._prune_if_due()
+
+    def _connection(self):
+        # sqlite3 connections must stay on the thread that created them
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _prune_if_due(self):
+        """Delete expired keys, at most every SHARED_STATE_PRUNE_INTERVAL; reads already ignore them"""
+        with self._prune_lock:
+            if time.time() < self._next_prune:
+                return
+            # Claimed before pruning, so concurrent writers do not all prune at once
+            self._next_prune = time.time() + SHARED_STATE_PRUNE_INTERVAL
+        pruned = self._connection().execute('DELETE FROM kv WHERE expires_at <= ?', (time.time(),)).rowcount
+        if pruned:
+            logger.info(f"🧹 Pruned {pruned} expired shared state keys")
+
+    def _get(self, key):
+        row = self._connection().execute('SELECT value, expires_at FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def _set(self, key, value, ttl):
+        self._connection().execute('INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)', (key, value, time.time() + ttl if ttl else None))
+        self._prune_if_due()
+
+    def _add(self, key, value, ttl):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM kv WHERE key = ? AND expires_at <= ?', (key, time.time()))
+            added = connection.execute('INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)', (key, value, time.time() + ttl)).rowcount == 1
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self._prune_if_due()
+        return added
+
+    def _update(self, key, fn, ttl):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT value, expires_at FROM kv WHERE key = ?', (key,)).fetchone()
+            current = json.loads(row[0]) if row is not None and (row[1] is None or row[1] > time.time()) else None
+            value = fn(current)
+            connection.execute('INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)', (key, json.dumps(value), time.time() + ttl if ttl else None))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self._prune_if_due()
+        return value
+
+    def _delete(self, key):
+        self._connection().execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def _take_token(self, key, rate, burst, needed):
+        connection = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so the read-refill-write is atomic across processes
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(now - updated, 0) * rate)
+            wait = 0.0
+            if tokens >= needed:
+                tokens -= 1
+            else:
+                wait = (needed - tokens) / rate
+            connection.execute('INSERT OR REPLACE INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def _drain(self, key):
+        self._connection().execute('INSERT OR REPLACE INTO rate_buckets (key, tokens, updated) VALUES (?, 0, ?)', (key, time.time()))
+
+class RedisSharedState(SharedStateBackend):
+    """Shared state on a Redis-compatible server, for workers on any number of hosts"""
+
+    scope = 'cluster'
+
+    def __init__(self, url):
+        super().__init__(url)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SHARED_STATE_URL points at Redis, but the 'redis' package is not installed (pip install redis)")
+        self.client = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2, health_check_interval=30)
+        self.client.ping()
+        self._watch_error = redis.WatchError
+        self._take_token_script = self.client.register_script(REDIS_TAKE_TOKEN)
+
+    def _get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def _set(self, key, value, ttl):
+        self.client.set(key, value, ex=int(ttl) if ttl else None)
+
+    def _add(self, key, value, ttl):
+        return bool(self.client.set(key, value, ex=int(ttl), nx=True))
+
+    def _update(self, key, fn, ttl):
+        # Optimistic transaction: if another worker changes the key before EXEC, read and merge again
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(key)
+                    current = pipe.get(key)
+                    value = fn(json.loads(current) if current is not None else None)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+                    pipe.execute()
+                    return value
+                except self._watch_error:
+                    continue
+
+    def _delete(self, key):
+        self.client.delete(key)
+
+    def _take_token(self, key, rate, burst, needed):
+        return float(self._take_token_script(keys=[key], args=[rate, burst, needed]))
+
+    def _drain(self, key):
+        self.client.hset(key, mapping={'tokens': 0, 'updated': time.time()})
+
+def open_shared_state(url=SHARED_STATE_URL):
+    """Backend for a SHARED_STATE_URL, or None (process-local state) if unset or unusable"""
+    if not url:
+        return None
+    try:
+        if url.startswith(('redis://', 'rediss://', 'unix://')):
+            backend = RedisSharedState(url)
+        elif url.startswith('sqlite://'):
+            backend = SqliteSharedState(url, url[len('sqlite://'):])
+        else:
+            raise ValueError(f"Unsupported SHARED_STATE_URL scheme: {url.split(':', 1)[0]}")
+    except Exception as e:
+        logger.error(f"❌ Could not open shared state {url}, keeping state per process: {str(e)}")
+        return None
+    logger.info(f"✅ Shared state: {type(backend).__name__} ({backend.scope})")
+    return backend
+
+class SharedResponseStore:
+    """
+    Response cache tier on the shared backend, with the same interface as the product snapshot
+    store: values are kept for the kind's TTL and returned with their fetch time.
+    """
+
+    def __init__(self, shared, ttls):
+        self.shared = shared
+        self.ttls = dict(ttls)
+
+    @staticmethod
+    def _key(kind, key):
+        return f"cache:{kind}:{json.dumps(key)}"
+
+    def get(self, kind, key, max_age):
+        entry = self.shared.get(self._key(kind, key))
+        if entry is None or time.time() - entry['fetchedAt'] >= max_age:
+            return None
+        return entry['value'], entry['fetchedAt']
+
+    def set(self, kind, key, value):
+        self.shared.set(self._key(kind, key), {'value': value, 'fetchedAt': time.time()}, ttl=self.ttls.get(kind))
+
+    def update(self, kind, key, fn, max_age):
+        def merge(entry):
+            current = entry['value'] if entry is not None and time.time() - entry['fetchedAt'] < max_age else None
+            return {'value': fn(current), 'fetchedAt': time.time()}
+
+        entry = self.shared.update(self._key(kind, key), merge, ttl=self.ttls.get(kind))
+        return entry['value'] if entry is not None else None
+
+shared_state = open_shared_state()
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Price/buybox history rows older than this are pruned
+PRICE_HISTORY_DAYS = int(os.environ.get('PRICE_HISTORY_DAYS', 180))
+# Snapshots past their kind's TTL and old history rows are pruned at startup and then at most
+# this often, by whichever write comes first
+SNAPSHOT_PRUNE_INTERVAL = int(os.environ.get('SNAPSHOT_PRUNE_INTERVAL', 3600))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    variant TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (asin, marketplace, kind, variant)
+);
+CREATE TABLE IF NOT EXISTS price_history (
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    observed_at REAL NOT NULL,
+    buybox_price REAL,
+    currency TEXT,
+    buybox_is_fba INTEGER,
+    lowest_fba_price REAL,
+    lowest_fbm_price REAL,
+    offer_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS price_history_asin ON price_history (asin, marketplace, observed_at);
+"""
+
+def split_key(key):
+    """(asin, marketplace, *rest) cache key -> (asin, marketplace, variant)"""
+    asin, marketplace, *rest = key
+    return asin, marketplace, json.dumps(rest) if rest else ''
+
+def history_row(offers_data):
+    """Buybox and lowest FBA/FBM prices from a processed offers result"""
+    offers = offers_data.get('offers') or []
+    lowest_fba = lowest_fbm = None
+    buybox_is_fba = None
+    # Offers are sorted by landed price, so the first of each kind is the lowest
+    for offer in offers:
+        price = offer.get('ListingPrice', {}).get('Amount')
+        if offer.get('IsFulfilledByAmazon'):
+            lowest_fba = price if lowest_fba is None else lowest_fba
+        else:
+            lowest_fbm = price if lowest_fbm is None else lowest_fbm
+        if offer.get('IsBuyBoxWinner'):
+            buybox_is_fba = int(bool(offer.get('IsFulfilledByAmazon')))
+    return offers_data.get('buyboxPrice'), offers_data.get('currencyCode'), buybox_is_fba, lowest_fba, lowest_fbm, len(offers)
+
+class ProductSnapshotStore:
+    """
+    SQLite store of the last known value of each kind of product data (catalog, restrictions,
+    offers, fees) per ASIN and marketplace, each with its own fetch time, plus an append-only
+    price/buybox history. Backs the in-memory response cache, so data survives restarts and
+    only the kinds that have gone stale are fetched from SP-API again.
+
+    Snapshots are kept for the same TTL per kind (`ttls`) that they are served for; older ones
+    could never be served again and are pruned.
+    """
+
+    def __init__(self, path, ttls):
+        self.path = path
+        self.ttls = dict(ttls)
+        self._local = threading.local()
+        self._next_prune = time.time() + SNAPSHOT_PRUNE_INTERVAL
+        self._prune_lock = threading.Lock()
+        self._ensure_schema()
+
+    def _connection(self):
+        # sqlite3 connections must stay on the thread that created them
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _ensure_schema(self):
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+        snapshots, history = self.prune()
+        logger.info(f"✅ Product snapshot store ready at {self.path} (pruned {snapshots} stale snapshots, {history} old price history rows)")
+
+    def prune(self):
+        """Delete snapshots past their kind's TTL and old price history; returns (snapshots, history rows) deleted"""
+        now = time.time()
+        connection = self._connection()
+        snapshots = 0
+        for kind, ttl in self.ttls.items():
+            snapshots += connection.execute('DELETE FROM snapshots WHERE kind = ? AND fetched_at < ?', (kind, now - ttl)).rowcount
+        history = connection.execute('DELETE FROM price_history WHERE observed_at < ?', (now - PRICE_HISTORY_DAYS * 86400,)).rowcount
+        return snapshots, history
+
+    def _prune_if_due(self):
+        with self._prune_lock:
+            if time.time() < self._next_prune:
+                return
+            # Claimed before pruning, so concurrent writers do not all prune at once
+            self._next_prune = time.time() + SNAPSHOT_PRUNE_INTERVAL
+        snapshots, history = self.prune()
+        if snapshots or history:
+            logger.info(f"🧹 Pruned {snapshots} stale snapshots and {history} old price history rows")
+
+    def get(self, kind, key, max_age):
+        """Return (value, fetched_at) if a snapshot younger than max_age exists, else None"""
+        asin, marketplace, variant = split_key(key)
+        try:
+            row = self._connection().execute(
+                'SELECT data, fetched_at FROM snapshots WHERE asin = ? AND marketplace = ? AND kind = ? AND variant = ?',
+                (asin, marketplace, kind, variant)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Snapshot read failed for {kind} {key}: {str(e)}")
+            return None
+        if row is None or time.time() - row[1] >= max_age:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, kind, key, value):
+        asin, marketplace, variant = split_key(key)
+        now = time.time()
+        try:
+            connection = self._connection()
+            connection.execute(
+                'INSERT OR REPLACE INTO snapshots (asin, marketplace, kind, variant, data, fetched_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (asin, marketplace, kind, variant, json.dumps(value), now))
+            if kind == 'offers':
+                connection.execute(
+                    'INSERT INTO price_history (asin, marketplace, observed_at, buybox_price, currency, buybox_is_fba, lowest_fba_price, lowest_fbm_price, offer_count) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (asin, marketplace, now, *history_row(value)))
+            self._prune_if_due()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Snapshot write failed for {kind} {key}: {str(e)}")
+
+    def update(self, kind, key, fn, max_age):
+        """
+        Replace a snapshot with fn(current value or None) in one write transaction, so workers
+        updating it at the same time do not overwrite each other; the new value, or None on failure
+        """
+        asin, marketplace, variant = split_key(key)
+        try:
+            connection = self._connection()
+            # BEGIN IMMEDIATE takes the write lock up front, so the read-modify-write is atomic across processes
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute(
+                    'SELECT data, fetched_at FROM snapshots WHERE asin = ? AND marketplace = ? AND kind = ? AND variant = ?',
+                    (asin, marketplace, kind, variant)).fetchone()
+                value = fn(json.loads(row[0]) if row and time.time() - row[1] < max_age else None)
+                connection.execute(
+                    'INSERT OR REPLACE INTO snapshots (asin, marketplace, kind, variant, data, fetched_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (asin, marketplace, kind, variant, json.dumps(value), time.time()))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            self._prune_if_due()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Snapshot update failed for {kind} {key}: {str(e)}")
+            return None
+        return value
+
+    def price_history(self, asin, marketplace, since):
+        rows = self._connection().execute(
+            'SELECT observed_at, buybox_price, currency, buybox_is_fba, lowest_fba_price, lowest_fbm_price, offer_count FROM price_history '
+            'WHERE asin = ? AND marketplace = ? AND observed_at >= ? ORDER BY observed_at',
+            (asin, marketplace, since)).fetchall()
+        return [{
+            'observedAt': observed_at,
+            'buyboxPrice': buybox_price,
+            'currency': currency,
+            'buyboxIsFba': None if buybox_is_fba is None else bool(buybox_is_fba),
+            'lowestFbaPrice': lowest_fba,
+            'lowestFbmPrice': lowest_fbm,
+            'offerCount': offer_count,
+        } for observed_at, buybox_price, currency, buybox_is_fba, lowest_fba, lowest_fbm, offer_count in rows]
+
+    def stats(self):
+        try:
+            connection = self._connection()
+            kinds = dict(connection.execute('SELECT kind, COUNT(*) FROM snapshots GROUP BY kind').fetchall())
+            history = connection.execute('SELECT COUNT(*) FROM price_history').fetchone()[0]
+        except sqlite3.Error as e:
+            return {'path': self.path, 'error': str(e)}
+        return {'path': self.path, 'snapshots': kinds, 'price_history_rows': history}
@@ -0,0 +1,155 @@
+import os
+import time
+import logging
+import threading
+from collections import namedtuple
+
+import requests
+import sp_api.base.client as sp_api_client
+from requests.adapters import HTTPAdapter
+from sp_api.api import CatalogItems, CatalogItemsVersion, ListingsRestrictions, Products, ProductFees
+from sp_api.auth import AccessTokenClient, AccessTokenResponse
+from sp_api.auth.exceptions import AuthorizationError
+
+try:
+    from .shared_state import shared_state
+except ImportError:
+    # Fallback for direct execution
+    from shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Refresh the LWA token this many seconds before Amazon says it expires
+TOKEN_REFRESH_MARGIN = int(os.environ.get('SP_API_TOKEN_REFRESH_MARGIN', 300))
+HTTP_POOL_SIZE = int(os.environ.get('SP_API_HTTP_POOL_SIZE', 4))
+# Connect and read timeouts in seconds for every SP-API and LWA call. Requests stop waiting at
+# their deadline anyway (see REQUEST_DEADLINE_MS); this bounds how long a hung call keeps its
+# worker thread busy in the background.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('SP_API_HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('SP_API_HTTP_READ_TIMEOUT', 15))
+# Send SP-API and LWA token calls to another host instead of Amazon, e.g. the local
+# stand-in in bench/fake_sp_api.py
+SP_API_ENDPOINT = os.environ.get('SP_API_ENDPOINT')
+LWA_TOKEN_URL = os.environ.get('SP_API_LWA_URL')
+
+# catalog_search uses the 2022-04-01 Catalog API, which can search up to 20 ASINs per call
+SPApis = namedtuple('SPApis', ['catalog', 'catalog_search', 'restrictions', 'products', 'fees'])
+
+# --- Keep-alive HTTP Sessions ---
+# requests.Session is not documented as thread-safe, so every worker thread gets its own
+# session. Worker threads are long-lived (see sp_api_executor), so connections are reused.
+_thread_local = threading.local()
+
+def get_http_session():
+    """Return this thread's keep-alive session"""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _thread_local.session = session
+    return session
+
+def _session_request(method, url, **kwargs):
+    return get_http_session().request(method, url, **kwargs)
+
+def install_pooled_sessions():
+    """
+    Route SP-API calls through the per-thread keep-alive sessions. The sp_api Client calls the
+    module-level requests.request() for every call, which opens a fresh connection (and TLS
+    handshake) each time. Called once from the app's startup code.
+    """
+    sp_api_client.request = _session_request
+
+# --- Shared LWA Access Tokens ---
+# Tokens are cached per process and, with SHARED_STATE_URL set, for all workers, so scaling out
+# does not multiply token exchanges
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+_token_locks = {}
+
+def _token_lock(cache_key):
+    with _token_cache_lock:
+        return _token_locks.setdefault(cache_key, threading.Lock())
+
+class PooledAccessTokenClient(AccessTokenClient):
+    """AccessTokenClient that shares one token per refresh token and renews it before expiry"""
+
+    def _request(self, url, data, headers):
+        response = get_http_session().post(url, data=data, headers=headers, proxies=self.proxies, verify=self.verify, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        response_data = response.json()
+        if response.status_code != 200:
+            raise AuthorizationError(response_data.get('error'), response_data.get('error_description'), response.status_code)
+        return response_data
+
+    def get_auth(self) -> AccessTokenResponse:
+        cache_key = self._get_cache_key()
+        entry = _token_cache.get(cache_key)
+        if entry and entry[1] > time.time():
+            return AccessTokenResponse(**entry[0])
+
+        # Only one thread exchanges the refresh token; the others wait and reuse its result
+        with _token_lock(cache_key):
+            entry = _token_cache.get(cache_key)
+            if entry and entry[1] > time.time():
+                return AccessTokenResponse(**entry[0])
+
+            # Another worker may have exchanged the refresh token already
+            entry = shared_state.get(f"lwa:{cache_key}") if shared_state else None
+            if entry and entry[1] > time.time():
+                _token_cache[cache_key] = tuple(entry)
+                return AccessTokenResponse(**entry[0])
+
+            request_url = LWA_TOKEN_URL or self.scheme + self.host + self.path
+            access_token = self._request(request_url, self.data, self.headers)
+            expires_in = int(access_token.get('expires_in') or 3600)
+            _token_cache[cache_key] = (access_token, time.time() + max(expires_in - TOKEN_REFRESH_MARGIN, 0))
+            if shared_state:
+                shared_state.set(f"lwa:{cache_key}", _token_cache[cache_key], ttl=max(expires_in - TOKEN_REFRESH_MARGIN, 1))
+            logger.info(f"🔑 LWA access token refreshed (expires in {expires_in}s)")
+            return AccessTokenResponse(**access_token)
+
+# --- Client Registry ---
+class SPClientRegistry:
+    """
+    Process-wide registry of SP-API client objects keyed by (region, marketplace).
+
+    The sp_api clients store per-call state on the instance, so each thread keeps its own
+    set. The access token is shared process-wide and each thread reuses its keep-alive session.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def get(self, region, marketplace, credentials) -> SPApis:
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+
+        key = (region, marketplace.name)
+        apis = clients.get(key)
+        if apis is None:
+            options = dict(credentials=credentials, marketplace=marketplace, auth_token_client_class=PooledAccessTokenClient, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+            apis = SPApis(
+                catalog=CatalogItems(**options),
+                catalog_search=CatalogItems(version=CatalogItemsVersion.V_2022_04_01, **options),
+                restrictions=ListingsRestrictions(**options),
+                products=Products(**options),
+                fees=ProductFees(**options),
+            )
+            if SP_API_ENDPOINT:
+                for client in apis:
+                    client.endpoint = SP_API_ENDPOINT.rstrip('/')
+            clients[key] = apis
+            with self._lock:
+                self._created += 1
+            logger.info(f"✅ SP-API clients created for {region}/{marketplace.name}")
+        return apis
+
+    def stats(self):
+        return {'client_sets_created': self._created, 'cached_tokens': len(_token_cache)}
+
+sp_client_registry = SPClientRegistry()
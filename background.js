@@ -158,30 +158,74 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     // 4. EU MARKET FİYATLARI İSTEĞİ
     if (request.action === 'fetchEuMarketPrices' && request.asin) {
         const tabId = sender.tab.id;
-        asinToTabIdMap[request.asin] = tabId;
-
-        connectPriceTrackerWebSocket();
         const markets = request.markets || ['DE', 'FR', 'IT', 'ES', 'NL'];
-        const message = {
-            type: "/eu-market-request",
-            asin: request.asin,
-            markets: markets
-        };
 
-        if (priceTrackerWs && priceTrackerWs.readyState === WebSocket.OPEN) {
-            priceTrackerWs.send(JSON.stringify(message));
-            sendResponse({ success: true });
-        } else {
-            priceTrackerMessageQueue.push(message);
-            if (!priceTrackerWs || priceTrackerWs.readyState === WebSocket.CLOSED) {
-                connectPriceTrackerWebSocket();
-            }
-            sendResponse({ success: false, error: 'EU Price WebSocket bağlantısı yok veya kuruluyor.' });
-        }
+        // Önce backend'in paralel fiyat karşılaştırmasını dene, başarısız olursa WebSocket servisine düş
+        fetch(`https://web-production-e38b7.up.railway.app/compare_prices/${request.asin}?marketplaces=${markets.join(',')}`)
+            .then(response => {
+                if (!response.ok) {
+                    return response.json().then(errorData => {
+                        throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+                    });
+                }
+                return response.json();
+            })
+            .then(data => {
+                // Backend'de EU kimlik bilgileri yoksa 200 ile boş liste döner; o durumda da WebSocket'e düş
+                if (!data.prices || data.prices.length === 0) {
+                    const reasons = (data.unavailable || []).map(u => `${u.market}: ${u.error}`).join(', ');
+                    throw new Error(`Backend fiyat döndürmedi${reasons ? ` (${reasons})` : ''}`);
+                }
+                chrome.tabs.sendMessage(tabId, {
+                    action: 'euMarketPrices',
+                    asin: request.asin,
+                    prices: data.prices
+                });
+                sendResponse({ success: true });
+            })
+            .catch(e => {
+                console.warn('BACKGROUND: Backend fiyat karşılaştırması başarısız, WebSocket deneniyor:', e.message);
+                requestEuMarketPricesViaWebSocket(request.asin, markets, tabId, sendResponse);
+            });
+        return true;
+    }
+
+    // 5. ÖN YÜKLEME: kullanıcının yakında açacağı ASIN'leri backend önbelleğine ısıt
+    if (request.action === 'prefetchAsins' && Array.isArray(request.asins) && request.asins.length) {
+        fetch('https://web-production-e38b7.up.railway.app/prefetch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ marketplace: request.marketplace, asins: request.asins.slice(0, 100) })
+        })
+            .then(response => sendResponse({ success: response.ok }))
+            .catch(e => sendResponse({ success: false, error: e.message }));
         return true;
     }
 });
 
+// --- EU MARKET FİYATLARI (WEBSOCKET YEDEĞİ) ---
+function requestEuMarketPricesViaWebSocket(asin, markets, tabId, sendResponse) {
+    asinToTabIdMap[asin] = tabId;
+
+    connectPriceTrackerWebSocket();
+    const message = {
+        type: "/eu-market-request",
+        asin: asin,
+        markets: markets
+    };
+
+    if (priceTrackerWs && priceTrackerWs.readyState === WebSocket.OPEN) {
+        priceTrackerWs.send(JSON.stringify(message));
+        sendResponse({ success: true });
+    } else {
+        priceTrackerMessageQueue.push(message);
+        if (!priceTrackerWs || priceTrackerWs.readyState === WebSocket.CLOSED) {
+            connectPriceTrackerWebSocket();
+        }
+        sendResponse({ success: false, error: 'EU Price WebSocket bağlantısı yok veya kuruluyor.' });
+    }
+}
+
 // --- render websocket --- (Orijinal fonksiyon, dokunulmadı)
 async function handleAsinCheck(data, sendResponse) {
     try {
@@ -313,24 +313,31 @@ function truncateTitle(title, maxLength = 50) {
     return title.substr(0, title.lastIndexOf(' ', maxLength)) + '...';
 }
 
-function updateUI(container, data, error = null) {
-    const mainView = container.querySelector('#fc-main-view');
-
-    if (error) {
-        mainView.innerHTML = `<div class="fc-header"><span></span><span class="fc-settings-icon">⚙️</span></div><div class="fc-error">Hata: ${error}</div>`;
-        mainView.querySelector('.fc-settings-icon').addEventListener('click', () => {
-            console.log('FastChecker: Settings icon clicked (error view)');
-            toggleView(container);
-        });
-        return;
+function getBsrInfoFromPage() {
+    let bsrText = 'N/A', bsrNumber = null, categoryName = null;
+    const thElements = Array.from(document.querySelectorAll('th'));
+    const bsrTh = thElements.find(th => th.textContent.trim().includes('Best Sellers Rank') || th.textContent.trim().includes('Best-Sellers Rank'));
+    if (bsrTh && bsrTh.nextElementSibling) { const bsrSpan = bsrTh.nextElementSibling.querySelector('span'); if (bsrSpan) bsrText = bsrSpan.textContent.trim(); }
+    if (bsrText === 'N/A') {
+        const detailBullets = document.getElementById('detailBullets_feature_div');
+        if (detailBullets) { const bsrLi = Array.from(detailBullets.querySelectorAll('li')).find(li => li.innerText.includes('Best Sellers Rank')); if (bsrLi) bsrText = bsrLi.innerText.split(':')[1].trim(); }
+    }
+    if (bsrText === 'N/A') {
+        const rankElement = Array.from(document.querySelectorAll('span.a-list-item')).find(el => el.textContent.includes('Best Sellers Rank'));
+        if (rankElement) bsrText = rankElement.textContent.replace('Best Sellers Rank:', '').trim();
     }
+    const bsrMatch = bsrText.match(/[\d,]+/); if (bsrMatch) bsrNumber = parseInt(bsrMatch[0].replace(/[#,]/g, ''), 10);
+    const categoryMatch = bsrText.match(/in\s+([^\(]+)/); if (categoryMatch) categoryName = categoryMatch[1].trim();
+    return { bsrNumber, categoryName };
+}
 
-    productData = data;
+function sellableStatusHtml(data) {
+    return data.isSellable ? '<span class="fc-status fc-sellable">SATILABİLİR</span>' : '<span class="fc-status fc-not-sellable">ONAY GEREKLİ</span>';
+}
 
+function sellersCardHtml(data) {
     const offers = (data.offers || []).filter(Boolean);
     const defaultCurrency = data.currencyCode || 'USD';
-    const sellableStatus = data.isSellable ? '<span class="fc-status fc-sellable">SATILABİLİR</span>' : '<span class="fc-status fc-not-sellable">ONAY GEREKLİ</span>';
-
     let sellersHtml = offers.map(offer => {
         const sellerId = offer.SellerId || 'N/A';
         const sellerLink = `https://www.amazon.com/sp?ie=UTF8&seller=${sellerId}`;
@@ -345,6 +352,24 @@ function updateUI(container, data, error = null) {
         </div>
     `}).join('');
     if (!sellersHtml) sellersHtml = '<div class="fc-no-seller">Aktif teklif yok.</div>';
+    return `<div class="fc-card-header"><span class="icon">📦</span><h4>Satıcılar (${offers.length})</h4></div><div class="fc-seller-list">${sellersHtml}</div>`;
+}
+
+function updateUI(container, data, error = null) {
+    const mainView = container.querySelector('#fc-main-view');
+
+    if (error) {
+        mainView.innerHTML = `<div class="fc-header"><span></span><span class="fc-settings-icon">⚙️</span></div><div class="fc-error">Hata: ${error}</div>`;
+        mainView.querySelector('.fc-settings-icon').addEventListener('click', () => {
+            console.log('FastChecker: Settings icon clicked (error view)');
+            toggleView(container);
+        });
+        return;
+    }
+
+    productData = data;
+
+    const defaultCurrency = data.currencyCode || 'USD';
 
     mainView.innerHTML = `
         <div class="fc-header"><span>✨ FastChecker AI Analysis</span><span class="fc-settings-icon">⚙️</span></div>
@@ -364,7 +389,7 @@ function updateUI(container, data, error = null) {
                 <div class="fc-main-dim"><b>Boyut:</b> ${data.dimensions || 'N/A'}</div>
                 <div class="fc-main-weight"><b>Ağırlık:</b> ${data.packageWeight || 'N/A'}</div>
             </div>
-            <div class="fc-main-restriction">${sellableStatus}</div>
+            <div class="fc-main-restriction">${sellableStatusHtml(data)}</div>
         </div>
         <div class="fc-card fc-finance-calculator"> 
             <div class="fc-card-header"><span>Profit Calculator</span></div>
@@ -377,7 +402,7 @@ function updateUI(container, data, error = null) {
             </div>
             <div id="fc-shipping-cost-details" class="fc-fee-details"></div>
         </div>
-        <div class="fc-card fc-sellers"><div class="fc-card-header"><span class="icon">📦</span><h4>Satıcılar (${offers.length})</h4></div><div class="fc-seller-list">${sellersHtml}</div></div>
+        <div class="fc-card fc-sellers">${sellersCardHtml(data)}</div>
         <div class="fc-card fc-eu-market-prices" id="fc-eu-market-prices">
             <div class="fc-card-header">
                 <span class="icon">🇪🇺</span><h4>EU Market Fiyatları</h4>
@@ -393,38 +418,21 @@ function updateUI(container, data, error = null) {
         toggleView(container);
     });
 
-    let bsrText = 'N/A', bsrNumber = null, categoryName = 'N/A';
     function formatBsr(num) {
         if (isNaN(num)) return 'N/A'; if (num < 1000) return num.toString(); return `${Math.floor(num / 1000)}k`;
     }
-    function calculateBsrPercentage(bsr, category, bsrData) {
-        if (!bsr || !category || !bsrData || !bsrData[category]) return ''; const categoryData = bsrData[category];
-        const thresholds = {'0.5%': categoryData['Top 0.5% BSR'],'1%': categoryData['Top 1% BSR'],'2%': categoryData['Top 2% BSR'],'3%': categoryData['Top 3% BSR'],'5%': categoryData['Top 5% BSR'],'10%': categoryData['Top 10% BSR'],};
-        if (bsr <= thresholds['0.5%']) return ' (0.5%)'; if (bsr <= thresholds['1%']) return ' (1%)'; if (bsr <= thresholds['2%']) return ' (2%)';
-        if (bsr <= thresholds['3%']) return ' (3%)'; if (bsr <= thresholds['5%']) return ' (5%)'; if (bsr <= thresholds['10%']) return ' (10%)'; return '';
-    }
-    const thElements = Array.from(document.querySelectorAll('th'));
-    const bsrTh = thElements.find(th => th.textContent.trim().includes('Best Sellers Rank') || th.textContent.trim().includes('Best-Sellers Rank'));
-    if (bsrTh && bsrTh.nextElementSibling) { const bsrSpan = bsrTh.nextElementSibling.querySelector('span'); if (bsrSpan) bsrText = bsrSpan.textContent.trim(); }
-    if (bsrText === 'N/A') {
-        const detailBullets = document.getElementById('detailBullets_feature_div');
-        if (detailBullets) { const bsrLi = Array.from(detailBullets.querySelectorAll('li')).find(li => li.innerText.includes('Best Sellers Rank')); if (bsrLi) bsrText = bsrLi.innerText.split(':')[1].trim(); }
-    }
-    if (bsrText === 'N/A') {
-        const rankElement = Array.from(document.querySelectorAll('span.a-list-item')).find(el => el.textContent.includes('Best Sellers Rank'));
-        if (rankElement) bsrText = rankElement.textContent.replace('Best Sellers Rank:', '').trim();
-    }
-    const bsrMatch = bsrText.match(/[\d,]+/); if (bsrMatch) bsrNumber = parseInt(bsrMatch[0].replace(/[#,]/g, ''), 10);
-    const categoryMatch = bsrText.match(/in\s+([^\(]+)/); if (categoryMatch) categoryName = categoryMatch[1].trim();
+    // Percentile bucket is computed by the backend from the bsr/category we sent with the request
+    const { bsrNumber } = getBsrInfoFromPage();
     const bsrInput = mainView.querySelector('#bsrInput');
-    if (bsrInput) { const percentageString = calculateBsrPercentage(bsrNumber, categoryName, data.bsr_data); bsrInput.value = `${formatBsr(bsrNumber)}${percentageString}`; }
+    if (bsrInput) { const percentageString = data.bsrPercentile ? ` (${data.bsrPercentile})` : ''; bsrInput.value = `${formatBsr(bsrNumber)}${percentageString}`; }
 
     const costInput = mainView.querySelector('#costInput'); const saleInput = mainView.querySelector('#saleInput');
     const profitResult = mainView.querySelector('#profitResult'); const roiResult = mainView.querySelector('#roiResult'); const breakevenResult = mainView.querySelector('#breakevenResult');
-    let referralFeePercentage = (data.buyboxPrice && data.referralFee) ? (data.referralFee / data.buyboxPrice) : 0;
     function formatInput(inputElement) { let value = inputElement.value; if (value && !value.includes('.')) inputElement.value = parseFloat(value).toFixed(2); }
     function calculateProfit() {
         const cost = parseFloat(costInput.value) || 0; const sale = parseFloat(saleInput.value) || 0;
+        // data'dan her seferinde okunur, böylece sonradan gelen fiyat/ücret alanları da hesaba girer
+        const referralFeePercentage = (data.buyboxPrice && data.referralFee) ? (data.referralFee / data.buyboxPrice) : 0;
         const currentReferralFee = sale * referralFeePercentage; const fbaFee = data.fbaFee || 0;
         const totalFees = currentReferralFee + fbaFee; const profit = sale - cost - totalFees;
         const roi = cost === 0 ? 0 : (profit / cost) * 100;
@@ -469,6 +477,72 @@ function renderEuMarketPrices(container, asin, prices) {
     }
 }
 
+// Geç gelen alanları data'ya yazar ve panelde sadece onları gösteren kısımları günceller;
+// maliyet/satış girişleri, EU fiyatları ve kargo ayarları yerinde kalır
+function patchPendingFields(container, data, late, fields) {
+    const mainView = container.querySelector('#fc-main-view');
+    fields.forEach(field => { data[field] = late[field]; });
+    const has = (...names) => names.some(name => fields.includes(name));
+    const setHtml = (selector, html) => { const el = mainView.querySelector(selector); if (el) el.innerHTML = html; };
+
+    if (has('imageUrl', 'title')) {
+        const img = mainView.querySelector('.fc-main-info-img');
+        if (img) { img.src = data.imageUrl || ''; img.alt = data.title || ''; }
+    }
+    if (has('ean')) setHtml('.fc-main-ean', `<b>EAN:</b> ${data.ean || 'N/A'}`);
+    if (has('brand')) setHtml('.fc-main-brand-name', data.brand || 'N/A');
+    if (has('dimensions')) setHtml('.fc-main-dim', `<b>Boyut:</b> ${data.dimensions || 'N/A'}`);
+    if (has('packageWeight')) setHtml('.fc-main-weight', `<b>Ağırlık:</b> ${data.packageWeight || 'N/A'}`);
+    if (has('dimensions', 'packageWeight')) calculateAndDisplayShipping();
+    if (has('isSellable')) setHtml('.fc-main-restriction', sellableStatusHtml(data));
+    if (has('offers', 'currencyCode')) setHtml('.fc-sellers', sellersCardHtml(data));
+
+    if (has('buyboxPrice', 'currencyCode', 'referralFee', 'fbaFee')) {
+        const saleInput = mainView.querySelector('#saleInput');
+        if (!saleInput) return;
+        // Kullanıcı satış fiyatını henüz girmediyse buybox fiyatını yerleştir
+        if (data.buyboxPrice && !parseFloat(saleInput.value)) saleInput.value = data.buyboxPrice.toFixed(2);
+        // Kâr, ROI ve ücret satırları hesaplayıcının kendi dinleyicisiyle yenilenir
+        saleInput.dispatchEvent(new Event('input'));
+    }
+}
+
+// Backend süre sınırına yetişmeyen alanları 'pending' olarak döner; bunlar arka planda yüklenmeye
+// devam eder, kısa bir süre sonra sadece o alanlar tekrar istenir ve panelde yerinde güncellenir
+function fetchPendingFields(container, asin, marketplace, data, attempt = 1) {
+    if (!data.pending || data.pending.length === 0 || attempt > 3) return;
+    const params = new URLSearchParams({ marketplace, fields: data.pending.join(',') });
+    setTimeout(() => {
+        fetch(`https://web-production-e38b7.up.railway.app/get_product_details/${asin}?${params.toString()}`)
+            .then(r => r.json())
+            .then(late => {
+                if (late.error) return;
+                // Hâlâ bekleyenler dışındaki alanlar geldi
+                const arrived = data.pending.filter(field => !(late.pending || []).includes(field));
+                patchPendingFields(container, data, late, arrived);
+                data.pending = late.pending;
+                data.retryAfterMs = late.retryAfterMs;
+                fetchPendingFields(container, asin, marketplace, data, attempt + 1);
+            })
+            .catch(e => console.warn('FastChecker: Bekleyen alanlar alınamadı:', e.message));
+    }, data.retryAfterMs || 1000);
+}
+
+// Sayfadaki ilgili ürünleri (karuseller, "bunu alanlar şunu da aldı") backend'e ön yükleme için gönder
+function prefetchRelatedAsins(currentAsin, marketplace) {
+    const asins = [];
+    document.querySelectorAll('a[href*="/dp/"]').forEach(link => {
+        const match = link.getAttribute('href').match(/\/dp\/([A-Z0-9]{10})/);
+        if (match && match[1] !== currentAsin && !asins.includes(match[1])) asins.push(match[1]);
+    });
+    if (asins.length === 0) return;
+    chrome.runtime && chrome.runtime.sendMessage && chrome.runtime.sendMessage({
+        action: 'prefetchAsins',
+        marketplace: marketplace,
+        asins: asins.slice(0, 30)
+    });
+}
+
 chrome.runtime && chrome.runtime.onMessage && chrome.runtime.onMessage.addListener((msg) => {
     if (msg.action === 'euMarketPrices' && msg.asin) {
         let container = document.getElementById('fastchecker-product-ui');
@@ -488,17 +562,25 @@ chrome.runtime && chrome.runtime.onMessage && chrome.runtime.onMessage.addListen
     if (!container) return;
     
     // Backend'den veri çek - marketplace parametresi ile
-    fetch(`https://web-production-e38b7.up.railway.app/get_product_details/${asin}?marketplace=${marketplace}`)
+    // BSR ve kategori gönderilir, backend sadece yüzdelik dilimi döner
+    const params = new URLSearchParams({ marketplace });
+    const { bsrNumber, categoryName } = getBsrInfoFromPage();
+    if (bsrNumber) params.set('bsr', bsrNumber);
+    if (categoryName) params.set('category', categoryName);
+    fetch(`https://web-production-e38b7.up.railway.app/get_product_details/${asin}?${params.toString()}`)
         .then(r => r.json())
         .then(data => {
             if (data.error) {
                 updateUI(container, {}, data.error);
             } else {
                 updateUI(container, data);
+                fetchPendingFields(container, asin, marketplace, data);
             }
         })
         .catch(e => updateUI(container, {}, e.message));
     
+    prefetchRelatedAsins(asin, marketplace);
+
     renderEuMarketPrices(container, asin, []);
     chrome.runtime && chrome.runtime.sendMessage && chrome.runtime.sendMessage({
         action: 'fetchEuMarketPrices',